@@ -1,9 +1,16 @@
 import os
+import sys
 import logging
-from prometheus_client import start_http_server, Gauge, Counter
+from prometheus_client import start_http_server, Gauge, Counter, Histogram
 import json
 from influx_helper import InfluxdbHelper
+from template_engine import TEMPLATES
 from subscriber import AMQPSubscriber
+from dead_letter import DeadLetterBuffer
+from state_store import StateStore
+from reconciler import Reconciler
+from shards import ShardSupervisor
+import tracing
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -15,27 +22,41 @@ AMQP_CONNECTION_STATUS = Gauge('amqp_connection_status', 'Connection status (1 =
 AMQP_MESSAGE_COUNT = Counter('amqp_message_count', 'Number of successfully processed messages')
 AMQP_IGNORED_MESSAGE_COUNT = Counter('amqp_ignored_message_count', 'Number of ignored messages')
 AMQP_FAILED_MESSAGE_COUNT = Counter('amqp_failed_message_count', 'Number of failed message processing attempts')
+AMQP_WORKER_QUEUE_DEPTH = Gauge('amqp_worker_queue_depth', 'Number of messages waiting in a worker queue', ['worker'])
+AMQP_COALESCED_MESSAGE_COUNT = Counter('amqp_coalesced_message_count', 'Number of messages not processed on their own because of coalescing', ['reason'])
+AMQP_WORKER_UTILISATION = Gauge('amqp_worker_utilisation', 'Fraction of time a worker spent processing messages since the last scrape', ['worker'])
+AMQP_MESSAGES_UNSETTLED = Gauge('amqp_messages_unsettled', 'Number of received messages not yet settled (queued, held or being processed)')
+AMQP_QUEUE_DEPTH = Gauge('amqp_queue_depth', 'Number of messages waiting in all worker queues and the coalescing window')
+LATENCY_BUCKETS = (.01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+AMQP_MESSAGE_QUEUE_WAIT = Histogram('amqp_message_queue_wait_seconds', 'Time from message receipt to the start of its processing', buckets=LATENCY_BUCKETS)
+AMQP_MESSAGE_LATENCY = Histogram('amqp_message_latency_seconds', 'Time from message receipt to the end of its processing', buckets=LATENCY_BUCKETS)
 
 
+# Extract App.Id and Operation from a message
+def parse_message(message):
+    app_id = ''
+    operation = 'create'
+    if isinstance(message, dict):
+        logger.debug("Message is a dictionary")
+        app_id = message.get('app-id', '')
+        operation = message.get('operation', '')
+    if isinstance(message, str):
+        logger.debug("Message is a string. Converting to dictionary")
+        d = json.loads(message)
+        app_id = d.get('app-id', '')
+        operation = d.get('operation', '')
+    if operation=='':
+        operation = 'create'
+    return app_id, operation
+
 # Define a message processing function (this is your functional interface)
 def process_message(message):
     logger.info(f"Processing message: {message}")
 
     try:
         # Extract App.Id and Operation from the message
-        app_id = ''
-        operation = 'create'
-        if isinstance(message, dict):
-            logger.debug("Message is a dictionary")
-            app_id = message.get('app-id', '')
-            operation = message.get('operation', '')
-        if isinstance(message, str):
-            logger.debug("Message is a string. Converting to dictionary")
-            d = json.loads(message)
-            app_id = d.get('app-id', '')
-            operation = d.get('operation', '')
-        if operation=='':
-            operation = 'create'
+        app_id, operation = parse_message(message)
+        tracing.annotate(operation=operation)
 
         # If App.Id has a value
         if app_id and app_id.strip():
@@ -43,12 +64,13 @@ def process_message(message):
             if operation=='create':
                 # Initialize app-specific artefacts in Influxdb, using an InfluxdbHelper instance
                 influxdb_helper = InfluxdbHelper(INFLUXDB_URL, ADMIN_TOKEN, ORG_NAME, app_id)
+                # Resume from the checkpoint of an earlier (failed or redelivered) create, if any
+                influxdb_helper.loadFromStore(STATE_STORE, app_id)
                 logger.info(f"Creating App. with Id: {app_id}")
-                influxdb_helper.create_all()
-
-                # Store InfluxdbHelper state in an app-state file
-                logger.info(f"Storing the state of App. with Id: {app_id}")
-                influxdb_helper.saveToFile(f'app-states/state-{app_id}.yaml')
+                # The InfluxdbHelper state is checkpointed in the state store as each step completes
+                timings = influxdb_helper.create_all(store=STATE_STORE)
+                logger.info(f"Created App. with Id: {app_id}. Step timings: "
+                            + ", ".join(f"{step}={secs:.3f}s" for step, secs in timings.items()))
                 AMQP_MESSAGE_COUNT.inc()  # Increment success counter
             elif operation=='delete':
                 # Find artefact id's and name's for given App.Id
@@ -57,21 +79,17 @@ def process_message(message):
                 influxdb_helper.find_all(app_id)
 
                 # Delete all artefacts for given App.Id
-                logger.info(f"Deleting App. with Id: {app_id}")
-                influxdb_helper.delete_all()
-                logger.info(f"Deleted App. with Id: {app_id}")
+                delete_app(influxdb_helper, app_id)
                 AMQP_MESSAGE_COUNT.inc()  # Increment success counter
             elif operation=='delete_2':
-                # Load the appropriate app-state file
+                # Load the stored state of the App.
                 logger.info(f"Loading state of App. with Id: {app_id}")
-                state_file = f'app-states/state-{app_id}.yaml'
-                influxdb_helper = InfluxdbHelper('', '', '', '')
-                influxdb_helper.loadFromFile(state_file)
+                influxdb_helper = InfluxdbHelper(INFLUXDB_URL, ADMIN_TOKEN, ORG_NAME, app_id)
+                if not influxdb_helper.loadFromStore(STATE_STORE, app_id):
+                    raise KeyError(f"No stored state for App. with Id: {app_id}")   # Not retried
 
                 # Delete all artefacts for given App.Id
-                logger.info(f"Deleting App. with Id: {app_id}")
-                influxdb_helper.delete_all()
-                logger.info(f"Deleted App. with Id: {app_id}")
+                delete_app(influxdb_helper, app_id)
                 AMQP_MESSAGE_COUNT.inc()  # Increment success counter
             elif operation=='find_all':
                 # Find artefact id's and name's for given App.Id
@@ -92,9 +110,124 @@ def process_message(message):
         AMQP_FAILED_MESSAGE_COUNT.inc()  # Increment failure counter
         raise
 
+# Message processing function of the asyncio engine (PROVISIONING_ENGINE=asyncio): same operations as
+# process_message, using AsyncInfluxdbHelper. All messages are processed concurrently on one event loop.
+async def process_message_async(message):
+    logger.info(f"Processing message: {message}")
+
+    try:
+        # Extract App.Id and Operation from the message
+        app_id, operation = parse_message(message)
+        tracing.annotate(operation=operation)
+
+        # If App.Id has a value
+        if app_id and app_id.strip():
+            logger.info(f"App.Id: {app_id}")
+            if operation=='create':
+                # Resume from the checkpoint of an earlier (failed or redelivered) create, if any
+                influxdb_helper = AsyncInfluxdbHelper(INFLUXDB_URL, ADMIN_TOKEN, ORG_NAME, app_id)
+                influxdb_helper.loadFromStore(STATE_STORE, app_id)
+                logger.info(f"Creating App. with Id: {app_id}")
+                timings = await influxdb_helper.create_all(store=STATE_STORE)
+                logger.info(f"Created App. with Id: {app_id}. Step timings: "
+                            + ", ".join(f"{step}={secs:.3f}s" for step, secs in timings.items()))
+                AMQP_MESSAGE_COUNT.inc()  # Increment success counter
+            elif operation in ('delete', 'delete_2'):
+                influxdb_helper = AsyncInfluxdbHelper(INFLUXDB_URL, ADMIN_TOKEN, ORG_NAME, app_id)
+                if operation=='delete':
+                    # Find artefact id's and name's for given App.Id
+                    logger.info(f"Retrieving state of App. with Id: {app_id}")
+                    await influxdb_helper.find_all(app_id)
+                elif not influxdb_helper.loadFromStore(STATE_STORE, app_id):
+                    raise KeyError(f"No stored state for App. with Id: {app_id}")   # Not retried
+
+                # Delete all artefacts for given App.Id
+                logger.info(f"Deleting App. with Id: {app_id}")
+                deleted_app(influxdb_helper, app_id, await influxdb_helper.delete_all())
+                AMQP_MESSAGE_COUNT.inc()  # Increment success counter
+            elif operation=='find_all':
+                # Find artefact id's and name's for given App.Id
+                logger.info(f"Retrieving state of App. with Id: {app_id}")
+                influxdb_helper = AsyncInfluxdbHelper(INFLUXDB_URL, ADMIN_TOKEN, ORG_NAME, app_id)
+                await influxdb_helper.find_all(app_id)
+            else:
+                logger.warning(f"Unknown operation {operation}. Ignoring the message")
+                AMQP_IGNORED_MESSAGE_COUNT.inc()  # Increment ignored counter
+            return f"Processed: {message}"
+        else:
+            logger.warning("App.Id not found. Ignoring the message")
+            raise KeyError("App.Id not found")
+    except KeyError as e:
+        AMQP_IGNORED_MESSAGE_COUNT.inc()  # Increment ignored counter
+        raise
+    except Exception as e:
+        AMQP_FAILED_MESSAGE_COUNT.inc()  # Increment failure counter
+        raise
+
+# Delete all artefacts of an App. The stored state is kept if some could not be deleted, for a retry
+def delete_app(influxdb_helper, app_id):
+    logger.info(f"Deleting App. with Id: {app_id}")
+    deleted_app(influxdb_helper, app_id, influxdb_helper.delete_all())
+
+# Check the teardown outcome of an App., and forget its stored state if all its artefacts are deleted
+# (otherwise, only the create steps whose artefacts are deleted)
+def deleted_app(influxdb_helper, app_id, outcome):
+    logger.info(f"Teardown of App. with Id: {app_id}: "
+                + ", ".join(f"{step}={o['status']}" for step, o in outcome.items()))
+    failed = InfluxdbHelper.failed_steps(outcome)
+    if failed:
+        influxdb_helper.forget_undone_steps(STATE_STORE, outcome)
+        raise Exception(f"Could not delete App. with Id: {app_id}: "
+                        + "; ".join(f"{step}: {outcome[step]['error']}" for step in failed))
+    STATE_STORE.delete(influxdb_helper.app_id)
+    logger.info(f"Deleted App. with Id: {app_id}")
+
+# Partition key of a message: its normalized App.Id, so that operations on the same app stay in order
+def message_app_id(message):
+    try:
+        app_id, _ = parse_message(message)
+    except (ValueError, AttributeError):
+        return None
+    if not isinstance(app_id, str) or not app_id.strip():
+        return None
+    return InfluxdbHelper.normalize_app_id(app_id)
+
+# Collapse redundant lifecycle operations of one app, received within the coalescing window.
+# Repeated creates (or deletes) become one. A create followed by a delete cancels out if the app has no
+# stored state (in store); otherwise the app may exist (e.g. the create is a duplicate), and only the delete
+# is processed. Returns the (message index, [folded message indexes]) groups to process, and the cancelled
+# message indexes.
+def coalesce_messages(messages, store=None):
+    groups = []         # [message index, operation, folded indexes]
+    cancelled = []
+    for i, message in enumerate(messages):
+        try:
+            app_id, operation = parse_message(message)
+        except (ValueError, AttributeError):
+            app_id, operation = None, None    # Unparseable messages are processed as they are
+        last = groups[-1] if groups else None
+        if last and operation == last[1] and operation in ('create', 'delete', 'delete_2'):
+            last[2].append(i)
+            AMQP_COALESCED_MESSAGE_COUNT.labels(reason='duplicate').inc()
+        elif last and last[1] == 'create' and operation in ('delete', 'delete_2'):
+            groups.pop()
+            if store is not None and InfluxdbHelper.normalize_app_id(app_id) not in store:
+                cancelled.extend([last[0]] + last[2] + [i])
+                AMQP_COALESCED_MESSAGE_COUNT.labels(reason='cancelled').inc(2)
+            else:
+                groups.append([i, operation, [last[0]] + last[2]])
+                AMQP_COALESCED_MESSAGE_COUNT.labels(reason='superseded').inc()
+        else:
+            groups.append([i, operation, []])
+    return [(index, folded) for index, _, folded in groups], cancelled
+
 def connection_status(status):
     AMQP_CONNECTION_STATUS.set(status)
 
+def message_timing(queue_wait, latency):
+    AMQP_MESSAGE_QUEUE_WAIT.observe(queue_wait)
+    AMQP_MESSAGE_LATENCY.observe(latency)
+
 if __name__ == "__main__":
     # Retrieve configuration from environment variables
     BROKER_URL = os.getenv("BROKER_URL", "amqp://activemq:5672")
@@ -104,12 +237,92 @@ if __name__ == "__main__":
     ADMIN_TOKEN  = os.getenv("INFLUXDB_ADMIN_TOKEN", "")
     ORG_NAME     = os.getenv("INFLUXDB_ORG_NAME", "my-org")
 
-    # Start Prometheus HTTP server on port 8000 for scraping
-    start_http_server(8000)
+    WORKER_COUNT = int(os.getenv("WORKER_COUNT", "4"))
+    MESSAGE_BUFFER_SIZE = int(os.getenv("MESSAGE_BUFFER_SIZE", "100"))
+    COALESCE_WINDOW_SECONDS = float(os.getenv("COALESCE_WINDOW_SECONDS", "0"))  # 0 disables coalescing
+    DLQ_BATCH_SIZE = int(os.getenv("DLQ_BATCH_SIZE", "50"))
+    DLQ_FLUSH_INTERVAL = float(os.getenv("DLQ_FLUSH_INTERVAL", "1"))
+    DLQ_MAX_BUFFERED = int(os.getenv("DLQ_MAX_BUFFERED", "1000"))
+    DLQ_SPILL_FILE = os.getenv("DLQ_SPILL_FILE", "app-states/dlq-spill.jsonl")
+    DLQ_SPILL_MAX_BYTES = int(os.getenv("DLQ_SPILL_MAX_BYTES", str(10 * 1024 * 1024)))
+    MAX_DELIVERIES = int(os.getenv("MAX_DELIVERIES", "5"))  # Attempts of a failed message before it is dead-lettered
+    STATE_DB_FILE = os.getenv("STATE_DB_FILE", "app-states/state.db")
+    STATE_IMPORT_DIR = os.getenv("STATE_IMPORT_DIR", "")    # Import the state-*.yaml files of this directory at startup
+    RECONCILE_INTERVAL_SECONDS = float(os.getenv("RECONCILE_INTERVAL_SECONDS", "3600"))  # 0 disables reconciliation
+    RECONCILE_REPAIR = os.getenv("RECONCILE_REPAIR", "false").lower() in ("1", "true", "yes")  # Default: report only
+    RECONCILE_GRACE_SECONDS = float(os.getenv("RECONCILE_GRACE_SECONDS", "600"))
+    RECONCILE_PAGE_SIZE = int(os.getenv("RECONCILE_PAGE_SIZE", "200"))
+    RECONCILE_PAGE_PAUSE = float(os.getenv("RECONCILE_PAGE_PAUSE", "0.5"))
+    PROVISIONING_ENGINE = os.getenv("PROVISIONING_ENGINE", "threads")  # 'threads' (WORKER_COUNT workers) or 'asyncio'
+    METRICS_PORT = int(os.getenv("METRICS_PORT", "8000"))
+    SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))        # Consumer processes (1: consume in this process)
+    SHARD_INDEX = os.getenv("SHARD_INDEX")                  # Set by the shard supervisor, in each consumer process
+    SHARD_MODE = os.getenv("SHARD_MODE", "partitioned")     # 'partitioned' (by App.Id, in order) or 'shared'
+    SHARED_SUBSCRIPTION = os.getenv("SHARED_SUBSCRIPTION", f"{TOPIC_NAME}-provisioning")
+
+    # The asyncio engine needs aiohttp, which is only imported when it is used
+    if PROVISIONING_ENGINE == 'asyncio':
+        from async_influx import AsyncInfluxdbHelper
+    elif PROVISIONING_ENGINE != 'threads':
+        raise ValueError(f"Unknown PROVISIONING_ENGINE: {PROVISIONING_ENGINE}")
+
+    # Open the app state store, importing the per-app YAML files of earlier versions if asked to
+    # (once, before the consumer processes are started, when sharded)
+    STATE_STORE = StateStore(STATE_DB_FILE)
+    if STATE_IMPORT_DIR and SHARD_INDEX is None:
+        STATE_STORE.import_yaml_files(STATE_IMPORT_DIR)
+
+    # Sharded: this process only supervises SHARD_COUNT consumer processes (running this script with
+    # SHARD_INDEX set), and serves the metrics of all of them, with a 'shard' label, on METRICS_PORT
+    if SHARD_COUNT > 1 and SHARD_INDEX is None:
+        if SHARD_MODE not in ('partitioned', 'shared'):
+            raise ValueError(f"Unknown SHARD_MODE: {SHARD_MODE}")
+        STATE_STORE.close()
+        sys.exit(ShardSupervisor(SHARD_COUNT, [sys.executable] + sys.argv, METRICS_PORT).run())
+    SHARD_INDEX = int(SHARD_INDEX or 0)
+    if SHARD_INDEX > 0:
+        # One spill file per consumer process (the first one keeps the file of a single process)
+        base, ext = os.path.splitext(DLQ_SPILL_FILE)
+        DLQ_SPILL_FILE = f"{base}.{SHARD_INDEX}{ext}"
+
+    # Start Prometheus HTTP server on port 8000 for scraping (a consumer process serves the supervisor only)
+    start_http_server(METRICS_PORT, addr='127.0.0.1' if SHARD_COUNT > 1 else '0.0.0.0')
+
+    # Compile the dashboard and chart templates once, at startup
+    TEMPLATES.preload([InfluxdbHelper.DASHBOARD_TEMPLATE_FILE, InfluxdbHelper.CHART_TEMPLATE_FILE])
+
+    # Reconcile the state store with InfluxDB at startup and then periodically, in the background
+    # (by the first consumer process only, when sharded)
+    if RECONCILE_INTERVAL_SECONDS > 0 and SHARD_INDEX == 0:
+        Reconciler(INFLUXDB_URL, ADMIN_TOKEN, ORG_NAME, STATE_STORE,
+                   repair=RECONCILE_REPAIR,
+                   page_size=RECONCILE_PAGE_SIZE,
+                   page_pause=RECONCILE_PAGE_PAUSE,
+                   grace=RECONCILE_GRACE_SECONDS).start(RECONCILE_INTERVAL_SECONDS)
 
     # Create subscriber instance and run
     subscriber = AMQPSubscriber(broker_url=BROKER_URL,
                                 topic=TOPIC_NAME,
                                 message_processor=process_message,
-                                connection_status_callback=connection_status)
+                                connection_status_callback=connection_status,
+                                worker_count=WORKER_COUNT,
+                                partition_key=message_app_id,
+                                buffer_size=MESSAGE_BUFFER_SIZE,
+                                coalesce_window=COALESCE_WINDOW_SECONDS,
+                                coalesce=lambda messages: coalesce_messages(messages, STATE_STORE),
+                                dead_letter_buffer=DeadLetterBuffer(DLQ_MAX_BUFFERED, DLQ_SPILL_FILE, DLQ_SPILL_MAX_BYTES),
+                                dlq_batch_size=DLQ_BATCH_SIZE,
+                                dlq_flush_interval=DLQ_FLUSH_INTERVAL,
+                                message_timing_callback=message_timing,
+                                async_message_processor=process_message_async if PROVISIONING_ENGINE == 'asyncio' else None,
+                                shard_index=SHARD_INDEX,
+                                shard_count=SHARD_COUNT,
+                                shared_subscription=SHARED_SUBSCRIPTION if SHARD_COUNT > 1 and SHARD_MODE == 'shared' else None,
+                                max_deliveries=MAX_DELIVERIES)
+    for worker in subscriber.workers:
+        AMQP_WORKER_QUEUE_DEPTH.labels(worker=worker.name).set_function(worker.queue_depth)
+        AMQP_WORKER_UTILISATION.labels(worker=worker.name).set_function(worker.utilisation)
+    AMQP_MESSAGES_UNSETTLED.set_function(lambda: subscriber.unsettled)
+    AMQP_QUEUE_DEPTH.set_function(lambda: sum(w.queue_depth() for w in subscriber.workers)
+                                  + (subscriber.coalescer.pending() if subscriber.coalescer else 0))
     subscriber.run()
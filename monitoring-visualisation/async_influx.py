@@ -0,0 +1,478 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import weakref
+import aiohttp
+from governor import GOVERNOR, is_retryable
+from influx_helper import CellViewError, InfluxdbHelper
+from metrics import INFLUXDB_REQUEST_SECONDS, INFLUXDB_REQUESTS_IN_FLIGHT, INFLUXDB_RETRIES, PROVISIONING_IN_FLIGHT, \
+    endpoint_of, observe_step
+from org_cache import ORG_CACHE
+from resource_catalog import ListingError, ResourceCatalog, aiter_listing, resource_name
+from step_executor import AsyncStepExecutor, gather_parallel
+import tracing
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+class AsyncResponse:
+    """A response read in full, with the requests.Response attributes used by the helpers."""
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content) if self.content else None
+
+    def __repr__(self):
+        return f"<AsyncResponse [{self.status_code}]>"
+
+
+class AsyncInfluxdbClient:
+    """HTTP client for the InfluxDB v2 API on an event loop: one aiohttp session, whose connection pool is
+    shared by all the requests of the loop. Same settings, metrics, governor and retries as InfluxdbClient."""
+
+    def __init__(self, pool_maxsize=None, connect_timeout=None, read_timeout=None, retries=None, governor=None):
+        self.pool_maxsize = pool_maxsize if pool_maxsize is not None else int(os.getenv("INFLUXDB_POOL_MAXSIZE", "32"))
+        self.connect_timeout = connect_timeout if connect_timeout is not None \
+            else float(os.getenv("INFLUXDB_CONNECT_TIMEOUT", "5"))
+        self.read_timeout = read_timeout if read_timeout is not None else float(os.getenv("INFLUXDB_READ_TIMEOUT", "30"))
+        self.timeout = aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+        self.retries = retries if retries is not None else int(os.getenv("INFLUXDB_RETRIES", "3"))
+        self.governor = governor or GOVERNOR
+        self.session = None     # Created on first use, on the loop
+        logger.debug(f"InfluxDB async client pool: maxsize={self.pool_maxsize}, timeout={self.timeout}")
+
+    def _session(self):
+        if self.session is None or self.session.closed:
+            # Requests beyond pool_maxsize wait for a free connection, as with the blocking pool
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool_maxsize),
+                                                 timeout=self.timeout)
+        return self.session
+
+    async def request(self, method, url, **kwargs):
+        endpoint = endpoint_of(url)
+        with tracing.span(f"{method} {endpoint}"):
+            for attempt in range(self.retries + 1):
+                response = await self._request(method, url, endpoint, **kwargs)
+                if not is_retryable(method, response.status_code) or attempt == self.retries:
+                    tracing.annotate(status=response.status_code, attempts=attempt + 1)
+                    return response
+                # The governor holds back new calls for Retry-After (or a backoff): the retry waits for it
+                INFLUXDB_RETRIES.inc()
+                logger.warning(f"{method} {endpoint}: {response.status_code}, retrying ({attempt + 1}/{self.retries})")
+
+    async def _request(self, method, url, endpoint, **kwargs):
+        response = None
+        cancelled = False
+        queued_at = time.perf_counter()
+        ticket = await self.governor.acquire_async()
+        start = time.perf_counter()
+        tracing.annotate(governor_wait_ms=round((start - queued_at) * 1000, 3))
+        INFLUXDB_REQUESTS_IN_FLIGHT.inc()
+        try:
+            async with self._session().request(method, url, **kwargs) as r:
+                response = AsyncResponse(r.status, r.headers, await r.read())
+            return response
+        except asyncio.CancelledError:
+            cancelled = True    # Not an InfluxDB failure
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            status = response.status_code if response is not None else None
+            INFLUXDB_REQUESTS_IN_FLIGHT.dec()
+            INFLUXDB_REQUEST_SECONDS.labels(method=method, endpoint=endpoint, status=str(status or "error")) \
+                .observe(elapsed)
+            self.governor.release(ticket, endpoint, elapsed, status,
+                                  response.headers.get("Retry-After") if response is not None else None,
+                                  adapt=not cancelled)
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request("POST", url, **kwargs)
+
+    async def patch(self, url, **kwargs):
+        return await self.request("PATCH", url, **kwargs)
+
+    async def delete(self, url, **kwargs):
+        return await self.request("DELETE", url, **kwargs)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+
+# One client per event loop (an aiohttp session can only be used on the loop it was created on)
+_clients = weakref.WeakKeyDictionary()
+# In-flight organization lookups per event loop: {(url, org. name): task}
+_org_lookups = weakref.WeakKeyDictionary()
+
+
+def get_async_client():
+    """Return the InfluxDB client of the running event loop, creating it on first use."""
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = _clients[loop] = AsyncInfluxdbClient()
+    return client
+
+
+async def close_async_client():
+    """Close the InfluxDB client of the running event loop, if any."""
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.close()
+
+
+class AsyncInfluxdbHelper(InfluxdbHelper):
+    """InfluxdbHelper for an event loop: create_all, delete_all and find_all (and their steps) are coroutines,
+    with the same semantics, checkpoints and state as InfluxdbHelper. Each app is one helper instance, and
+    any number of apps can be provisioned concurrently on one loop, over the loop's shared connection pool.
+    The step lists (create_steps, delete_steps) are inherited: their functions return coroutines here."""
+
+    # Shared, pooled HTTP client of the running loop (kept out of the instance state, which is saved)
+    @property
+    def http(self):
+        return get_async_client()
+
+    def _iter_listing(self, url_path, json_section):
+        return aiter_listing(self.http, self.influxdb_base_url, self.headers, url_path, json_section)
+
+    # 1. Set organization id from org. name
+    async def set_org(self):
+        return await self._set_org(self.org_name)
+
+    async def _set_org(self, org_name):
+        # Cached process-wide, as for InfluxdbHelper; concurrent creates on the loop share one lookup
+        key = (self.influxdb_base_url, org_name)
+        org_id = ORG_CACHE.peek(key)
+        if org_id is None:
+            lookups = _org_lookups.setdefault(asyncio.get_running_loop(), {})
+            task = lookups.get(key)
+            if task is None:
+                task = lookups[key] = asyncio.ensure_future(self._lookup_and_cache_org(key, org_name))
+                task.add_done_callback(lambda _: lookups.pop(key, None))
+            org_id = await asyncio.shield(task)     # A cancelled caller does not cancel the others' lookup
+        self.org_id = org_id
+        self.org_name = org_name
+        return org_id
+
+    async def _lookup_and_cache_org(self, key, org_name):
+        org_id = await self._lookup_org(org_name)
+        ORG_CACHE.put(key, org_id)
+        return org_id
+
+    async def _lookup_org(self, org_name):
+        try:
+            async for org in self._iter_listing("/api/v2/orgs", 'orgs'):
+                if org['name'] == org_name:
+                    self.info(f"Organization '{org_name}' found with ID: {org['id']}")
+                    return org['id']
+        except Exception as e:
+            self.error(f"Error while fetching organization list: {e}")
+        self.error(f"Organization '{org_name}' not found")
+
+    # Create a resource, and return its data. If the name is already taken and the listing (URL path,
+    # JSON section) to look for it is given, the existing resource is adopted: its data is then {'id': ...}
+    async def _post_create(self, what, url_path, payload, name, listing=None):
+        response = await self.http.post(f"{self.influxdb_base_url}{url_path}", headers=self.headers, json=payload)
+        if response.status_code == 201:
+            data = response.json()
+            self.info(f"{what.capitalize()} '{name}' created successfully!")
+            self.debug(lambda: f"Response: {data}")
+            return data
+        elif listing is not None and response.status_code in self.ALREADY_EXISTS:
+            return {'id': await self._adopt(what, *listing, name, response)}
+        else:
+            self.error(f"Error creating {what}: {response.text}")
+
+    # Delete a resource: "deleted", or "missing" if it was already deleted
+    async def _delete(self, what, url_path, name):
+        url = f"{self.influxdb_base_url}{url_path}"
+        self.debug(lambda: f"Deleting {what} {name}: '{url}'")
+        response = await self.http.delete(url, headers=self.headers)
+        self.debug(lambda: f"Deleting {what}: RESPONSE: '{response}'")
+        if response.status_code == 204:
+            self.info(f"{what.capitalize()} '{name}' deleted successfully!")
+            return "deleted"
+        elif response.status_code == 404:
+            self.info(f"{what.capitalize()} '{name}' was already deleted")
+            return "missing"
+        else:
+            self.error(f"Error deleting {what}: {response.text}")
+
+    # 2. Create a new bucket
+    async def create_bucket(self):
+        data = await self._post_create("bucket", "/api/v2/buckets", self._bucket_payload(self.bucket_name, self.org_id),
+                                       self.bucket_name, (f"/api/v2/buckets?orgID={self.org_id}", "buckets"))
+        self.bucket_id = data['id']
+        return self.bucket_id
+
+    async def delete_bucket(self):
+        return await self._delete("bucket", f"/api/v2/buckets/{self.bucket_id}", self.bucket_name)
+
+    # 3. Create a new scraper
+    async def create_scraper(self, adopt=False):
+        # Scraper names are not unique: when resuming, look for one created by the earlier attempt first
+        scraper_id = adopt and await self._find_id("/api/v2/scrapers", "configurations", self.scraper_name)
+        if not scraper_id:
+            payload = self._scraper_payload(self.scraper_name, self.scraper_url, self.org_id, self.bucket_id)
+            scraper_id = (await self._post_create("scraper", "/api/v2/scrapers", payload, self.scraper_name))['id']
+        self.scraper_id = scraper_id
+        return self.scraper_id
+
+    async def delete_scraper(self):
+        return await self._delete("scraper", f"/api/v2/scrapers/{self.scraper_id}", self.scraper_name)
+
+    # 4. Create a new user
+    async def create_user(self):
+        data = await self._post_create("user", "/api/v2/users",
+                                       self._user_payload(self.user_name, self.user_password, self.org_id),
+                                       self.user_name, ("/api/v2/users", "users"))
+        self.user_id = data['id']
+        # Also resets the password of an adopted user
+        await self._update_user_password(self.user_id, self.user_name, self.user_password)
+        return self.user_id
+
+    async def _update_user_password(self, user_id, user_name, user_password):
+        url = f"{self.influxdb_base_url}/api/v2/users/{user_id}/password"
+        response = await self.http.post(url, headers=self.headers, json={"password": user_password})
+        if response.status_code == 204:
+            self.info(f"User '{user_name}' password updated successfully!")
+        else:
+            self.error(f"Error updating user password: {response.text}")
+
+    async def delete_user(self):
+        return await self._delete("user", f"/api/v2/users/{self.user_id}", self.user_name)
+
+    # 5. Create the variables, concurrently
+    async def create_variables(self):
+        metrics_query, fields_query = self._variable_queries()
+        self.var_id_metrics, self.var_id_fields = await asyncio.gather(
+            self._create_variable(self.var_name_metrics, metrics_query, self.org_id),
+            self._create_variable(self.var_name_fields, fields_query, self.org_id))
+        return self.var_id_metrics, self.var_id_fields
+
+    async def _create_variable(self, variable_name, variable_query, org_id):
+        data = await self._post_create("variable", "/api/v2/variables",
+                                       self._variable_payload(variable_name, variable_query, org_id),
+                                       variable_name, ("/api/v2/variables", "variables"))
+        return data['id']
+
+    async def delete_variables(self):
+        await asyncio.gather(self._delete_variable(self.var_id_metrics, self.var_name_metrics),
+                             self._delete_variable(self.var_id_fields, self.var_name_fields))
+
+    async def _delete_variable(self, variable_id, variable_name):
+        return await self._delete("variable", f"/api/v2/variables/{variable_id}", variable_name)
+
+    # 6. Create a new dashboard from template
+    async def create_dashboard(self, adopt=False):
+        # Dashboard names are not unique: when resuming, look for one created by the earlier attempt first
+        dashboard_id = adopt and await self._find_id("/api/v2/dashboards", "dashboards", self.dashboard_name)
+        if dashboard_id:
+            self.info(f"Dashboard '{self.dashboard_name}' already exists: adopting {dashboard_id}")
+            dashboard_data = await self._get_dashboard(dashboard_id)
+        else:
+            dashboard_data = await self._post_create("dashboard", "/api/v2/dashboards",
+                                                     self._load_dashboard_template(self.DASHBOARD_TEMPLATE_FILE),
+                                                     self.dashboard_name)
+        self.dashboard_id = dashboard_data['id']
+        self.dashboard_cells = [{'id': c['id'], 'name': c['name']} for c in dashboard_data['cells']]
+        return self.dashboard_id
+
+    # 6b. Patch the views of the dashboard cells not patched yet
+    async def create_cell_views(self):
+        dashboard_tpl = self._load_dashboard_template(self.DASHBOARD_TEMPLATE_FILE)
+        cells = self.dashboard_cells
+        for attempt in range(self.CELL_RETRIES + 1):
+            try:
+                await self._create_cell_views(self.dashboard_id, dashboard_tpl, cells)
+                break
+            except CellViewError as e:
+                # Only the failed cells are left (and checkpointed): a resumed create patches just these
+                self.dashboard_cells = e.cells
+                if attempt == self.CELL_RETRIES:
+                    raise
+                self.info(f"Retrying {len(e.cells)} failed cell(s) of dashboard '{self.dashboard_name}'")
+                cells = e.cells
+        self.dashboard_cells = []
+
+    async def _get_dashboard(self, dashboard_id):
+        response = await self.http.get(f"{self.influxdb_base_url}/api/v2/dashboards/{dashboard_id}", headers=self.headers)
+        if response.status_code == 200:
+            return response.json()
+        else:
+            self.error(f"Error retrieving dashboard {dashboard_id}: {response.text}")
+
+    async def _create_cell_views(self, dashboard_id, dashboard_tpl, cells):
+        payload_of = self._cell_view_payloads(dashboard_tpl)
+        tpl_cells = {x['name']: x for x in dashboard_tpl['cells']}
+
+        async def patch_cell_view(c):
+            url = f"{self.influxdb_base_url}/api/v2/dashboards/{dashboard_id}/cells/{c['id']}/view"
+            payload = payload_of(c)
+            response = await self.http.patch(url, headers=self.headers, json=payload)
+            if response.status_code != 200:
+                raise Exception(f"Error patching cell: {response.text}")
+            self.info(f"      Cell '{c['name']}' patched successfully!")
+            self.cell_hashes[c['name']] = self._cell_hashes_of(tpl_cells.get(c['name'], {}), payload)
+
+        # Patch cell views concurrently, and report failures per cell
+        failed = []
+        for c, _, e in await gather_parallel(patch_cell_view, cells, self.CELL_WORKERS):
+            if e is not None:
+                self.warning(f"Cell '{c['name']}' ({c['id']}) of dashboard {dashboard_id} failed: {e}")
+                failed.append(c)
+        if failed:
+            raise CellViewError(dashboard_id, failed)
+
+    async def delete_dashboard(self):
+        return await self._delete("dashboard", f"/api/v2/dashboards/{self.dashboard_id}", self.dashboard_name)
+
+    # 7. Grant all privileges to the user
+    async def grant_privileges(self, adopt=False):
+        # Authorizations are not unique: when resuming, keep the ones granted by the earlier attempt
+        if adopt and await self._get_user_authorizations(self.user_id):
+            self.info(f"User '{self.user_name}' already has authorizations: keeping them")
+            return
+        payload = self._authorization_payload(self.user_id, self.user_name, self.dashboard_id, self.bucket_id, self.org_id)
+        response = await self.http.post(f"{self.influxdb_base_url}/api/v2/authorizations",
+                                        headers=self.headers, json=payload)
+        if response.status_code == 201:
+            self.info(f"Granted all privileges to user '{self.user_name}'!")
+        else:
+            self.error(f"Error granting privileges: {response.text}")
+
+    async def revoke_privileges(self):
+        authorizations = await self._get_user_authorizations(self.user_id)
+        failed = [(auth, e) for auth, _, e in
+                  await gather_parallel(self._delete_authorization, authorizations, self.DELETE_WORKERS)
+                  if e is not None]
+        for auth, e in failed:
+            self.warning(f"Error deleting authorization {auth['id']} of user {auth.get('userID')}: {e}")
+        if failed:
+            self.error(f"Error deleting {len(failed)} of {len(authorizations)} authorization(s)")
+        self.info(f"Deleted user authorizations: '{self.user_name}'")
+        return "deleted" if authorizations else "missing"
+
+    async def _delete_authorization(self, auth):
+        url = f"{self.influxdb_base_url}/api/v2/authorizations/{auth['id']}"
+        response = await self.http.delete(url, headers=self.headers)
+        self.debug(lambda: f"Deleting user authorization {auth['id']}: RESPONSE: '{response}'")
+        if response.status_code != 204:
+            raise Exception(f"Error deleting authorization : {response.text}")
+
+    async def _get_user_authorizations(self, user_id):
+        # Get only this user's authorizations, filtered by InfluxDB (all pages)
+        authorizations = [x async for x in self._iter_listing(f"/api/v2/authorizations?userID={user_id}", 'authorizations')]
+        self.debug(lambda: f"User authorizations: {authorizations}")
+        return authorizations
+
+    # 8. Stack mode: create the app's stack, and apply the template of its bucket, variables and dashboard
+    async def create_stack(self, adopt=False):
+        # Stack names are not unique: when resuming, look for the stack of the earlier attempt first
+        stack_id = adopt and await self._find_stack(self.stack_name)
+        if not stack_id:
+            stack_id = (await self._post_create("stack", "/api/v2/stacks",
+                                                self._stack_payload(self.stack_name, self.org_id),
+                                                self.stack_name))['id']
+        self.stack_id = stack_id
+        return self.stack_id
+
+    async def _find_stack(self, stack_name):
+        return await self._find_id(self._stacks_path(stack_name), 'stacks', stack_name)
+
+    async def _find_app_stack(self, app_id):
+        try:
+            return await self._find_stack(self.name_of("stack", app_id))
+        except ListingError as e:
+            if e.status_code != 404:
+                raise
+            self.debug(lambda: f"No stacks API, no stack for '{app_id}'")
+            return None
+
+    async def apply_template(self):
+        url = f"{self.influxdb_base_url}/api/v2/templates/apply"
+        cells = self._rendered_cells()
+        response = await self.http.post(url, headers=self.headers, json=self._apply_payload(cells))
+        if response.status_code in (200, 201):
+            self._set_applied_ids(response.json(), cells)
+        else:
+            self.error(f"Error applying the template of stack '{self.stack_name}': {response.text}")
+
+    async def delete_stack(self):
+        return await self._delete("stack", f"/api/v2/stacks/{self.stack_id}?orgID={self.org_id}", self.stack_name)
+
+    # Run all the create steps (see InfluxdbHelper.create_all): independent steps run concurrently
+    # on the loop, each completed step is checkpointed, and the steps of an earlier attempt are skipped.
+    # The state store is written to inline: a checkpoint is one short SQLite transaction.
+    async def create_all(self, max_workers=None, store=None):
+        resumed = bool(self.completed_steps)
+        if resumed:
+            self.info(f"Resuming the creation of '{self.app_id}': skipping steps {', '.join(self.completed_steps)}")
+
+        def checkpoint(step_name):
+            self.completed_steps.append(step_name)
+            if store is not None:
+                self.saveToStore(store)
+
+        with PROVISIONING_IN_FLIGHT.labels(operation="create").track_inprogress():
+            try:
+                timings = await AsyncStepExecutor(max_workers, "create").run(self.create_steps(resumed),
+                                                                             completed=self.completed_steps,
+                                                                             on_step_done=checkpoint)
+            finally:
+                # Also checkpoint the progress of the failed steps (e.g. the cells left to patch)
+                if store is not None:
+                    self.saveToStore(store)
+        self.debug(lambda: f"create_all step timings: {timings}")
+        return timings
+
+    # Delete all resources (see InfluxdbHelper.delete_all). Returns the outcome per step
+    async def delete_all(self, max_workers=None):
+        steps = self.delete_steps()
+        executor = AsyncStepExecutor(max_workers, "delete")
+        with PROVISIONING_IN_FLIGHT.labels(operation="delete").track_inprogress():
+            await executor.run(steps, keep_going=True)
+        return self._teardown_outcome(steps, executor)
+
+    async def resource_catalog(self, resource_types=None):
+        catalog = ResourceCatalog(self.influxdb_base_url, self.headers, self.org_id, load=False)
+        return await catalog.aload(self.http, resource_types)
+
+    # Find all related info (id's, names) for an App.Id (see InfluxdbHelper.find_all)
+    async def find_all(self, app_id, catalog=None):
+        app_id = self._normalize(app_id)
+        await self.set_org()
+        if catalog is None:
+            with observe_step("find_all", "list_resources"):
+                catalog = await self.resource_catalog()
+        self._find_in_catalog(app_id, catalog)
+        self.stack_id = await self._find_app_stack(app_id)
+
+    # Adopt an existing resource with the same name, when its creation was refused as a duplicate
+    async def _adopt(self, what, url_path, json_section, name, response):
+        resource_id = await self._find_id(url_path, json_section, name)
+        if not resource_id:
+            self.error(f"Error creating {what}: {response.text}")
+        self.info(f"{what.capitalize()} '{name}' already exists: adopting {resource_id}")
+        return resource_id
+
+    # ID of the resource with exactly this name, or None, stopping at the first match
+    async def _find_id(self, url_path, json_section, name):
+        async for x in self._iter_listing(url_path, json_section):
+            if resource_name(x) == name:
+                return x['id']
+        return None
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+# Benchmark create_all, delete_all and find_all against an in-process fake InfluxDB v2 API.
+# Runs offline. From the monitoring-visualisation directory:
+#
+#   python -m benchmarks.bench_provisioning --concurrency 1,8,32 --catalog-sizes 0,2000 --output bench-results.json
+#   python -m benchmarks.bench_provisioning --compare bench-results.json     # compare a new run with a saved one
+#   python -m benchmarks.bench_provisioning --engine asyncio --concurrency 32,256   # AsyncInfluxdbHelper, on one event loop
+#   python -m benchmarks.bench_provisioning --mode stack     # Bucket, variables and dashboard applied as one template
+
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import platform
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+START_DIR = os.getcwd()
+sys.path.insert(0, BASE_DIR)
+os.chdir(BASE_DIR)  # Templates are loaded relative to the app directory
+
+from benchmarks.fake_influxdb import FakeInfluxdb, FakeInfluxdbProcess  # noqa: E402
+from influx_helper import InfluxdbHelper  # noqa: E402
+
+ADMIN_TOKEN = 'benchmark-token'
+ORG_NAME = 'my-org'
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    f = int(k)
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+
+def run_operation(url, operation, app_id):
+    """One operation, as process_message runs it."""
+    helper = InfluxdbHelper(url, ADMIN_TOKEN, ORG_NAME, app_id)
+    if operation == 'create':
+        helper.create_all()
+    elif operation == 'find_all':
+        helper.find_all(app_id)
+    elif operation == 'delete':
+        helper.find_all(app_id)
+        helper.delete_all()
+
+
+async def run_operation_async(url, operation, app_id):
+    """One operation, as process_message_async runs it."""
+    from async_influx import AsyncInfluxdbHelper
+    helper = AsyncInfluxdbHelper(url, ADMIN_TOKEN, ORG_NAME, app_id)
+    if operation == 'create':
+        await helper.create_all()
+    elif operation == 'find_all':
+        await helper.find_all(app_id)
+    elif operation == 'delete':
+        await helper.find_all(app_id)
+        await helper.delete_all()
+
+
+def run_threads(url, operation, app_ids, concurrency):
+    def timed(app_id):
+        start = time.perf_counter()
+        try:
+            run_operation(url, operation, app_id)
+            return time.perf_counter() - start, None
+        except Exception as e:
+            return time.perf_counter() - start, str(e)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(timed, app_ids))
+
+
+def run_asyncio(url, operation, app_ids, concurrency):
+    from async_influx import close_async_client
+
+    async def run_all():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def timed(app_id):
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    await run_operation_async(url, operation, app_id)
+                    return time.perf_counter() - start, None
+                except Exception as e:
+                    return time.perf_counter() - start, str(e)
+        try:
+            return await asyncio.gather(*(timed(app_id) for app_id in app_ids))
+        finally:
+            await close_async_client()
+
+    return asyncio.run(run_all())
+
+
+ENGINES = {'threads': run_threads, 'asyncio': run_asyncio}
+
+
+def measure(fake, url, operation, app_ids, concurrency, engine='threads'):
+    requests_before = fake.request_count()
+    start = time.perf_counter()
+    outcomes = ENGINES[engine](url, operation, app_ids, concurrency)
+    elapsed = time.perf_counter() - start
+    latencies = [secs for secs, error in outcomes if error is None]
+    errors = [error for _, error in outcomes if error is not None]
+    return {
+        'operation': operation,
+        'ops': len(app_ids),
+        'errors': len(errors),
+        'first_error': errors[0] if errors else None,
+        'seconds': round(elapsed, 6),
+        'throughput': round(len(app_ids) / elapsed, 3) if elapsed else None,
+        'p50': round(percentile(latencies, 50), 6) if latencies else None,
+        'p99': round(percentile(latencies, 99), 6) if latencies else None,
+        'requests_per_op': round((fake.request_count() - requests_before) / len(app_ids), 2),
+    }
+
+
+def run(args):
+    results = []
+    for catalog_size in args.catalog_sizes:
+        options = dict(org_name=ORG_NAME, latency=args.latency, error_rate=args.error_rate,
+                       error_status=args.error_status, retry_after=args.retry_after,
+                       catalog_size=catalog_size, seed=args.seed)
+        if args.in_process:
+            fake = FakeInfluxdb(**options)
+            url = fake.start()
+        else:
+            fake = FakeInfluxdbProcess(**options)
+            url = fake.url
+        try:
+            for concurrency in args.concurrency:
+                app_ids = [f'bench-c{catalog_size}-n{concurrency}-{i}' for i in range(args.apps)]
+                for operation in args.operations:
+                    result = measure(fake, url, operation, app_ids, concurrency, args.engine)
+                    result.update(catalog_size=catalog_size, concurrency=concurrency, engine=args.engine,
+                                  mode=args.mode)
+                    results.append(result)
+                    print(f"{operation:9s} catalog={catalog_size:<6d} concurrency={concurrency:<4d} "
+                          f"ops/s={result['throughput']:<9} p50={result['p50']}s p99={result['p99']}s "
+                          f"requests/op={result['requests_per_op']} errors={result['errors']}", file=sys.stderr)
+        finally:
+            fake.stop()
+    return results
+
+
+def compare(baseline, results):
+    """Print throughput and p99 changes against a baseline run."""
+    key = lambda r: (r['operation'], r['catalog_size'], r['concurrency'])
+    base = {key(r): r for r in baseline['results']}
+    for r in results:
+        b = base.get(key(r))
+        if not b or not b['throughput'] or not r['throughput'] or not b['p99'] or not r['p99']:
+            continue
+        print(f"{r['operation']:9s} catalog={r['catalog_size']:<6d} concurrency={r['concurrency']:<4d} "
+              f"throughput x{r['throughput'] / b['throughput']:.2f}  p99 x{r['p99'] / b['p99']:.2f}")
+
+
+def main(argv=None):
+    csv_ints = lambda s: [int(x) for x in s.split(',')]
+    parser = argparse.ArgumentParser(description="Provisioning benchmark against a fake InfluxDB v2 API")
+    parser.add_argument('--concurrency', type=csv_ints, default=[1, 8, 32], help="Comma-separated concurrency levels")
+    parser.add_argument('--catalog-sizes', type=csv_ints, default=[0, 1000], help="Comma-separated numbers of pre-existing apps")
+    parser.add_argument('--apps', type=int, default=64, help="Apps per run")
+    parser.add_argument('--operations', default='create,find_all,delete', help="Comma-separated, run in this order")
+    parser.add_argument('--latency', type=float, default=0.002, help="Fake server latency per request, in seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of failing write requests")
+    parser.add_argument('--error-status', type=int, default=500, help="Status of the failing write requests (e.g. 429)")
+    parser.add_argument('--retry-after', type=float, help="Retry-After header (seconds) sent with the failing write requests")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='threads', help="Provisioning engine (default: threads)")
+    parser.add_argument('--mode', choices=['rest', 'stack'], default='rest',
+                        help="Provisioning mode (default: rest, one call per resource)")
+    parser.add_argument('--in-process', action='store_true', help="Run the fake server in this process (default: a child process)")
+    parser.add_argument('--output', help="Save the results as JSON to this file")
+    parser.add_argument('--compare', help="Compare with the results saved in this file")
+    args = parser.parse_args(argv)
+    args.operations = args.operations.split(',')
+    output, baseline = [os.path.join(START_DIR, f) if f else None for f in (args.output, args.compare)]
+
+    logging.basicConfig(level=logging.CRITICAL)
+    InfluxdbHelper.PROVISIONING_MODE = args.mode
+    results = run(args)
+    report = {
+        'meta': {
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'args': {k: v for k, v in vars(args).items() if k not in ('output', 'compare')},
+        },
+        'results': results,
+    }
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if baseline:
+        with open(baseline) as f:
+            compare(json.load(f), results)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
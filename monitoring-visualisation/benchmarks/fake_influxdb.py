@@ -0,0 +1,269 @@
+import collections
+import itertools
+import json
+import multiprocessing
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, urlencode
+from urllib.request import urlopen
+
+ID_PATTERN = re.compile(r'/[0-9a-f]{16}(?=/|$)')
+
+
+class FakeInfluxdb:
+    """In-process stand-in for the InfluxDB v2 endpoints used by InfluxdbHelper: orgs, buckets, scrapers, users,
+    variables, dashboards (with cells and views), authorizations, stacks and templates/apply.
+
+    latency:      seconds added to every request
+    error_rate:   fraction of write requests (POST, PATCH, DELETE) failing with error_status
+    catalog_size: number of filler apps (with all their resources) created up front
+    """
+    PAGE_DEFAULT = 20
+    PAGE_MAX = 100
+    COLLECTIONS = {
+        'buckets': 'buckets',
+        'scrapers': 'configurations',
+        'users': 'users',
+        'variables': 'variables',
+        'dashboards': 'dashboards',
+        'authorizations': 'authorizations',
+        'stacks': 'stacks',
+    }
+    PAGINATED = ('buckets', 'users', 'dashboards')
+    UNIQUE_NAMES = ('buckets', 'users', 'variables', 'stacks')
+
+    def __init__(self, org_name='my-org', latency=0.0, error_rate=0.0, catalog_size=0, seed=0,
+                 error_status=500, retry_after=None):
+        self.org = {'id': '0000000000000001', 'name': org_name}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after      # Retry-After header (seconds) sent with injected errors
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(2)
+        self.data = {name: {} for name in self.COLLECTIONS}
+        self.request_counts = collections.Counter()     # (method, endpoint template) -> count
+        self.server = None
+        self.thread = None
+        self.populate(catalog_size)
+
+    def _new_id(self):
+        return f'{next(self.ids):016x}'
+
+    def populate(self, count):
+        for i in range(count):
+            app = f'filler_{i:06d}'
+            self._insert('buckets', {'name': f'neb_{app}_bucket', 'orgID': self.org['id']})
+            self._insert('scrapers', {'name': f'neb_{app}_scraper', 'orgID': self.org['id']})
+            user = self._insert('users', {'name': f'neb_{app}_user'})
+            self._insert('variables', {'name': f'neb_{app}_var_metrics_list', 'orgID': self.org['id']})
+            self._insert('variables', {'name': f'neb_{app}_var_fields_list', 'orgID': self.org['id']})
+            self._insert('dashboards', {'name': f'Nebulous Dashboard {app}', 'orgID': self.org['id'], 'cells': []})
+            self._insert('authorizations', {'userID': user['id'], 'orgID': self.org['id'], 'permissions': []})
+
+    def _insert(self, collection, obj):
+        obj = dict(obj, id=self._new_id())
+        self.data[collection][obj['id']] = obj
+        return obj
+
+    def request_count(self):
+        with self.lock:
+            return sum(self.request_counts.values())
+
+    # -------------------------------------------------------------------
+    def start(self, host='127.0.0.1', port=0):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _handle(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length)) if length else None
+                status, payload, headers = fake.handle(self.command, self.path, body)
+                data = b'' if payload is None else json.dumps(payload).encode()
+                self.send_response(status)
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PATCH = do_DELETE = _handle
+
+        class Server(ThreadingHTTPServer):
+            request_queue_size = 128    # Clients opening many connections at once (e.g. an async pool)
+
+            def handle_error(self, request, client_address):
+                # Clients closing a connection early (e.g. a listing read up to the first match) are expected
+                if not isinstance(sys.exc_info()[1], ConnectionError):
+                    super().handle_error(request, client_address)
+
+        self.server = Server((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return f'http://{host}:{self.server.server_address[1]}'
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    # -------------------------------------------------------------------
+    def handle(self, method, path, body):
+        url = urlsplit(path)
+        if url.path == '/_fake/stats':
+            return 200, {'requests': self.request_count()}, None
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        with self.lock:
+            self.request_counts[(method, ID_PATTERN.sub('/{id}', url.path))] += 1
+            inject_error = self.error_rate and method != 'GET' and self.random.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if inject_error:
+            headers = {'Retry-After': str(self.retry_after)} if self.retry_after is not None else None
+            return self.error_status, {'code': 'internal error', 'message': 'injected failure'}, headers
+        parts = url.path.strip('/').split('/')[2:]
+        with self.lock:
+            return self._route(method, parts, query, body, url.path)
+
+    def _route(self, method, parts, query, body, path):
+        if parts == ['orgs'] and method == 'GET':
+            return 200, {'orgs': [self.org]}, None
+        if not parts or parts[0] not in self.COLLECTIONS and parts[0] != 'templates':
+            return 404, {'code': 'not found', 'message': path}, None
+        collection = parts[0]
+        if collection == 'templates' and parts[1:] == ['apply'] and method == 'POST':
+            return self._apply_template(body)
+        if len(parts) == 1:
+            if method == 'GET':
+                return self._list(collection, query, path)
+            if method == 'POST':
+                return self._create(collection, body)
+        obj = self.data[collection].get(parts[1])
+        if obj is None:
+            return 404, {'code': 'not found', 'message': f'{collection} not found'}, None
+        if len(parts) == 2:
+            if method == 'GET':
+                return 200, obj, None
+            if method == 'DELETE':
+                del self.data[collection][obj['id']]
+                if collection == 'stacks':
+                    for kind, res_id in obj.get('resources', []):
+                        self.data[kind].pop(res_id, None)
+                return 204, None, None
+            if method == 'PATCH':
+                obj.update(body or {})
+                return 200, obj, None
+        if collection == 'users' and parts[2:] == ['password'] and method == 'POST':
+            return 204, None, None
+        if collection == 'dashboards' and parts[2] == 'cells':
+            if len(parts) == 3 and method == 'POST':
+                cell = dict(body, id=self._new_id())
+                obj['cells'].append(cell)
+                return 201, cell, None
+            cell = next((c for c in obj['cells'] if c['id'] == parts[3]), None)
+            if cell is None:
+                return 404, {'code': 'not found', 'message': 'cell not found'}, None
+            if parts[4:] == ['view'] and method == 'PATCH':
+                cell['view'] = dict(body, id=cell['id'])
+                return 200, cell['view'], None
+            if parts[4:] == ['view'] and method == 'GET':
+                return 200, cell.get('view', {}), None
+            if len(parts) == 4 and method == 'PATCH':
+                cell.update(body)
+                return 200, cell, None
+            if len(parts) == 4 and method == 'DELETE':
+                obj['cells'].remove(cell)
+                return 204, None, None
+        return 405, {'code': 'method not allowed', 'message': path}, None
+
+    def _list(self, collection, query, path):
+        items = list(self.data[collection].values())
+        for key in ('userID', 'orgID', 'name', 'id'):
+            if key in query:
+                items = [x for x in items if x.get(key) == query[key]]
+        result = {}
+        if collection in self.PAGINATED:
+            limit = min(int(query.get('limit', self.PAGE_DEFAULT)), self.PAGE_MAX)
+            offset = int(query.get('offset', 0))
+            page = items[offset:offset + limit]
+            result['links'] = {'self': path}
+            if len(page) == limit:
+                params = dict(query, offset=str(offset + limit), limit=str(limit))
+                result['links']['next'] = f'{path}?{urlencode(params)}'
+            items = page
+        result[self.COLLECTIONS[collection]] = items
+        return 200, result, None
+
+    def _create(self, collection, body):
+        if collection in self.UNIQUE_NAMES and body.get('name'):
+            if any(x.get('name') == body['name'] for x in self.data[collection].values()):
+                return 422, {'code': 'conflict', 'message': f'{collection} with name {body["name"]} already exists'}, None
+        obj = dict(body)
+        obj.pop('password', None)
+        if collection == 'dashboards':
+            obj['cells'] = [dict(c, id=self._new_id()) for c in body.get('cells', [])]
+        if collection == 'stacks':
+            obj['resources'] = []
+        obj = self._insert(collection, obj)
+        return 201, obj, None
+
+    def _apply_template(self, body):
+        stack = self.data['stacks'].get(body.get('stackID'))
+        if stack is None:
+            return 422, {'code': 'invalid', 'message': 'stack not found'}, None
+        summary = {'buckets': [], 'variables': [], 'dashboards': []}
+        # Applying again to the same stack updates its resources, instead of creating them again
+        applied = {(c, self.data[c][i]['name']): i for c, i in stack['resources'] if i in self.data[c]}
+        for entry in body['template']['contents']:
+            kind, spec = entry['kind'], entry['spec']
+            collection = {'Bucket': 'buckets', 'Variable': 'variables', 'Dashboard': 'dashboards'}[kind]
+            obj = {'name': spec['name'], 'orgID': body['orgID']}
+            if kind == 'Dashboard':
+                obj['cells'] = [{'id': self._new_id(), 'name': c.get('name'), 'view': c}
+                                for c in spec.get('charts', [])]
+            if (collection, obj['name']) in applied:
+                obj = self.data[collection][applied[collection, obj['name']]]
+            else:
+                obj = self._insert(collection, obj)
+                stack['resources'].append((collection, obj['id']))
+            summary[collection].append({'id': obj['id'], 'name': obj['name']})
+        return 201, {'stackID': stack['id'], 'summary': summary}, None
+
+
+def _serve(conn, kwargs):
+    fake = FakeInfluxdb(**kwargs)
+    conn.send(fake.start())
+    conn.recv()     # Block until the parent asks to stop
+    fake.stop()
+
+
+class FakeInfluxdbProcess:
+    """Runs a FakeInfluxdb in a child process, so that it does not compete with the client for the GIL."""
+
+    def __init__(self, **kwargs):
+        ctx = multiprocessing.get_context('spawn')
+        self._conn, child_conn = ctx.Pipe()
+        self._process = ctx.Process(target=_serve, args=(child_conn, kwargs), daemon=True)
+        self._process.start()
+        self.url = self._conn.recv()
+
+    def request_count(self):
+        with urlopen(f'{self.url}/_fake/stats') as response:
+            return json.loads(response.read())['requests']
+
+    def stop(self):
+        self._conn.send('stop')
+        self._process.join(10)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from influx_helper import InfluxdbHelper
+from state_store import StateStore
+from step_executor import run_parallel
+
+logger = logging.getLogger(__name__)
+
+OPERATIONS = ('create', 'delete', 'find_all')
+
+
+class BulkProvisioner:
+    """Run create_all, delete_all or find_all for many apps, with bounded concurrency.
+    The jobs of one app (by normalized App.Id) run one after the other, in file order, as the subscriber
+    processes the messages of an app; the jobs of different apps run concurrently.
+    Resource listings for delete / find_all are fetched once and shared by the whole batch, and the
+    authorizations of the users of the apps to delete are revoked in one batch, before the other deletes.
+    Apps are recorded in the state store as for the messages: creates are checkpointed (and resumed),
+    and the state of an app is removed once it is deleted."""
+
+    def __init__(self, influxdb_base_url, admin_token, org_name, store, concurrency=8):
+        self.influxdb_base_url = influxdb_base_url
+        self.admin_token = admin_token
+        self.org_name = org_name
+        self.store = store
+        self.concurrency = concurrency
+        self._catalog = None
+        self._catalog_lock = threading.Lock()
+        self._prepared = {}     # Normalized App.Id -> (helper with the app's resources, status of its revoke_privileges)
+
+    def _helper(self, app_id):
+        return InfluxdbHelper(self.influxdb_base_url, self.admin_token, self.org_name, app_id)
+
+    def catalog(self, helper):
+        """The resource catalog shared by the batch, listed on first use."""
+        with self._catalog_lock:
+            if self._catalog is None:
+                helper.set_org()
+                start = time.perf_counter()
+                self._catalog = helper.resource_catalog()
+                logger.info(f"Listed InfluxDB resources in {time.perf_counter() - start:.3f}s")
+            return self._catalog
+
+    def prepare_deletes(self, app_ids):
+        """Find the resources of the apps to delete, and revoke the authorizations of all their users in one
+        batch. Apps whose resources are not found, or all of them if the batch fails, are left to run_one."""
+        def find(app_id):
+            helper = self._helper(app_id)
+            helper.find_all(app_id, self.catalog(helper))
+            return helper
+
+        helpers = {app_id: helper for app_id, helper, e in run_parallel(find, app_ids, self.concurrency) if e is None}
+        if not helpers:
+            return
+        start = time.perf_counter()
+        try:
+            authorizations = next(iter(helpers.values())).revoke_users_privileges([h.user_id for h in helpers.values()])
+        except Exception as e:
+            logger.warning(f"Could not revoke the authorizations of {len(helpers)} user(s) in one batch: {e}")
+            return
+        revoked_users = {auth.get('userID') for auth in authorizations}
+        self._prepared = {helper.app_id: (helper, 'deleted' if helper.user_id in revoked_users else 'missing')
+                          for helper in helpers.values()}
+        logger.info(f"Revoked {len(authorizations)} authorization(s) of {len(helpers)} user(s) "
+                    f"in {time.perf_counter() - start:.3f}s")
+
+    def run_app(self, jobs):
+        """Run the jobs of one app, in order. Returns their results.
+        The resources of an app created by an earlier job are not in the catalog (listed once): the jobs after
+        it use the IDs of the create instead."""
+        results = []
+        created = None
+        for app_id, operation in jobs:
+            result, helper = self.run_one(app_id, operation, created)
+            results.append(result)
+            if operation == 'create':
+                created = helper if result['status'] == 'ok' else None
+            elif operation == 'delete':
+                created = None
+        return results
+
+    def run_one(self, app_id, operation, created=None):
+        """Run one job. Returns its result, and the helper of the app."""
+        result = {'app-id': app_id, 'operation': operation}
+        start = time.perf_counter()
+        helper = created if created is not None and operation != 'create' else self._helper(app_id)
+        try:
+            if operation == 'create':
+                # Resume from the checkpoint of an earlier (failed) create, if any
+                helper.loadFromStore(self.store, app_id)
+                result['steps'] = helper.create_all(store=self.store)
+            elif operation == 'delete':
+                helper, revoked = self._prepared.pop(helper.app_id, (helper, None))
+                if revoked is None and created is None:
+                    helper.find_all(app_id, self.catalog(helper))
+                result['resources'] = helper.delete_all(revoked=revoked)
+                failed = helper.failed_steps(result['resources'])
+                if failed:
+                    helper.forget_undone_steps(self.store, result['resources'])
+                    raise Exception(f"Could not delete: {', '.join(failed)}")
+                self.store.delete(helper.app_id)
+            elif operation == 'find_all':
+                if created is None:
+                    helper.find_all(app_id, self.catalog(helper))
+                result['resources'] = {id_attr: getattr(helper, id_attr, None)
+                                       for id_attr, _, _, _ in helper.resource_names(helper.app_id)}
+            else:
+                raise ValueError(f"Unknown operation {operation}")
+            result['status'] = 'ok'
+        except Exception as e:
+            result['status'] = 'failed'
+            result['error'] = str(e)
+        result['seconds'] = round(time.perf_counter() - start, 6)
+        return result, helper
+
+    def run(self, jobs, output):
+        """Run (app_id, operation) jobs, writing one JSON result line per job as it completes.
+        Returns the number of failed jobs."""
+        failed = 0
+        done = 0
+        start = time.perf_counter()
+        apps = {}   # Normalized App.Id -> the app's jobs, in file order
+        for app_id, operation in jobs:
+            apps.setdefault(InfluxdbHelper.normalize_app_id(app_id), []).append((app_id, operation))
+        # Only the apps whose first job is a delete: the other deletes follow a job of the batch
+        self.prepare_deletes([app_jobs[0][0] for app_jobs in apps.values() if app_jobs[0][1] == 'delete'])
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="bulk") as pool:
+            futures = [pool.submit(self.run_app, app_jobs) for app_jobs in apps.values()]
+            for future in as_completed(futures):
+                for result in future.result():
+                    output.write(json.dumps(result) + '\n')
+                    output.flush()
+                    done += 1
+                    if result['status'] != 'ok':
+                        failed += 1
+                        logger.warning(f"{result['operation']} {result['app-id']} failed: {result['error']}")
+        elapsed = time.perf_counter() - start
+        logger.info(f"Processed {done} app(s) in {elapsed:.3f}s ({done / elapsed if elapsed else 0:.1f}/s), {failed} failed")
+        return failed
+
+
+def read_jobs(lines, default_operation):
+    """Parse job lines: 'APP_ID', 'OPERATION APP_ID', or a JSON message like {"app-id": ..., "operation": ...}.
+    Blank lines and lines starting with '#' are skipped."""
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('{'):
+            d = json.loads(line)
+            app_id, operation = d.get('app-id', ''), d.get('operation') or default_operation
+        else:
+            parts = line.split()
+            operation, app_id = (parts[0], parts[1]) if len(parts) > 1 else (default_operation, parts[0])
+        if operation not in OPERATIONS:
+            raise ValueError(f"Unknown operation '{operation}' in line: {line}")
+        yield app_id, operation
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk provisioning / teardown of app resources in InfluxDB")
+    parser.add_argument('jobs', help="File with one app per line ('APP_ID', 'OPERATION APP_ID' or a JSON message), or - for stdin")
+    parser.add_argument('--operation', default='create', choices=OPERATIONS, help="Operation for lines without one (default: create)")
+    parser.add_argument('--concurrency', type=int, default=int(os.getenv('BULK_CONCURRENCY', '8')), help="Apps processed at the same time (default: 8)")
+    parser.add_argument('--output', default='-', help="File for the JSON result lines, or - for stdout (default)")
+    parser.add_argument('--db', default=None, help="State database file (default: STATE_DB_FILE or app-states/state.db)")
+    parser.add_argument('--log-level', default='INFO')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level.upper(), stream=sys.stderr,
+                        format="%(asctime)s - %(levelname)s - %(message)s")
+
+    input_file = sys.stdin if args.jobs == '-' else open(args.jobs, 'r')
+    with input_file:
+        jobs = list(read_jobs(input_file, args.operation))
+
+    store = StateStore(args.db)
+    provisioner = BulkProvisioner(os.environ.get('INFLUXDB_URL'),
+                                  os.environ.get('INFLUXDB_ADMIN_TOKEN'),
+                                  os.environ.get('INFLUXDB_ORG_NAME'),
+                                  store, args.concurrency)
+    output = sys.stdout if args.output == '-' else open(args.output, 'w')
+    try:
+        failed = provisioner.run(jobs, output)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        store.close()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,61 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+class Coalescer:
+    """Hold items for a short window per key, then hand each key's batch to flush(key, items) at once.
+    The window starts with the first item of a key, so an item is delayed by at most the window."""
+
+    def __init__(self, window, flush):
+        self.window = window
+        self.flush = flush
+        self._pending = {}              # key -> list of items
+        self._due = []                  # Heap of (due time, sequence, key)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="coalescer", daemon=True)
+        self._thread.start()
+
+    def offer(self, key, item):
+        with self._cond:
+            items = self._pending.get(key)
+            if items is not None:
+                items.append(item)
+                return
+            self._pending[key] = [item]
+            heapq.heappush(self._due, (time.monotonic() + self.window, next(self._seq), key))
+            self._cond.notify()
+
+    def pending(self):
+        with self._cond:
+            return sum(len(items) for items in self._pending.values())
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped and (not self._due or self._due[0][0] > time.monotonic()):
+                    self._cond.wait(self._due[0][0] - time.monotonic() if self._due else None)
+                if self._stopped and not self._due:
+                    return
+                _, _, key = heapq.heappop(self._due)
+                items = self._pending.pop(key)
+            try:
+                self.flush(key, items)
+            except Exception as e:
+                logger.error(f"Error flushing coalesced items of '{key}': {e}", exc_info=True)
+
+    def stop(self):
+        """Flush all pending items immediately, and stop."""
+        with self._cond:
+            self._stopped = True
+            self._due = [(0, seq, key) for _, seq, key in self._due]
+            heapq.heapify(self._due)
+            self._cond.notify()
+        self._thread.join()
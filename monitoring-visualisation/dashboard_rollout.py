@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from influx_helper import InfluxdbHelper
+from state_store import StateStore
+
+logger = logging.getLogger(__name__)
+
+# Steps after which the dashboard of an app is complete (REST and stack provisioning modes)
+DASHBOARD_STEPS = ('create_cell_views', 'apply_template')
+
+
+class DashboardRollout:
+    """Roll out changes of the dashboard and chart templates to the dashboards of the apps in the state store.
+
+    The dashboard of every app is rendered again, and the content hashes of its cells (position and size,
+    view) are compared with the hashes recorded when they were deployed: only the cells which differ are
+    written, concurrently, and an app without changes costs no request. The new hashes are recorded in the
+    state store as soon as the cells of an app are written, so a rollout which is interrupted (or which
+    failed for some apps) resumes where it stopped when it is run again."""
+
+    def __init__(self, influxdb_base_url, admin_token, org_name, store, concurrency=8,
+                 dry_run=False, assume_current=False):
+        self.influxdb_base_url = influxdb_base_url
+        self.admin_token = admin_token
+        self.org_name = org_name
+        self.store = store
+        self.concurrency = concurrency
+        self.dry_run = dry_run                  # Only report the changes
+        self.assume_current = assume_current    # Record the hashes of the current templates, without writing
+
+    def _helper(self, app_id):
+        return InfluxdbHelper(self.influxdb_base_url, self.admin_token, self.org_name, app_id)
+
+    def roll_out_one(self, app_id, state):
+        result = {'app-id': app_id}
+        start = time.perf_counter()
+        helper = self._helper(app_id)
+        helper.loadState(state)
+        deployed = dict(helper.cell_hashes or {})
+        try:
+            if not getattr(helper, 'dashboard_id', None) or not set(DASHBOARD_STEPS) & set(helper.completed_steps):
+                # Not created (completely) yet: a resumed create renders the current templates
+                result['status'] = 'skipped'
+            elif self.dry_run or self.assume_current:
+                result['changes'] = helper.plan_dashboard_update()
+                result['status'] = 'unchanged' if not result['changes'] else 'planned' if self.dry_run else 'recorded'
+                if self.assume_current:
+                    helper.cell_hashes = helper.rendered_cell_hashes()
+            else:
+                result['changes'] = helper.update_dashboard()
+                result['status'] = 'updated' if result['changes'] else 'unchanged'
+        except Exception as e:
+            result['status'] = 'failed'
+            result['error'] = str(e)
+        finally:
+            # Also after a partial failure: the cells written are not written again by the next run
+            if helper.cell_hashes != deployed and not self.store.update(app_id, {'cell_hashes': helper.cell_hashes}):
+                logger.info(f"Rollout: app '{app_id}' was deleted meanwhile")
+        result['seconds'] = round(time.perf_counter() - start, 6)
+        return result
+
+    def run(self, output, app_ids=None):
+        """Roll out to the given apps, or to all the apps in the store (in App.Id order), writing one JSON
+        result line per app as it completes. Returns the counts of the results by status."""
+        if app_ids is not None:
+            apps = ((app_id, self.store.load(app_id)) for app_id in map(InfluxdbHelper.normalize_app_id, app_ids))
+        else:
+            apps = ((app_id, state) for app_id, _, state in self.store.iter_states())
+        counts = Counter()
+        start = time.perf_counter()
+
+        def report(result):
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+            counts[result['status']] += 1
+            if result['status'] == 'failed':
+                logger.warning(f"Rollout: app '{result['app-id']}' failed: {result['error']}")
+
+        # Apps are read from the store as they are submitted, so that only a window of them is in memory
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="rollout") as pool:
+            pending = set()
+            for app_id, state in apps:
+                if state is None:
+                    report({'app-id': app_id, 'status': 'failed', 'error': 'no state stored'})
+                    continue
+                if len(pending) >= 2 * self.concurrency:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        report(future.result())
+                pending.add(pool.submit(self.roll_out_one, app_id, state))
+            for future in wait(pending).done:
+                report(future.result())
+        elapsed = time.perf_counter() - start
+        logger.info(f"Rollout done in {elapsed:.3f}s: "
+                    + ", ".join(f"{status}={count}" for status, count in sorted(counts.items())))
+        return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Roll out the dashboard and chart templates to the dashboards of the existing apps")
+    parser.add_argument('--db', default=None, help="State database file (default: STATE_DB_FILE or app-states/state.db)")
+    parser.add_argument('--app', action='append', dest='apps', metavar='APP_ID', help="Only this app (repeatable), e.g. for a canary")
+    parser.add_argument('--dry-run', action='store_true', help="Only report the cells which would be written")
+    parser.add_argument('--assume-current', action='store_true',
+                        help="Record the current templates as deployed, without writing (e.g. for apps created before content hashes were recorded)")
+    parser.add_argument('--concurrency', type=int, default=int(os.getenv('ROLLOUT_CONCURRENCY', '8')), help="Apps updated at the same time (default: 8)")
+    parser.add_argument('--output', default='-', help="File for the JSON result lines, or - for stdout (default)")
+    parser.add_argument('--log-level', default='INFO')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level.upper(), stream=sys.stderr,
+                        format="%(asctime)s - %(levelname)s - %(message)s")
+
+    store = StateStore(args.db)
+    rollout = DashboardRollout(os.environ.get('INFLUXDB_URL'),
+                               os.environ.get('INFLUXDB_ADMIN_TOKEN'),
+                               os.environ.get('INFLUXDB_ORG_NAME'),
+                               store, args.concurrency, dry_run=args.dry_run, assume_current=args.assume_current)
+    output = sys.stdout if args.output == '-' else open(args.output, 'w')
+    try:
+        counts = rollout.run(output, args.apps)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        store.close()
+    return 1 if counts['failed'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
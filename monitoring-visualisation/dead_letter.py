@@ -0,0 +1,88 @@
+import collections
+import json
+import logging
+import os
+import threading
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+class DeadLetterBuffer:
+    """Thread-safe buffer of dead letters waiting to be sent. When more than max_buffered letters are
+    waiting (e.g. while the broker is down), the extra ones go to a local spill file of bounded size,
+    and are read back once they can be sent."""
+
+    def __init__(self, max_buffered=1000, spill_file='app-states/dlq-spill.jsonl', spill_max_bytes=10 * 1024 * 1024):
+        self.max_buffered = max_buffered
+        self.spill_file = spill_file
+        self.spill_max_bytes = spill_max_bytes
+        self._letters = collections.deque()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._letters)
+
+    def add(self, letter):
+        with self._lock:
+            if len(self._letters) < self.max_buffered:
+                self._letters.append(letter)
+                return
+        self.spill([letter])
+
+    def take(self, count):
+        """Remove and return up to count letters, oldest first."""
+        with self._lock:
+            return [self._letters.popleft() for _ in range(min(count, len(self._letters)))]
+
+    def put_back(self, letters):
+        """Return letters that could not be sent to the front of the buffer."""
+        with self._lock:
+            self._letters.extendleft(reversed(letters))
+
+    def spill(self, letters=None):
+        """Append letters (by default, all buffered letters) to the spill file, while it is under its size limit."""
+        if letters is None:
+            letters = self.take(len(self))
+        if not letters or not self.spill_file:
+            return
+        with self._lock:
+            os.makedirs(os.path.dirname(self.spill_file) or '.', exist_ok=True)
+            size = os.path.getsize(self.spill_file) if os.path.exists(self.spill_file) else 0
+            written = 0
+            with open(self.spill_file, 'a') as f:
+                for letter in letters:
+                    line = json.dumps(letter, default=str) + '\n'
+                    if size + len(line) > self.spill_max_bytes:
+                        break
+                    f.write(line)
+                    size += len(line)
+                    written += 1
+        if written < len(letters):
+            logger.error(f"DLQ spill file '{self.spill_file}' is full: dropped {len(letters) - written} dead letter(s)")
+        if written:
+            logger.warning(f"Spilled {written} dead letter(s) to '{self.spill_file}'")
+
+    def restore(self):
+        """Move spilled letters back into the buffer, as far as it has room. Returns the number restored."""
+        with self._lock:
+            if not self.spill_file or not os.path.exists(self.spill_file):
+                return 0
+            with open(self.spill_file, 'r') as f:
+                letters = [json.loads(line) for line in f if line.strip()]
+            room = max(self.max_buffered - len(self._letters), 0)
+            self._letters.extend(letters[:room])
+            remaining = letters[room:]
+            # Rewrite the spill file with what did not fit, atomically
+            tmp_file = f"{self.spill_file}.tmp"
+            with open(tmp_file, 'w') as f:
+                for letter in remaining:
+                    f.write(json.dumps(letter, default=str) + '\n')
+            os.replace(tmp_file, self.spill_file)
+            if not remaining:
+                os.remove(self.spill_file)
+        restored = min(room, len(letters))
+        if restored:
+            logger.info(f"Restored {restored} dead letter(s) from '{self.spill_file}'")
+        return restored
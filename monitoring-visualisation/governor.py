@@ -0,0 +1,194 @@
+import asyncio
+import collections
+import email.utils
+import logging
+import os
+import threading
+import time
+from metrics import INFLUXDB_CONCURRENCY_LIMIT, INFLUXDB_GOVERNOR_WAIT_SECONDS, INFLUXDB_THROTTLED_RESPONSES
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+THROTTLED = (429, 503)      # InfluxDB is asking clients to slow down (and may send Retry-After)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'PATCH', 'DELETE')
+
+
+def is_retryable(method, status):
+    """Whether a throttled call may be sent again. A 429 was refused before being processed; after a 503
+    (e.g. from a proxy) a POST may have been processed all the same, and sending it again would create a
+    duplicate (scrapers, dashboards, cells and authorizations have no unique names)."""
+    return status == 429 or (status in THROTTLED and method.upper() in IDEMPOTENT_METHODS)
+
+
+def retry_after_seconds(value, now=None):
+    """Seconds to wait from a Retry-After header value (delay in seconds, or an HTTP date), or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - (now if now is not None else time.time()))
+
+
+class ConcurrencyGovernor:
+    """Process-wide limit on the InfluxDB REST calls in progress, shared by the blocking and the async clients.
+
+    The limit adapts (additive increase, multiplicative decrease): it grows by about one per 'limit' successful
+    calls while it is fully used and latency is close to its unloaded value, and shrinks when InfluxDB slows
+    down or fails:
+    - throttled responses (429, 503) halve it, and pause all new calls for Retry-After (or a backoff);
+    - other server errors and connection errors cut it by a quarter;
+    - a recent latency of an endpoint above 'tolerance' times its unloaded latency cuts it by a tenth.
+    Only one cut is made per round of calls: calls started before the last cut do not cut it again."""
+
+    def __init__(self, initial=None, minimum=None, maximum=None, tolerance=None, max_pause=None, latency_window=None):
+        self.minimum = minimum or int(os.getenv("INFLUXDB_CONCURRENCY_MIN", "1"))
+        self.maximum = maximum or int(os.getenv("INFLUXDB_CONCURRENCY_MAX", os.getenv("INFLUXDB_POOL_MAXSIZE", "32")))
+        self.limit = float(initial or int(os.getenv("INFLUXDB_CONCURRENCY_INITIAL", "8")))
+        self.limit = min(max(self.limit, self.minimum), self.maximum)
+        self.tolerance = tolerance or float(os.getenv("INFLUXDB_LATENCY_TOLERANCE", "2"))
+        self.max_pause = max_pause or float(os.getenv("INFLUXDB_RETRY_AFTER_MAX", "60"))
+        # Seconds over which the unloaded latency follows a lasting change (e.g. a bigger instance, more data)
+        self.latency_window = latency_window or float(os.getenv("INFLUXDB_LATENCY_WINDOW", "600"))
+        self.in_flight = 0
+        self.paused_until = 0.0         # No call starts before this time (monotonic), after a throttled response
+        self._backoff = 0.0             # Pause after a throttled response without Retry-After; doubles while throttled
+        self._started = 0               # Calls started so far: the 'ticket' of a call
+        self._cut_at = 0                # Calls started before this ticket do not cut the limit again
+        self._latencies = {}            # Endpoint -> [recent average latency, unloaded latency, samples, updated at]
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._async_waiters = collections.deque()   # (loop, future) of coroutines waiting for a slot
+        INFLUXDB_CONCURRENCY_LIMIT.set(int(self.limit))
+
+    # ------------------------------------------------------------------
+    # Slots
+
+    def _try_start(self, now):
+        # Called with the lock held. Returns the ticket of the call, or None if it has to wait
+        if self.in_flight >= int(self.limit) or now < self.paused_until:
+            return None
+        self.in_flight += 1
+        self._started += 1
+        return self._started
+
+    def _wait_time(self, now):
+        return self.paused_until - now if now < self.paused_until else None
+
+    def acquire(self):
+        """Wait for a slot (blocking). Returns a ticket, to pass to release()."""
+        start = time.monotonic()
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                ticket = self._try_start(now)
+                if ticket is not None:
+                    break
+                self._condition.wait(self._wait_time(now))
+        INFLUXDB_GOVERNOR_WAIT_SECONDS.observe(time.monotonic() - start)
+        return ticket
+
+    async def acquire_async(self):
+        """Wait for a slot, on an event loop. Returns a ticket, to pass to release()."""
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                ticket = self._try_start(now)
+                if ticket is not None:
+                    break
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+                timeout = self._wait_time(now)
+            try:
+                await asyncio.wait_for(waiter, timeout)
+            except asyncio.TimeoutError:
+                pass
+        INFLUXDB_GOVERNOR_WAIT_SECONDS.observe(time.monotonic() - start)
+        return ticket
+
+    def _wake(self):
+        # Called with the lock held: wake up as many waiters as there are free slots
+        free = int(self.limit) - self.in_flight
+        if free <= 0:
+            return
+        self._condition.notify(free)
+        while free and self._async_waiters:
+            loop, waiter = self._async_waiters.popleft()
+            if not waiter.done():   # Not timed out (e.g. at the end of a pause)
+                loop.call_soon_threadsafe(_set_result, waiter)
+                free -= 1
+
+    def release(self, ticket, endpoint, latency, status=None, retry_after=None, adapt=True):
+        """Give back the slot of a call, and adapt the limit to its outcome (unless adapt is false, e.g. for a
+        cancelled call). status is the HTTP status code, or None if the call failed without a response."""
+        with self._lock:
+            self.in_flight -= 1
+            if not adapt:
+                pass
+            elif status in THROTTLED:
+                INFLUXDB_THROTTLED_RESPONSES.labels(status=str(status)).inc()
+                self._pause(retry_after_seconds(retry_after))
+                self._cut(ticket, 0.5, f"InfluxDB responded {status}")
+            elif status is None or status >= 500:
+                self._cut(ticket, 0.75, f"InfluxDB call failed ({status or 'no response'})")
+            else:
+                self._backoff = 0.0
+                ratio = self._observe_latency(endpoint, latency)
+                if ratio > self.tolerance:
+                    self._cut(ticket, 0.9, f"InfluxDB latency of {endpoint} is {ratio:.1f}x its unloaded value",
+                              logging.INFO)
+                elif ratio > (1 + self.tolerance) / 2:
+                    pass    # Slower than unloaded: hold the limit
+                elif self.in_flight + 1 >= int(self.limit) and self.limit < self.maximum:
+                    # The limit was fully used, and InfluxDB kept up: allow one more call per round
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                    INFLUXDB_CONCURRENCY_LIMIT.set(int(self.limit))
+            self._wake()
+
+    def _observe_latency(self, endpoint, latency):
+        # Returns the recent latency of the endpoint relative to its unloaded latency (1.0 until known).
+        # The unloaded latency is the lowest recent average seen, drifting up slowly to follow a lasting change
+        now = time.monotonic()
+        stats = self._latencies.get(endpoint)
+        if stats is None:
+            stats = self._latencies[endpoint] = [latency, latency, 0, now]
+        stats[0] += (latency - stats[0]) * 0.2
+        stats[1] = min(stats[0], stats[1] + (stats[0] - stats[1]) * min(1.0, (now - stats[3]) / self.latency_window))
+        stats[2] += 1
+        stats[3] = now
+        return stats[0] / stats[1] if stats[2] >= 20 and stats[1] > 0 else 1.0
+
+    def _cut(self, ticket, factor, reason, level=logging.WARNING):
+        if ticket <= self._cut_at:
+            return      # Started before the last cut: already accounted for
+        self._cut_at = self._started
+        old = int(self.limit)
+        self.limit = max(self.minimum, self.limit * factor)
+        INFLUXDB_CONCURRENCY_LIMIT.set(int(self.limit))
+        logger.log(level, f"{reason}: concurrency limit {old} -> {int(self.limit)}")
+
+    def _pause(self, seconds):
+        if seconds is None:
+            self._backoff = min(self.max_pause, max(0.5, self._backoff * 2))
+            seconds = self._backoff
+        until = time.monotonic() + min(seconds, self.max_pause)
+        if until > self.paused_until:
+            self.paused_until = until
+            logger.warning(f"InfluxDB is throttling: pausing new calls for {min(seconds, self.max_pause):.1f}s")
+
+
+def _set_result(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+# Shared governor of all InfluxDB REST calls
+GOVERNOR = ConcurrencyGovernor()
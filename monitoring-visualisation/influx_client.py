@@ -0,0 +1,112 @@
+import logging
+import os
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from governor import GOVERNOR, is_retryable
+import tracing
+from metrics import INFLUXDB_REQUEST_SECONDS, INFLUXDB_REQUESTS_IN_FLIGHT, INFLUXDB_RETRIES, endpoint_of
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+class InfluxdbClient:
+    """Process-wide HTTP client for the InfluxDB v2 API, backed by a pooled keep-alive session.
+    Every call takes a slot of the concurrency governor, and throttled calls are retried (429, and 503 for
+    idempotent methods only: see is_retryable)."""
+
+    def __init__(self, pool_connections=None, pool_maxsize=None, connect_timeout=None, read_timeout=None,
+                 retries=None, governor=None):
+        self.pool_connections = pool_connections if pool_connections is not None \
+            else int(os.getenv("INFLUXDB_POOL_CONNECTIONS", "4"))
+        self.pool_maxsize = pool_maxsize if pool_maxsize is not None else int(os.getenv("INFLUXDB_POOL_MAXSIZE", "32"))
+        self.connect_timeout = connect_timeout if connect_timeout is not None \
+            else float(os.getenv("INFLUXDB_CONNECT_TIMEOUT", "5"))
+        self.read_timeout = read_timeout if read_timeout is not None else float(os.getenv("INFLUXDB_READ_TIMEOUT", "30"))
+        self.timeout = (self.connect_timeout, self.read_timeout)
+        self.retries = retries if retries is not None else int(os.getenv("INFLUXDB_RETRIES", "3"))
+        self.governor = governor or GOVERNOR
+
+        # Keep-alive session, with a connection pool sized for concurrent provisioning
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_connections,
+                              pool_maxsize=self.pool_maxsize,
+                              pool_block=True)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        logger.debug(f"InfluxDB client pool: connections={self.pool_connections}, maxsize={self.pool_maxsize}, "
+                     f"timeout={self.timeout}")
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        endpoint = endpoint_of(url)
+        with tracing.span(f"{method} {endpoint}"):
+            for attempt in range(self.retries + 1):
+                response = self._request(method, url, endpoint, **kwargs)
+                if not is_retryable(method, response.status_code) or attempt == self.retries:
+                    tracing.annotate(status=response.status_code, attempts=attempt + 1)
+                    return response
+                # The governor holds back new calls for Retry-After (or a backoff): the retry waits for it
+                INFLUXDB_RETRIES.inc()
+                logger.warning(f"{method} {endpoint}: {response.status_code}, retrying ({attempt + 1}/{self.retries})")
+                response.close()
+
+    def _request(self, method, url, endpoint, **kwargs):
+        response = None
+        queued_at = time.perf_counter()
+        ticket = self.governor.acquire()
+        start = time.perf_counter()
+        tracing.annotate(governor_wait_ms=round((start - queued_at) * 1000, 3))
+        INFLUXDB_REQUESTS_IN_FLIGHT.inc()
+        try:
+            response = self.session.request(method, url, **kwargs)
+            return response
+        finally:
+            elapsed = time.perf_counter() - start
+            status = response.status_code if response is not None else None
+            INFLUXDB_REQUESTS_IN_FLIGHT.dec()
+            INFLUXDB_REQUEST_SECONDS.labels(method=method, endpoint=endpoint, status=str(status or "error")) \
+                .observe(elapsed)
+            self.governor.release(ticket, endpoint, elapsed, status,
+                                  response.headers.get("Retry-After") if response is not None else None)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request("PATCH", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+# Shared client instance (created lazily, on first use)
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Return the process-wide InfluxDB client, creating it on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = InfluxdbClient()
+    return _client
+
+
+def set_client(client):
+    """Replace the process-wide InfluxDB client (e.g. with a differently sized pool)."""
+    global _client
+    with _client_lock:
+        old, _client = _client, client
+    if old is not None and old is not client:
+        old.close()
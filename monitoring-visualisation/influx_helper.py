@@ -1,16 +1,23 @@
 #!/usr/bin/env python3
 
+import copy
+import hashlib
 import logging
 import os, sys, datetime, pprint
 import re
-from contextlib import suppress
 # import time, uuid
 import secrets
-import requests
 import yaml, json
 import textwrap
 import pickle
-from copy import deepcopy
+from urllib.parse import quote
+import stack_manifest
+from influx_client import get_client
+from metrics import PROVISIONING_IN_FLIGHT, observe_step
+from org_cache import ORG_CACHE
+from resource_catalog import ListingError, ResourceCatalog, iter_listing, resource_name
+from step_executor import Step, StepExecutor, run_parallel
+from template_engine import TEMPLATES
 
 # Configure logging
 # logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -18,11 +25,39 @@ logger = logging.getLogger(__name__)
 # logger.setLevel(logging.INFO)
 
 
+CELL_POSITION_FIELDS = ('x', 'y', 'w', 'h')
+
+
+def content_hash(payload):
+    """Short hash of a JSON payload, independent of the order of its keys."""
+    text = json.dumps(payload, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+
+class CellViewError(Exception):
+    """Raised when some cell views of a dashboard could not be patched. Carries the failed cells."""
+
+    def __init__(self, dashboard_id, cells):
+        self.dashboard_id = dashboard_id
+        self.cells = cells
+        names = ", ".join(f"'{c['name']}'" for c in cells)
+        super().__init__(f"Error patching {len(cells)} cell(s) of dashboard {dashboard_id}: {names}")
+
+
 class InfluxdbHelper:
     #DASHBOARD_TEMPLATE_FILE = 'templates/dashboard-tpl.json'
     DASHBOARD_TEMPLATE_FILE = 'templates/dashboard-tpl.yaml'
     CHART_TEMPLATE_FILE = 'templates/charts-tpl.yaml'
     TEMPLATE_EXCLUDED_FIELDS = ['headers', 'user_password']
+    CELL_WORKERS = int(os.getenv('INFLUXDB_CELL_WORKERS', '8'))    # Concurrent cell view PATCHes per dashboard
+    CELL_RETRIES = int(os.getenv('INFLUXDB_CELL_RETRIES', '1'))    # Retries of failed cells only
+    DELETE_WORKERS = int(os.getenv('INFLUXDB_DELETE_WORKERS', '8'))  # Concurrent deletes of a kind (e.g. authorizations)
+    STATE_SECRET_FIELDS = ('user_password',)    # Kept apart from the resource IDs in the state store
+    STATE_EXCLUDED_FIELDS = ('headers',)        # Not stored: rebuilt from the admin token
+    ALREADY_EXISTS = (409, 422)                 # Create responses for a name that is already taken
+    # 'rest': one REST call per resource and cell view; 'stack': the bucket, variables and dashboard (with its
+    # cell views) are applied as one template, into a stack per app, which is removed in one call
+    PROVISIONING_MODE = os.getenv('PROVISIONING_MODE', 'rest')
 
     def __init__(self, influxdb_base_url, admin_token, org_name, app_id):
         self.influxdb_base_url = influxdb_base_url
@@ -41,6 +76,16 @@ class InfluxdbHelper:
         self.var_name_metrics = self.name_of("var_metrics_list", app_id)  # Variable for listing/selecting a metric
         self.var_name_fields  = self.name_of("var_fields_list", app_id)   # Variable for listing/selecting a field
         self.dashboard_name = self.dashboard_name_of(app_id)      # Dashboard name
+        self.dashboard_cells = []                                 # Dashboard cells whose view is not patched yet
+        self.completed_steps = []                                 # Checkpoint: provisioning steps done so far
+        self.cell_hashes = {}                                     # Content hashes of the deployed cells, by name
+        self.provisioning_mode = self.PROVISIONING_MODE           # Kept with the state: deletes use the same mode
+        self.stack_name = self.name_of("stack", app_id)           # Stack of the templated resources (stack mode)
+
+    # Shared, pooled HTTP client (kept out of the instance state, which is saved to file)
+    @property
+    def http(self):
+        return get_client()
 
     # Naming functions
     def name_of(self, what, app_id):
@@ -53,9 +98,13 @@ class InfluxdbHelper:
         password_length = 32
         return secrets.token_urlsafe(password_length)
 
+    @staticmethod
+    def normalize_app_id(app_id):
+        return re.sub(r'[^A-Za-z0-9_]', r'_', app_id.strip())
+
     def _normalize(self, app_id):
-        app_id_norm = re.sub(r'[^A-Za-z0-9_]', r'_', app_id.strip())
-        self.debug(f'normalize: {app_id} -> {app_id_norm}')
+        app_id_norm = self.normalize_app_id(app_id)
+        self.debug(lambda: f'normalize: {app_id} -> {app_id_norm}')
         return app_id_norm
 
 
@@ -72,8 +121,11 @@ class InfluxdbHelper:
 
     @staticmethod
     def debug(message):
+        # The message can be a callable (e.g. a lambda with an f-string), only called when debug logging is on
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
         # m = f"\033[34m{message}\033[0m"
-        m = message
+        m = message() if callable(message) else message
         logger.debug(m)
         # print(m)
 
@@ -103,20 +155,21 @@ class InfluxdbHelper:
         self._set_org(self.org_name)
 
     def _set_org(self, org_name):
-        url = f"{self.influxdb_base_url}/api/v2/orgs"
-        response = requests.get(url, headers=self.headers)
+        # The org. ID is looked up once and cached process-wide, since the org. never changes while running
+        org_id = ORG_CACHE.get((self.influxdb_base_url, org_name), lambda: self._lookup_org(org_name))
+        self.org_id = org_id
+        self.org_name = org_name
+        return org_id
 
-        if response.status_code == 200:
-            orgs = response.json()['orgs']
-            for org in orgs:
+    def _lookup_org(self, org_name):
+        try:
+            for org in iter_listing(self.influxdb_base_url, self.headers, "/api/v2/orgs", 'orgs'):
                 if org['name'] == org_name:
                     self.info(f"Organization '{org_name}' found with ID: {org['id']}")
-                    self.org_id = org['id']
-                    self.org_name = org_name
                     return org['id']
-            self.error(f"Organization '{org_name}' not found")
-        else:
-            self.error(f"Error while fetching organization list: {response.text}")
+        except Exception as e:
+            self.error(f"Error while fetching organization list: {e}")
+        self.error(f"Organization '{org_name}' not found")
         return None
 
     # 2. Create a new bucket
@@ -124,66 +177,86 @@ class InfluxdbHelper:
         self.bucket_id = self._create_bucket(self.bucket_name, self.org_id)
         return self.bucket_id
 
-    def _create_bucket(self, bucket_name, org_id):
-        url = f"{self.influxdb_base_url}/api/v2/buckets"
-        payload = {
+    def _bucket_payload(self, bucket_name, org_id):
+        return {
             "orgID": org_id,
             "name": bucket_name,
             "retentionRules": [{"type": "expire", "everySeconds": self.retention}],
             "shardGroupDuration": "1h"
         }
-        response = requests.post(url, headers=self.headers, json=payload)
+
+    def _create_bucket(self, bucket_name, org_id):
+        url = f"{self.influxdb_base_url}/api/v2/buckets"
+        payload = self._bucket_payload(bucket_name, org_id)
+        response = self.http.post(url, headers=self.headers, json=payload)
         if response.status_code == 201:
+            data = response.json()
             self.info(f"Bucket '{bucket_name}' created successfully!")
-            self.debug(f"Response: {response.json()}")
-            return response.json()['id']
+            self.debug(lambda: f"Response: {data}")
+            return data['id']
+        elif response.status_code in self.ALREADY_EXISTS:
+            return self._adopt("bucket", f"/api/v2/buckets?orgID={org_id}", "buckets", bucket_name, response)
         else:
             self.error(f"Error creating bucket: {response.text}")
 
     def delete_bucket(self):
-        self._delete_bucket(self.bucket_id, self.bucket_name)
+        return self._delete_bucket(self.bucket_id, self.bucket_name)
 
     def _delete_bucket(self, bucket_id, bucket_name):
         url = f"{self.influxdb_base_url}/api/v2/buckets/{bucket_id}"
-        self.debug(f"Deleting bucket {bucket_name}: '{url}'")
-        response = requests.delete(url, headers=self.headers)
-        self.debug(f"Deleting bucket: RESPONSE: '{response}'")
+        self.debug(lambda: f"Deleting bucket {bucket_name}: '{url}'")
+        response = self.http.delete(url, headers=self.headers)
+        self.debug(lambda: f"Deleting bucket: RESPONSE: '{response}'")
         if response.status_code == 204:
             self.info(f"Bucket '{bucket_name}' deleted successfully!")
+            return "deleted"
+        elif response.status_code == 404:
+            self.info(f"Bucket '{bucket_name}' was already deleted")
+            return "missing"
         else:
             self.error(f"Error deleting bucket: {response.text}")
 
     # 3. Create a new scraper
-    def create_scraper(self):
-        self.scraper_id = self._create_scraper(self.scraper_name, self.scraper_url, self.org_id, self.bucket_id)
+    def create_scraper(self, adopt=False):
+        # Scraper names are not unique: when resuming, look for one created by the earlier attempt first
+        self.scraper_id = adopt and self._find_id("/api/v2/scrapers", "configurations", self.scraper_name) \
+            or self._create_scraper(self.scraper_name, self.scraper_url, self.org_id, self.bucket_id)
         return self.scraper_id
 
-    def _create_scraper(self, scraper_name, scraper_url, org_id, bucket_id):
-        url = f"{self.influxdb_base_url}/api/v2/scrapers"
-        payload = {
+    def _scraper_payload(self, scraper_name, scraper_url, org_id, bucket_id):
+        return {
             "name": scraper_name,
             "orgID": org_id,
             "bucketID": bucket_id,
             "url": scraper_url
         }
-        response = requests.post(url, headers=self.headers, json=payload)
+
+    def _create_scraper(self, scraper_name, scraper_url, org_id, bucket_id):
+        url = f"{self.influxdb_base_url}/api/v2/scrapers"
+        payload = self._scraper_payload(scraper_name, scraper_url, org_id, bucket_id)
+        response = self.http.post(url, headers=self.headers, json=payload)
         if response.status_code == 201:
+            data = response.json()
             self.info(f"Scraper '{scraper_name}' created successfully!")
-            self.debug(f"Response: {response.json()}")
-            return response.json()['id']
+            self.debug(lambda: f"Response: {data}")
+            return data['id']
         else:
             self.error(f"Error creating scrapper: {response.text}")
 
     def delete_scraper(self):
-        self._delete_scraper(self.scraper_id, self.scraper_name)
+        return self._delete_scraper(self.scraper_id, self.scraper_name)
 
     def _delete_scraper(self, scraper_id, scraper_name):
         url = f"{self.influxdb_base_url}/api/v2/scrapers/{scraper_id}"
-        self.debug(f"Deleting scraper {scraper_name}: '{url}'")
-        response = requests.delete(url, headers=self.headers)
-        self.debug(f"Deleting scraper: RESPONSE: '{response}'")
+        self.debug(lambda: f"Deleting scraper {scraper_name}: '{url}'")
+        response = self.http.delete(url, headers=self.headers)
+        self.debug(lambda: f"Deleting scraper: RESPONSE: '{response}'")
         if response.status_code == 204:
             self.info(f"Scraper '{scraper_name}' deleted successfully!")
+            return "deleted"
+        elif response.status_code == 404:
+            self.info(f"Scraper '{scraper_name}' was already deleted")
+            return "missing"
         else:
             self.error(f"Error deleting scrapper: {response.text}")
 
@@ -193,18 +266,24 @@ class InfluxdbHelper:
         self._update_user_password(self.user_id, self.user_name, self.user_password)
         return self.user_id
 
-    def _create_user(self, user_name, user_password, org_id):
-        url = f"{self.influxdb_base_url}/api/v2/users"
-        payload = {
+    def _user_payload(self, user_name, user_password, org_id):
+        return {
             "name": user_name,
             "password": user_password,
             "orgID": org_id
         }
-        response = requests.post(url, headers=self.headers, json=payload)
+
+    def _create_user(self, user_name, user_password, org_id):
+        url = f"{self.influxdb_base_url}/api/v2/users"
+        payload = self._user_payload(user_name, user_password, org_id)
+        response = self.http.post(url, headers=self.headers, json=payload)
         if response.status_code == 201:
             self.info(f"User '{user_name}' created successfully!")
             self.info(f"User password: {user_password}")
             return response.json()['id']
+        elif response.status_code in self.ALREADY_EXISTS:
+            # The password is then reset by _update_user_password
+            return self._adopt("user", "/api/v2/users", "users", user_name, response)
         else:
             self.error(f"Error creating user: {response.text}")
 
@@ -213,36 +292,43 @@ class InfluxdbHelper:
         payload = {
             "password": user_password
         }
-        response = requests.post(url, headers=self.headers, json=payload)
+        response = self.http.post(url, headers=self.headers, json=payload)
         if response.status_code == 204:
             self.info(f"User '{user_name}' password updated successfully!")
         else:
             self.error(f"Error updating user password: {response.text}")
 
     def delete_user(self):
-        self._delete_user(self.user_id, self.user_name)
+        return self._delete_user(self.user_id, self.user_name)
 
     def _delete_user(self, user_id, user_name):
         url = f"{self.influxdb_base_url}/api/v2/users/{user_id}"
-        self.debug(f"Deleting user {user_name}: '{url}'")
-        response = requests.delete(url, headers=self.headers)
-        self.debug(f"Deleting user: RESPONSE: '{response}'")
+        self.debug(lambda: f"Deleting user {user_name}: '{url}'")
+        response = self.http.delete(url, headers=self.headers)
+        self.debug(lambda: f"Deleting user: RESPONSE: '{response}'")
         if response.status_code == 204:
             self.info(f"User '{user_name}' deleted successfully!")
+            return "deleted"
+        elif response.status_code == 404:
+            self.info(f"User '{user_name}' was already deleted")
+            return "missing"
         else:
             self.error(f"Error deleting user: {response.text}")
 
     # 5. Create a new variable
     def create_variables(self):
-        self.var_id_metrics = self._create_variable(
-                self.var_name_metrics,
-                textwrap.dedent(f'''
+        metrics_query, fields_query = self._variable_queries()
+        self.var_id_metrics = self._create_variable(self.var_name_metrics, metrics_query, self.org_id)
+        self.var_id_fields = self._create_variable(self.var_name_fields, fields_query, self.org_id)
+        return self.var_id_metrics, self.var_id_fields
+
+    # Flux queries of the metrics list and fields list variables
+    def _variable_queries(self):
+        return (
+            textwrap.dedent(f'''
                 import "influxdata/influxdb/schema"
                 schema.measurements(bucket: "{self.bucket_name}")'''),
-                self.org_id)
-        self.var_id_fields = self._create_variable(
-                self.var_name_fields,
-                textwrap.dedent(f'''
+            textwrap.dedent(f'''
                 import "influxdata/influxdb/schema"
                 schema.fieldKeys(
                   bucket: "{self.bucket_name}",
@@ -250,12 +336,10 @@ class InfluxdbHelper:
                                     and r._field !~ /^(\\d.*)/
                                     and r._field !~ /^(?i)(\\+inf|-inf)$/
                 )'''),
-                self.org_id)
-        return self.var_id_metrics, self.var_id_fields
+        )
 
-    def _create_variable(self, variable_name, variable_query, org_id):
-        url = f"{self.influxdb_base_url}/api/v2/variables"
-        payload = {
+    def _variable_payload(self, variable_name, variable_query, org_id):
+        return {
             "arguments": {
                 "type": "query",
                 "values": {
@@ -266,11 +350,18 @@ class InfluxdbHelper:
             "name": variable_name,
             "orgID": org_id
         }
-        response = requests.post(url, headers=self.headers, json=payload)
+
+    def _create_variable(self, variable_name, variable_query, org_id):
+        url = f"{self.influxdb_base_url}/api/v2/variables"
+        payload = self._variable_payload(variable_name, variable_query, org_id)
+        response = self.http.post(url, headers=self.headers, json=payload)
         if response.status_code == 201:
+            data = response.json()
             self.info(f"Variable '{variable_name}' created successfully!")
-            self.debug(f"Response: {response.json()}")
-            return response.json()['id']
+            self.debug(lambda: f"Response: {data}")
+            return data['id']
+        elif response.status_code in self.ALREADY_EXISTS:
+            return self._adopt("variable", "/api/v2/variables", "variables", variable_name, response)
         else:
             self.error(f"Error creating variable: {response.text}")
 
@@ -280,86 +371,237 @@ class InfluxdbHelper:
 
     def _delete_variable(self, variable_id, variable_name):
         url = f"{self.influxdb_base_url}/api/v2/variables/{variable_id}"
-        self.debug(f"Deleting variable {variable_name}: '{url}'")
-        response = requests.delete(url, headers=self.headers)
-        self.debug(f"Deleting dashboard: RESPONSE: '{response}'")
+        self.debug(lambda: f"Deleting variable {variable_name}: '{url}'")
+        response = self.http.delete(url, headers=self.headers)
+        self.debug(lambda: f"Deleting dashboard: RESPONSE: '{response}'")
         if response.status_code == 204:
             self.info(f"Variable '{variable_name}' deleted successfully!")
+            return "deleted"
+        elif response.status_code == 404:
+            self.info(f"Variable '{variable_name}' was already deleted")
+            return "missing"
         else:
             self.error(f"Error deleting variable: {response.text}")
 
     # 6. Create a new dashboard from template
-    def create_dashboard(self):
-        dashboard_data, dashboard_tpl = self._create_dashboard(self.dashboard_name, self.org_id)
+    def create_dashboard(self, adopt=False):
+        # Dashboard names are not unique: when resuming, look for one created by the earlier attempt first
+        dashboard_id = adopt and self._find_id("/api/v2/dashboards", "dashboards", self.dashboard_name)
+        if dashboard_id:
+            self.info(f"Dashboard '{self.dashboard_name}' already exists: adopting {dashboard_id}")
+            dashboard_data = self._get_dashboard(dashboard_id)
+        else:
+            dashboard_data, _ = self._create_dashboard(self.dashboard_name, self.org_id)
         self.dashboard_id = dashboard_data['id']
-        self._create_cell_views(dashboard_data, dashboard_tpl)
+        self.dashboard_cells = [{'id': c['id'], 'name': c['name']} for c in dashboard_data['cells']]
         return self.dashboard_id
 
+    # 6b. Patch the views of the dashboard cells not patched yet
+    def create_cell_views(self):
+        dashboard_tpl = self._load_dashboard_template(self.DASHBOARD_TEMPLATE_FILE)
+        dashboard_data = {'id': self.dashboard_id, 'cells': self.dashboard_cells}
+        cells = self.dashboard_cells
+        for attempt in range(self.CELL_RETRIES + 1):
+            try:
+                self._create_cell_views(dashboard_data, dashboard_tpl, cells)
+                break
+            except CellViewError as e:
+                # Only the failed cells are left (and checkpointed): a resumed create patches just these
+                self.dashboard_cells = e.cells
+                if attempt == self.CELL_RETRIES:
+                    raise
+                # Retry only the cells that failed
+                self.info(f"Retrying {len(e.cells)} failed cell(s) of dashboard '{self.dashboard_name}'")
+                cells = e.cells
+        self.dashboard_cells = []
+
+    def _get_dashboard(self, dashboard_id):
+        url = f"{self.influxdb_base_url}/api/v2/dashboards/{dashboard_id}"
+        response = self.http.get(url, headers=self.headers)
+        if response.status_code == 200:
+            return response.json()
+        else:
+            self.error(f"Error retrieving dashboard {dashboard_id}: {response.text}")
+
     def _create_dashboard(self, dashboard_name, org_id):
         url = f"{self.influxdb_base_url}/api/v2/dashboards"
         payload = self._load_dashboard_template(self.DASHBOARD_TEMPLATE_FILE)
-        response = requests.post(url, headers=self.headers, json=payload)
+        response = self.http.post(url, headers=self.headers, json=payload)
         if response.status_code == 201:
+            data = response.json()
             self.info(f"Dashboard '{dashboard_name}' created successfully!")
-            self.debug(f"Response: {response.json()}")
-            return response.json(), payload
+            self.debug(lambda: f"Response: {data}")
+            return data, payload
         else:
             self.error(f"Error creating dashboard: {response.text}")
 
     def _load_dashboard_template(self, file_path):
-        # with open(file_path) as f: input_string = f.read()
-        with open(file_path, 'r') as file:
-            input_string = file.read()
-            #for placeholder, replacement in placeholders.items():
-            #    input_string = input_string.replace(f'{{{placeholder}}}', str(replacement))
-            for field, value in self.__dict__.items():
-                if field in self.TEMPLATE_EXCLUDED_FIELDS:
-                    continue
-                else:
-                    self.debug(f".........{field} = {value}")
-                    input_string = input_string.replace(f'{{{field}}}', str(value))
-
-            data = yaml.safe_load(input_string)
-            json_string = json.dumps(data, indent=2)
-            json_data = json.loads(json_string)
-            self.debug(f"_load_dashboard_template result: {json_data}")
-            return json_data
-
-    def _create_cell_views(self, dashboard_data, dashboard_tpl):
-        dashboard_id = dashboard_data['id']
+        # Templates are compiled once and cached; only the placeholders a template contains are substituted
+        template = TEMPLATES.get(file_path)
+        values = {field: self.__dict__[field] for field in template.placeholders
+                  if field in self.__dict__ and field not in self.TEMPLATE_EXCLUDED_FIELDS}
+        self.debug(lambda: f"_load_dashboard_template values: {values}")
+        return template.render(values)
+
+    # Function building the view payload of a dashboard cell
+    def _cell_view_payloads(self, dashboard_tpl):
         templates = self._load_dashboard_template(self.CHART_TEMPLATE_FILE)
-        for c in dashboard_data['cells']:
-            url = f"{self.influxdb_base_url}/api/v2/dashboards/{dashboard_id}/cells/{c["id"]}/view"
-            cell_tpl = next((x for x in dashboard_tpl['cells'] if x['name'] == c['name']), None)
-            cell_template = cell_tpl["cell-template"] or "default_chart"
-            payload = deepcopy( templates[cell_template] )
-            payload["name"] = c["name"] or "Unnamed cell"
-            response = requests.patch(url, headers=self.headers, json=payload)
-            if response.status_code == 200:
-                self.info(f"      Cell '{c["name"]}' patched successfully!")
-            else:
-                self.error(f"Error patching cell: {response.text}")
+        cell_templates = {x['name']: x.get('cell-template') for x in dashboard_tpl['cells']}
+
+        def payload_of(c):
+            cell_template = cell_templates.get(c['name']) or "default_chart"
+            # Shallow copy is enough: only the name differs between cells, and the payload is not mutated
+            return dict(templates[cell_template], name=c['name'] or "Unnamed cell")
+        return payload_of
+
+    def _create_cell_views(self, dashboard_data, dashboard_tpl, cells=None):
+        dashboard_id = dashboard_data['id']
+        cells = dashboard_data['cells'] if cells is None else cells
+        payload_of = self._cell_view_payloads(dashboard_tpl)
+        tpl_cells = {x['name']: x for x in dashboard_tpl['cells']}
+
+        def patch_cell_view(c):
+            payload = payload_of(c)
+            self._patch_cell_view(dashboard_id, c['id'], c['name'], payload)
+            self.cell_hashes[c['name']] = self._cell_hashes_of(tpl_cells.get(c['name'], {}), payload)
+
+        # Patch cell views concurrently, and report failures per cell
+        failed = []
+        for c, _, e in run_parallel(patch_cell_view, cells, self.CELL_WORKERS):
+            if e is not None:
+                self.warning(f"Cell '{c['name']}' ({c['id']}) of dashboard {dashboard_id} failed: {e}")
+                failed.append(c)
+        if failed:
+            raise CellViewError(dashboard_id, failed)
+
+    def _patch_cell_view(self, dashboard_id, cell_id, cell_name, payload):
+        url = f"{self.influxdb_base_url}/api/v2/dashboards/{dashboard_id}/cells/{cell_id}/view"
+        response = self.http.patch(url, headers=self.headers, json=payload)
+        if response.status_code != 200:
+            raise Exception(f"Error patching cell: {response.text}")
+        self.info(f"      Cell '{cell_name}' patched successfully!")
+
+    # Rendered cells of the dashboard: (template cell, view payload)
+    def _rendered_cells(self):
+        dashboard_tpl = self._load_dashboard_template(self.DASHBOARD_TEMPLATE_FILE)
+        payload_of = self._cell_view_payloads(dashboard_tpl)
+        return [(c, payload_of(c)) for c in dashboard_tpl['cells']]
+
+    # Content hashes of a cell, as rendered: of its position and size, and of its view
+    def _cell_hashes_of(self, tpl_cell, view):
+        return {
+            'position': content_hash({k: tpl_cell.get(k) for k in CELL_POSITION_FIELDS}),
+            'view': content_hash(view)
+        }
+
+    def rendered_cell_hashes(self):
+        return {c['name']: self._cell_hashes_of(c, view) for c, view in self._rendered_cells()}
+
+    # 6c. Update the dashboard of an existing app to the current templates
+    def plan_dashboard_update(self):
+        """Compare the content hashes of the rendered cells with those of the deployed cells. Returns the
+        changes {cell name: what to write}: 'view' and/or 'position', or 'remove' for a cell deployed
+        from a template cell which no longer exists. Cells without a recorded hash are written."""
+        rendered = self.rendered_cell_hashes()
+        deployed = self.cell_hashes or {}
+        changes = {}
+        for name, hashes in rendered.items():
+            changed = [what for what in ('position', 'view') if (deployed.get(name) or {}).get(what) != hashes[what]]
+            if changed:
+                changes[name] = changed
+        changes.update({name: ['remove'] for name in deployed if name not in rendered})
+        return changes
+
+    def update_dashboard(self):
+        """Write the changed cells of the dashboard (see plan_dashboard_update) concurrently: the cell
+        positions, the views, new cells and removed cells. The hashes of the cells written are recorded
+        in cell_hashes, also when other cells fail (CellViewError). Returns the changes made."""
+        changes = self.plan_dashboard_update()
+        if not changes:
+            return changes
+        rendered = {c['name']: (c, view) for c, view in self._rendered_cells()}
+        dashboard_id = self.dashboard_id
+        # One read for the cell IDs (cells added by hand to the dashboard are left alone)
+        cell_ids = {c.get('name'): c['id'] for c in self._get_dashboard(dashboard_id)['cells']}
+
+        def write_cell(name):
+            if changes[name] == ['remove']:
+                if name in cell_ids:
+                    self._delete_cell(dashboard_id, cell_ids[name], name)
+                self.cell_hashes.pop(name, None)
+                return
+            tpl_cell, view = rendered[name]
+            cell_id = cell_ids.get(name)
+            if cell_id is None:
+                # New in the template (or removed from the dashboard): add it, at its position
+                cell_id = self._add_cell(dashboard_id, tpl_cell)
+                changes[name] = ['add', 'view']
+            elif 'position' in changes[name]:
+                self._patch_cell_position(dashboard_id, cell_id, name, tpl_cell)
+            if 'view' in changes[name]:
+                self._patch_cell_view(dashboard_id, cell_id, name, view)
+            self.cell_hashes[name] = self._cell_hashes_of(tpl_cell, view)
+
+        failed = []
+        for name, _, e in run_parallel(write_cell, list(changes), self.CELL_WORKERS):
+            if e is not None:
+                self.warning(f"Cell '{name}' of dashboard {dashboard_id} failed: {e}")
+                failed.append({'id': cell_ids.get(name), 'name': name})
+        if failed:
+            raise CellViewError(dashboard_id, failed)
+        self.info(f"Dashboard '{self.dashboard_name}' updated: {len(changes)} cell(s) written")
+        return changes
+
+    def _add_cell(self, dashboard_id, tpl_cell):
+        url = f"{self.influxdb_base_url}/api/v2/dashboards/{dashboard_id}/cells"
+        payload = dict({k: tpl_cell.get(k) for k in CELL_POSITION_FIELDS}, name=tpl_cell['name'])
+        response = self.http.post(url, headers=self.headers, json=payload)
+        if response.status_code != 201:
+            raise Exception(f"Error adding cell: {response.text}")
+        self.info(f"      Cell '{tpl_cell['name']}' added successfully!")
+        return response.json()['id']
+
+    def _patch_cell_position(self, dashboard_id, cell_id, cell_name, tpl_cell):
+        url = f"{self.influxdb_base_url}/api/v2/dashboards/{dashboard_id}/cells/{cell_id}"
+        response = self.http.patch(url, headers=self.headers, json={k: tpl_cell.get(k) for k in CELL_POSITION_FIELDS})
+        if response.status_code != 200:
+            raise Exception(f"Error moving cell: {response.text}")
+        self.info(f"      Cell '{cell_name}' moved successfully!")
+
+    def _delete_cell(self, dashboard_id, cell_id, cell_name):
+        url = f"{self.influxdb_base_url}/api/v2/dashboards/{dashboard_id}/cells/{cell_id}"
+        response = self.http.delete(url, headers=self.headers)
+        if response.status_code not in (204, 404):
+            raise Exception(f"Error deleting cell: {response.text}")
+        self.info(f"      Cell '{cell_name}' deleted successfully!")
 
     def delete_dashboard(self):
-        self._delete_dashboard(self.dashboard_id, self.dashboard_name)
+        return self._delete_dashboard(self.dashboard_id, self.dashboard_name)
 
     def _delete_dashboard(self, dashboard_id, dashboard_name):
         url = f"{self.influxdb_base_url}/api/v2/dashboards/{dashboard_id}"
-        self.debug(f"Deleting dashboard {dashboard_name} : {url}")
-        response = requests.delete(url, headers=self.headers)
-        self.debug(f"Deleting dashboard: RESPONSE: '{response}'")
+        self.debug(lambda: f"Deleting dashboard {dashboard_name} : {url}")
+        response = self.http.delete(url, headers=self.headers)
+        self.debug(lambda: f"Deleting dashboard: RESPONSE: '{response}'")
         if response.status_code == 204:
             self.info(f"Dashboard '{dashboard_name}' successfully deleted!")
+            return "deleted"
+        elif response.status_code == 404:
+            self.info(f"Dashboard '{dashboard_name}' was already deleted")
+            return "missing"
         else:
             self.error(f"Error deleting dashboard {dashboard_name} : {response.text}")
 
     # 7. Grant all privileges to the user
-    def grant_privileges(self):
+    def grant_privileges(self, adopt=False):
+        # Authorizations are not unique: when resuming, keep the ones granted by the earlier attempt
+        if adopt and self._get_user_authorizations(self.user_id):
+            self.info(f"User '{self.user_name}' already has authorizations: keeping them")
+            return
         self._grant_privileges(self.user_id, self.user_name, self.dashboard_id, self.bucket_id, self.org_id)
 
-    def _grant_privileges(self, user_id, user_name, dashboard_id, bucket_id, org_id):
-        url = f"{self.influxdb_base_url}/api/v2/authorizations"
-        payload = {
+    def _authorization_payload(self, user_id, user_name, dashboard_id, bucket_id, org_id):
+        return {
             "orgID": org_id,
             "userID": user_id,
             "status": "active",
@@ -371,87 +613,347 @@ class InfluxdbHelper:
                 {"action": "write", "resource": {"type": "dashboards", "id": dashboard_id}}
             ]
         }
-        response = requests.post(url, headers=self.headers, json=payload)
+
+    def _grant_privileges(self, user_id, user_name, dashboard_id, bucket_id, org_id):
+        url = f"{self.influxdb_base_url}/api/v2/authorizations"
+        payload = self._authorization_payload(user_id, user_name, dashboard_id, bucket_id, org_id)
+        response = self.http.post(url, headers=self.headers, json=payload)
         if response.status_code == 201:
             self.info(f"Granted all privileges to user '{self.user_name}'!")
         else:
             self.error(f"Error granting privileges: {response.text}")
 
     def revoke_privileges(self):
-        self._revoke_privileges(self.user_id)
+        return self._revoke_privileges(self.user_id)
 
     def _revoke_privileges(self, user_id):
-        # Get user authorizations
-        authorizations = self._get_user_authorizations(user_id)
-
-        # Delete each user authorization
-        for auth in authorizations:
-            url = f"{self.influxdb_base_url}/api/v2/authorizations/{auth['id']}"
-            self.debug(f'Deleting user authorization: {url}')
-            response = requests.delete(url, headers=self.headers)
-            self.debug(f"Deleting user authorization: RESPONSE: '{response}'")
-            if response.status_code == 204:
-                self.debug(f"Deleted user authorization: '{auth['id']}'")
-            else:
-                self.error(f"Error deleting authorization : {response.text}")
+        authorizations = self.revoke_users_privileges([user_id])
         self.info(f"Deleted user authorizations: '{self.user_name}'")
+        return "deleted" if authorizations else "missing"
+
+    # Revoke the authorizations of many users in one batch (e.g. during bulk teardown).
+    # Returns the deleted authorizations
+    def revoke_users_privileges(self, user_ids):
+        # Get each user's authorizations (filtered server-side, so the cost follows the batch size, not the
+        # number of users of the instance), concurrently
+        authorizations = []
+        for user_id, auths, e in run_parallel(self._get_user_authorizations, user_ids, self.DELETE_WORKERS):
+            if e is not None:
+                self.error(f"Error retrieving authorizations of user {user_id}: {e}")
+            authorizations.extend(auths)
+
+        # Delete the user authorizations, concurrently
+        failed = [(auth, e) for auth, _, e in run_parallel(self._delete_authorization, authorizations, self.DELETE_WORKERS)
+                  if e is not None]
+        for auth, e in failed:
+            self.warning(f"Error deleting authorization {auth['id']} of user {auth.get('userID')}: {e}")
+        if failed:
+            self.error(f"Error deleting {len(failed)} of {len(authorizations)} authorization(s)")
+        return authorizations
 
-    # Functions for getting Authorizations
-    def _get_all_authorizations(self):
-        # Get all authorizations
-        url = f"{self.influxdb_base_url}/api/v2/authorizations"
-        self.debug(f"Getting all authorizations: '{url}'")
-        response = requests.get(url, headers=self.headers)
-        self.debug(f"Getting all authorizations: RESPONSE: '{response}'")
-        if response.status_code == 200:
-            self.debug(f"Got all authorizations!")
-            self.debug(response.json())
-            return response.json()['authorizations']
+    def _delete_authorization(self, auth):
+        url = f"{self.influxdb_base_url}/api/v2/authorizations/{auth['id']}"
+        self.debug(lambda: f'Deleting user authorization: {url}')
+        response = self.http.delete(url, headers=self.headers)
+        self.debug(lambda: f"Deleting user authorization: RESPONSE: '{response}'")
+        if response.status_code == 204:
+            self.debug(lambda: f"Deleted user authorization: '{auth['id']}'")
         else:
-            self.error(f"Error retrieving authorizations: {response.text}")
-            return None
+            raise Exception(f"Error deleting authorization : {response.text}")
 
     def _get_user_authorizations(self, user_id):
-        # Get all authorizations
-        authorizations = self._get_all_authorizations()
+        # Get only this user's authorizations, filtered by InfluxDB (all pages)
+        authorizations = list(iter_listing(self.influxdb_base_url, self.headers,
+                                           f"/api/v2/authorizations?userID={user_id}", 'authorizations'))
+        self.debug(lambda: f"User authorizations: {authorizations}")
+        return authorizations
 
-        # Extract this user's authorizations
-        self.debug(f"All authorizations: {authorizations}")
-        authorizations = [x for x in authorizations if x['userID'] == user_id]
-        self.debug(f"User authorizations: {authorizations}")
 
-        return authorizations
+    # 8. Stack mode: create the app's stack, and apply the template of its bucket, variables and dashboard
+    def create_stack(self, adopt=False):
+        # Stack names are not unique: when resuming, look for the stack of the earlier attempt first
+        self.stack_id = adopt and self._find_stack(self.stack_name) \
+            or self._create_stack(self.stack_name, self.org_id)
+        return self.stack_id
 
+    def _stack_payload(self, stack_name, org_id):
+        return {
+            "orgID": org_id,
+            "name": stack_name,
+            "description": f"Resources of application {self.app_id}"
+        }
 
-    # Function to run all tasks
-    def create_all(self):
-        self.set_org()          # Step 1: Set Org. Id
-        self.create_bucket()    # Step 2: Create bucket
-        self.create_scraper()   # Step 3: Create scraper for writing data to bucket
-        self.create_user()      # Step 4: Create user
-        self.create_variables() # Step 5: Create variables
-        self.create_dashboard() # Step 6: Create dashboard with a graph cell
-        self.grant_privileges() # Step 7: Grant privileges to user
-
-    # Function to delete all resources
-    def delete_all(self):
-        with suppress(Exception): self.revoke_privileges() # Step 7: Revoke privileges from user
-        with suppress(Exception): self.delete_dashboard()  # Step 6: Delete dashboard with a graph cell
-        with suppress(Exception): self.delete_variables()  # Step 5: Delete variables
-        with suppress(Exception): self.delete_user()       # Step 4: Delete user
-        with suppress(Exception): self.delete_scraper()    # Step 3: Delete scraper for writing data to bucket
-        with suppress(Exception): self.delete_bucket()     # Step 2: Delete bucket
-
-    # Function for finding all related info (id's, names) for an App.Id
-    def find_all(self, app_id):
+    def _create_stack(self, stack_name, org_id):
+        url = f"{self.influxdb_base_url}/api/v2/stacks"
+        response = self.http.post(url, headers=self.headers, json=self._stack_payload(stack_name, org_id))
+        if response.status_code == 201:
+            data = response.json()
+            self.info(f"Stack '{stack_name}' created successfully!")
+            self.debug(lambda: f"Response: {data}")
+            return data['id']
+        else:
+            self.error(f"Error creating stack: {response.text}")
+
+    # ID of the org's stack with this name, or None
+    def _find_stack(self, stack_name):
+        return self._find_id(self._stacks_path(stack_name), 'stacks', stack_name)
+
+    def _stacks_path(self, stack_name):
+        return f"/api/v2/stacks?orgID={self.org_id}&name={quote(stack_name)}"
+
+    def apply_template(self):
+        url = f"{self.influxdb_base_url}/api/v2/templates/apply"
+        cells = self._rendered_cells()
+        response = self.http.post(url, headers=self.headers, json=self._apply_payload(cells))
+        if response.status_code in (200, 201):
+            self._set_applied_ids(response.json(), cells)
+        else:
+            self.error(f"Error applying the template of stack '{self.stack_name}': {response.text}")
+
+    # Template of the bucket, the variables and the dashboard, rendered from the same templates as in REST mode
+    def _template_manifest(self, cells):
+        metrics_query, fields_query = self._variable_queries()
+        dashboard_tpl = self._load_dashboard_template(self.DASHBOARD_TEMPLATE_FILE)
+        charts = [stack_manifest.chart_of(c, view) for c, view in cells]
+        return [
+            stack_manifest.bucket_entry(self.bucket_name, self.retention),
+            stack_manifest.variable_entry(self.var_name_metrics, metrics_query),
+            stack_manifest.variable_entry(self.var_name_fields, fields_query),
+            stack_manifest.dashboard_entry(self.dashboard_name, dashboard_tpl.get('description'), charts),
+        ]
+
+    def _apply_payload(self, cells):
+        return {
+            "orgID": self.org_id,
+            "stackID": self.stack_id,
+            "template": {"contents": self._template_manifest(cells)}
+        }
+
+    def _set_applied_ids(self, data, cells):
+        summary = data.get('summary') or {}
+        ids = {(what, x.get('name')): x.get('id') for what in ('buckets', 'variables', 'dashboards')
+               for x in summary.get(what) or []}
+        self.bucket_id = ids.get(('buckets', self.bucket_name))
+        self.var_id_metrics = ids.get(('variables', self.var_name_metrics))
+        self.var_id_fields = ids.get(('variables', self.var_name_fields))
+        self.dashboard_id = ids.get(('dashboards', self.dashboard_name))
+        self.dashboard_cells = []   # The cell views are part of the template
+        self.cell_hashes = {c['name']: self._cell_hashes_of(c, view) for c, view in cells}
+        missing = [name for name, value in (("bucket", self.bucket_id), ("variables", self.var_id_metrics and self.var_id_fields),
+                                            ("dashboard", self.dashboard_id)) if not value]
+        if missing:
+            self.error(f"Stack '{self.stack_name}' applied without: {', '.join(missing)}")
+        self.info(f"Template of stack '{self.stack_name}' applied successfully!")
+
+    # Remove the stack, and with it the resources it holds
+    def delete_stack(self):
+        return self._delete_stack(self.stack_id, self.stack_name)
+
+    def _delete_stack(self, stack_id, stack_name):
+        url = f"{self.influxdb_base_url}/api/v2/stacks/{stack_id}?orgID={self.org_id}"
+        self.debug(lambda: f"Deleting stack {stack_name}: '{url}'")
+        response = self.http.delete(url, headers=self.headers)
+        self.debug(lambda: f"Deleting stack: RESPONSE: '{response}'")
+        if response.status_code == 204:
+            self.info(f"Stack '{stack_name}' deleted successfully, with its bucket, variables and dashboard!")
+            return "deleted"
+        elif response.status_code == 404:
+            self.info(f"Stack '{stack_name}' was already deleted")
+            return "missing"
+        else:
+            self.error(f"Error deleting stack: {response.text}")
+
+
+    # Provisioning steps, with the steps each one depends on.
+    # When resuming, steps which create non-unique resources first look for the ones of the earlier attempt
+    def create_steps(self, resumed=False):
+        if self.provisioning_mode == 'stack':
+            return [
+                Step("set_org", self.set_org),
+                Step("create_stack", lambda: self.create_stack(resumed), ["set_org"]),
+                Step("apply_template", self.apply_template, ["create_stack"]),   # Bucket, variables, dashboard
+                Step("create_scraper", lambda: self.create_scraper(resumed), ["apply_template"]),
+                Step("create_user", self.create_user, ["set_org"]),
+                Step("grant_privileges", lambda: self.grant_privileges(resumed), ["create_user", "apply_template"]),
+            ]
+        return [
+            Step("set_org", self.set_org),                                         # Step 1: Set Org. Id
+            Step("create_bucket", self.create_bucket, ["set_org"]),                # Step 2: Create bucket
+            Step("create_scraper", lambda: self.create_scraper(resumed),
+                 ["create_bucket"]),                                               # Step 3: Create scraper for writing data to bucket
+            Step("create_user", self.create_user, ["set_org"]),                    # Step 4: Create user
+            Step("create_variables", self.create_variables, ["set_org"]),          # Step 5: Create variables (only need the bucket name)
+            Step("create_dashboard", lambda: self.create_dashboard(resumed),
+                 ["set_org"]),                                                     # Step 6: Create dashboard (only needs the variable names)
+            Step("create_cell_views", self.create_cell_views, ["create_dashboard"]),  # Step 6b: Patch the dashboard cell views
+            Step("grant_privileges", lambda: self.grant_privileges(resumed),
+                 ["create_user", "create_bucket", "create_dashboard"]),            # Step 7: Grant privileges to user
+        ]
+
+    # Function to run all tasks. Independent steps run concurrently; returns the per-step timings.
+    # Each completed step is checkpointed (in store, if given), and the steps completed by an earlier
+    # attempt (loaded with loadFromStore) are skipped, so a retried create only does what is left.
+    def create_all(self, max_workers=None, store=None):
+        resumed = bool(self.completed_steps)
+        if resumed:
+            self.info(f"Resuming the creation of '{self.app_id}': skipping steps {', '.join(self.completed_steps)}")
+
+        def checkpoint(step_name):
+            self.completed_steps.append(step_name)
+            if store is not None:
+                self.saveToStore(store)
+
+        with PROVISIONING_IN_FLIGHT.labels(operation="create").track_inprogress():
+            try:
+                timings = StepExecutor(max_workers, "create").run(self.create_steps(resumed),
+                                                                  completed=self.completed_steps,
+                                                                  on_step_done=checkpoint)
+            finally:
+                # Also checkpoint the progress of the failed steps (e.g. the cells left to patch)
+                if store is not None:
+                    self.saveToStore(store)
+        self.debug(lambda: f"create_all step timings: {timings}")
+        return timings
+
+    # Teardown steps, with the steps each one waits for. A resource without a known ID is skipped
+    def delete_steps(self):
+        def unless_unknown(id_attr, func):
+            return lambda: func() if getattr(self, id_attr, None) else "skipped"
+        if getattr(self, 'stack_id', None):
+            # The stack holds the bucket, the variables and the dashboard: they are removed with it, last
+            return [
+                Step("revoke_privileges", unless_unknown("user_id", self.revoke_privileges)),
+                Step("delete_user", unless_unknown("user_id", self.delete_user), ["revoke_privileges"]),
+                Step("delete_scraper", unless_unknown("scraper_id", self.delete_scraper), ["revoke_privileges"]),
+                Step("delete_stack", self.delete_stack, ["revoke_privileges", "delete_user", "delete_scraper"]),
+            ]
+        return [
+            Step("revoke_privileges", unless_unknown("user_id", self.revoke_privileges)),  # Step 7: Revoke privileges from user
+            Step("delete_dashboard", unless_unknown("dashboard_id", self.delete_dashboard),
+                 ["revoke_privileges"]),                                           # Step 6: Delete dashboard with a graph cell
+            Step("delete_var_metrics", unless_unknown("var_id_metrics",
+                 lambda: self._delete_variable(self.var_id_metrics, self.var_name_metrics)),
+                 ["revoke_privileges"]),                                           # Step 5: Delete variables
+            Step("delete_var_fields", unless_unknown("var_id_fields",
+                 lambda: self._delete_variable(self.var_id_fields, self.var_name_fields)),
+                 ["revoke_privileges"]),
+            Step("delete_user", unless_unknown("user_id", self.delete_user),
+                 ["revoke_privileges"]),                                           # Step 4: Delete user
+            Step("delete_scraper", unless_unknown("scraper_id", self.delete_scraper),
+                 ["revoke_privileges"]),                                           # Step 3: Delete scraper for writing data to bucket
+            Step("delete_bucket", unless_unknown("bucket_id", self.delete_bucket),
+                 ["delete_dashboard", "delete_var_metrics", "delete_var_fields",
+                  "delete_user", "delete_scraper"]),                               # Step 2: Delete bucket, last
+        ]
+
+    # Function to delete all resources. Independent deletes run concurrently, and a failed delete does not
+    # stop the others. Returns the outcome per step: {step: {'status': deleted|missing|skipped|failed, 'error': ...}}
+    # revoked: the status of revoke_privileges, when the user's authorizations were revoked with a batch of apps
+    def delete_all(self, max_workers=None, revoked=None):
+        steps = self.delete_steps()
+        executor = StepExecutor(max_workers, "delete")
+        with PROVISIONING_IN_FLIGHT.labels(operation="delete").track_inprogress():
+            executor.run(steps, completed=["revoke_privileges"] if revoked else (), keep_going=True)
+        outcome = self._teardown_outcome(steps, executor)
+        if revoked:
+            outcome["revoke_privileges"] = {'status': revoked, 'error': None}
+        return outcome
+
+    def _teardown_outcome(self, steps, executor):
+        outcome = {}
+        for step in steps:
+            e = executor.errors.get(step.name)
+            outcome[step.name] = {'status': 'failed', 'error': str(e)} if e is not None \
+                else {'status': executor.results.get(step.name), 'error': None}
+        failed = self.failed_steps(outcome)
+        if failed:
+            self.warning(f"Teardown of '{self.app_id}' incomplete: failed {', '.join(failed)}")
+        return outcome
+
+    @staticmethod
+    def failed_steps(outcome):
+        return [name for name, o in outcome.items() if o['status'] == 'failed']
+
+    # The create step of the resource each teardown step removes
+    UNDONE_BY_DELETE = {
+        "revoke_privileges": "grant_privileges",
+        "delete_dashboard": "create_dashboard",
+        "delete_var_metrics": "create_variables",
+        "delete_var_fields": "create_variables",
+        "delete_user": "create_user",
+        "delete_scraper": "create_scraper",
+        "delete_bucket": "create_bucket",
+        "delete_stack": "create_stack",
+    }
+
+    # The create steps undone by a teardown: those of the resources it removed (or found already removed),
+    # and the steps which depend on them
+    def undone_steps(self, outcome):
+        undone = {self.UNDONE_BY_DELETE[name] for name, o in outcome.items()
+                  if name in self.UNDONE_BY_DELETE and o['status'] != 'failed'}
+        for step in self.create_steps():     # Listed after the steps they require
+            if undone.intersection(step.requires):
+                undone.add(step.name)
+        return undone
+
+    # After an incomplete teardown, whose stored state is kept for a retry: forget the undone create steps
+    # in the stored checkpoint, so that a later create makes their resources again instead of skipping them
+    def forget_undone_steps(self, store, outcome):
+        state = store.load(self.app_id)
+        if state is None:
+            return
+        stored = copy.copy(self)
+        stored.loadState(state)
+        undone = stored.undone_steps(outcome)
+        store.update(self.app_id, {'completed_steps': [s for s in stored.completed_steps if s not in undone]})
+
+    # App resources, as (id attribute, name attribute, resource type, resource name)
+    def resource_names(self, app_id):
+        return [
+            ("bucket_id", "bucket_name", "buckets", self.name_of("bucket", app_id)),
+            ("scraper_id", "scraper_name", "scrapers", self.name_of("scraper", app_id)),
+            ("user_id", "user_name", "users", self.name_of("user", app_id)),
+            ("var_id_metrics", "var_name_metrics", "variables", self.name_of("var_metrics_list", app_id)),
+            ("var_id_fields", "var_name_fields", "variables", self.name_of("var_fields_list", app_id)),
+            ("dashboard_id", "dashboard_name", "dashboards", self.dashboard_name_of(app_id)),
+        ]
+
+    def resource_catalog(self, resource_types=None):
+        return ResourceCatalog(self.influxdb_base_url, self.headers, self.org_id, resource_types)
+
+    # Function for finding all related info (id's, names) for an App.Id.
+    # A catalog can be passed in, to share the resource listings between many App.Ids
+    def find_all(self, app_id, catalog=None):
         app_id = self._normalize(app_id)
         self.set_org()
-        self.bucket_id, self.bucket_name = self._query("buckets", f"/api/v2/buckets?orgID={self.org_id}", 'buckets', self.name_of("bucket", app_id))
-        self.scraper_id, self.scraper_name = self._query("scrapers", "/api/v2/scrapers", 'configurations', self.name_of("scraper", app_id))
-        self.user_id, self.user_name = self._query("users", "/api/v2/users", 'users', self.name_of("user", app_id))
-        self.var_id_metrics, self.var_name_metrics = self._query("variables", "/api/v2/variables", 'variables', self.name_of("var_metrics_list", app_id))
-        self.var_id_fields, self.var_name_fields = self._query("variables", "/api/v2/variables", 'variables', self.name_of("var_fields_list", app_id))
-        self.dashboard_id, self.dashboard_name = self._query("dashboards", "/api/v2/dashboards", 'dashboards', self.dashboard_name_of(app_id))
+        if catalog is None:
+            with observe_step("find_all", "list_resources"):
+                catalog = self.resource_catalog()
+        self._find_in_catalog(app_id, catalog)
+        self.stack_id = self._find_app_stack(app_id)
+
+    # The app's stack is looked up whatever the mode: the app may have been created in the other one.
+    # A server without the stacks API (404) has none
+    def _find_app_stack(self, app_id):
+        try:
+            return self._find_stack(self.name_of("stack", app_id))
+        except ListingError as e:
+            if e.status_code != 404:
+                raise
+            self.debug(lambda: f"No stacks API, no stack for '{app_id}'")
+            return None
+
+    def _find_in_catalog(self, app_id, catalog):
+        missing = []
+        for id_attr, name_attr, what, name in self.resource_names(app_id):
+            x = catalog.lookup(what, name)
+            if x is None:
+                missing.append(f"{name} in {what}")
+                continue
+            setattr(self, id_attr, x['id'])
+            setattr(self, name_attr, x['name'])
+        if missing:
+            self.error(f"ERROR: Not found {', '.join(missing)}")
         self.info(f"    Found bucket:    {self.bucket_id}  {self.bucket_name}")
         self.info(f"    Found scraper:   {self.scraper_id}  {self.scraper_name}")
         self.info(f"    Found user:      {self.user_id}  {self.user_name}")
@@ -459,31 +961,25 @@ class InfluxdbHelper:
         self.info(f"    Found var. fields list:  {self.var_id_fields}  {self.var_name_fields}")
         self.info(f"    Found dashboard: {self.dashboard_id}  {self.dashboard_name}")
 
-    def _query(self, what, url_path, json_section, search):
-        url = f"{self.influxdb_base_url}{url_path}"
-        self.debug(f"Getting all {what}: '{url}'")
-        response = requests.get(url, headers=self.headers)
-        self.debug(f"Getting all {what}: RESPONSE: '{response}'")
-        if response.status_code == 200:
-            self.debug(f"Got all {what}!")
-            self.debug(response.json())
-            self.debug(f'JSON section to use: {json_section}')
-            self.debug(f'Searching for: {search}')
-            if response.json() and response.json()[json_section]:
-                for x in response.json()[json_section]:
-                    self.debug(f' --- Checking: {x}')
-                    if x['name'] and search in x['name']:
-                        self.debug(f' --- Found {search} : {x}')
-                        return x['id'], x['name']
-            self.error(f'ERROR: Not found {search} in {json_section}')
-            return None, None
-        else:
-            self.error(f"Error retrieving {what}: {response.text}")
+    # Adopt an existing resource with the same name, when its creation was refused as a duplicate
+    def _adopt(self, what, url_path, json_section, name, response):
+        resource_id = self._find_id(url_path, json_section, name)
+        if not resource_id:
+            self.error(f"Error creating {what}: {response.text}")
+        self.info(f"{what.capitalize()} '{name}' already exists: adopting {resource_id}")
+        return resource_id
+
+    # ID of the resource with exactly this name, or None, stopping at the first match
+    def _find_id(self, url_path, json_section, name):
+        for x in iter_listing(self.influxdb_base_url, self.headers, url_path, json_section):
+            if resource_name(x) == name:
+                return x['id']
+        return None
 
     # Debug print all variable values
     def print(self):
         for field, value in self.__dict__.items():
-            self.debug(f"-- {field} := {value}")
+            self.debug(lambda: f"-- {field} := {value}")
         # print(vars(self))
 
     def saveToFile(self, file_name):
@@ -497,6 +993,33 @@ class InfluxdbHelper:
             for field, value in dataMap.items():
                 setattr(self, field, value)
 
+    # Save / load Helper state to / from a StateStore (headers are not stored, passwords are stored apart)
+    def saveToStore(self, store, include_secrets=True):
+        # Copied first: steps running concurrently may be setting attributes
+        state = {field: value for field, value in dict(self.__dict__).items()
+                 if field not in self.STATE_SECRET_FIELDS and field not in self.STATE_EXCLUDED_FIELDS}
+        secrets = {field: getattr(self, field) for field in self.STATE_SECRET_FIELDS if hasattr(self, field)}
+        store.save(self.app_id, state, secrets if include_secrets else None)
+
+    def loadFromStore(self, store, app_id):
+        state = store.load(self.normalize_app_id(app_id))
+        if state is None:
+            return False
+        self.loadState(state)
+        for field, value in (store.load_secrets(self.app_id) or {}).items():
+            setattr(self, field, value)
+        return True
+
+    # Set the state of the helper from a stored state (without secrets)
+    def loadState(self, state):
+        for field, value in state.items():
+            setattr(self, field, value)
+        if 'provisioning_mode' not in state:
+            self.provisioning_mode = 'rest'     # Stored by an earlier version
+        if 'completed_steps' not in state:
+            # Stored by an earlier version (or recorded by the reconciler): created completely
+            self.completed_steps = [step.name for step in self.create_steps()]
+
     # Save Helper state to a file
     def serialize(self, file_name):
         # Serialize to a file
@@ -514,20 +1037,17 @@ class InfluxdbHelper:
 
     # List users
     def list_users(self):
-        url = f"{self.influxdb_base_url}/api/v2/users"
-        response = requests.get(url, headers=self.headers)
-
-        if response.status_code == 200:
-            users = response.json()['users']
-            if users:
-                self.info(f"Listing all users:")
-                for user in users:
-                    self.debug(user)
-                    self.info(f"User: {user['name']}, ID: {user['id']}")
-            else:
-                self.info("No users found.")
+        try:
+            users = list(iter_listing(self.influxdb_base_url, self.headers, "/api/v2/users", 'users'))
+        except Exception as e:
+            self.error(f"Error while fetching user list: {e}")
+        if users:
+            self.info(f"Listing all users:")
+            for user in users:
+                self.debug(user)
+                self.info(f"User: {user['name']}, ID: {user['id']}")
         else:
-            self.error(f"Error while fetching user list: {response.text}")
+            self.info("No users found.")
 
     # ----------------------------------------------------------------------
 
@@ -550,6 +1070,11 @@ if __name__ == "__main__":
     ORG_NAME = os.environ.get('INFLUXDB_ORG_NAME')  # Organization name
     ADMIN_TOKEN = os.environ.get('INFLUXDB_ADMIN_TOKEN')  # Admin token for authentication
 
+    # Bulk mode: influx_helper.py --bulk <file or -> [--operation ...] [--concurrency N] [--output ...]
+    if len(sys.argv) > 1 and sys.argv[1] == '--bulk':
+        from bulk_provision import main
+        sys.exit(main(sys.argv[2:]))
+
     APP_ID = sys.argv[1] if len(sys.argv) > 1 else datetime.datetime.now().strftime("%Y%m%d%H%M%S%f")
     # print(f" APP_ID: {APP_ID}")
     InfluxdbHelper.info(f" APP_ID: {APP_ID}")
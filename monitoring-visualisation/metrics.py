@@ -0,0 +1,53 @@
+import re
+import time
+from contextlib import contextmanager
+from prometheus_client import Counter, Gauge, Histogram
+
+# Prometheus metrics shared by the InfluxDB helper modules (exposed by the app's HTTP server on port 8000)
+
+# Organization lookup cache
+INFLUXDB_ORG_CACHE_HITS = Counter('influxdb_org_cache_hits', 'Number of organization lookups served from the cache')
+INFLUXDB_ORG_CACHE_MISSES = Counter('influxdb_org_cache_misses', 'Number of organization lookups not served from the cache')
+
+# InfluxDB REST calls
+INFLUXDB_REQUEST_SECONDS = Histogram('influxdb_request_seconds', 'Duration of InfluxDB REST calls',
+                                     ['method', 'endpoint', 'status'])
+INFLUXDB_REQUESTS_IN_FLIGHT = Gauge('influxdb_requests_in_flight', 'Number of InfluxDB REST calls in progress')
+
+# Concurrency governor of the InfluxDB REST calls
+INFLUXDB_CONCURRENCY_LIMIT = Gauge('influxdb_concurrency_limit', 'Current limit on the InfluxDB REST calls in progress')
+INFLUXDB_GOVERNOR_WAIT_SECONDS = Histogram('influxdb_governor_wait_seconds', 'Time InfluxDB REST calls waited for the concurrency governor')
+INFLUXDB_THROTTLED_RESPONSES = Counter('influxdb_throttled_responses', 'Number of InfluxDB responses asking to slow down', ['status'])
+INFLUXDB_RETRIES = Counter('influxdb_retries', 'Number of InfluxDB REST calls retried after a throttled response')
+
+# Provisioning operations (create_all, delete_all, find_all) and their steps
+STEP_BUCKETS = (.01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+PROVISIONING_STEP_SECONDS = Histogram('provisioning_step_seconds', 'Duration of each provisioning step',
+                                      ['operation', 'step'], buckets=STEP_BUCKETS)
+PROVISIONING_IN_FLIGHT = Gauge('provisioning_in_flight', 'Number of provisioning operations in progress', ['operation'])
+
+# InfluxDB IDs are 16 hex digits. They are replaced in URL paths, to keep the endpoint label bounded.
+ID_PATTERN = re.compile(r'/[0-9a-f]{16}(?=/|$)')
+
+
+def endpoint_of(url):
+    """URL path template of an InfluxDB API URL, e.g. /api/v2/dashboards/{id}/cells/{id}/view"""
+    path = url.split('://', 1)[-1]
+    path = path[path.find('/'):] if '/' in path else '/'
+    return ID_PATTERN.sub('/{id}', path.split('?', 1)[0])
+
+
+@contextmanager
+def observe_step(operation, step):
+    """Record the duration of a provisioning step."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        PROVISIONING_STEP_SECONDS.labels(operation=operation, step=step).observe(time.perf_counter() - start)
+
+
+# Reconciliation sweeps between the state store and InfluxDB
+RECONCILE_APPS = Gauge('reconcile_apps', 'Number of apps found in each state by the last reconciliation sweep', ['status'])
+RECONCILE_REPAIRS = Counter('reconcile_repairs', 'Number of reconciliation repairs', ['action', 'result'])
+RECONCILE_SWEEP_SECONDS = Gauge('reconcile_sweep_seconds', 'Duration of the last reconciliation sweep')
@@ -0,0 +1,86 @@
+import logging
+import os
+import threading
+import time
+from metrics import INFLUXDB_ORG_CACHE_HITS, INFLUXDB_ORG_CACHE_MISSES
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+class _Lookup:
+    """An in-flight lookup, which concurrent callers for the same key wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class OrgCache:
+    """Process-wide organization name -> ID cache, with a TTL and single-flight refresh on a miss."""
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl if ttl is not None else float(os.getenv("INFLUXDB_ORG_CACHE_TTL", "300"))
+        self._entries = {}      # key -> (org_id, expiry time)
+        self._lookups = {}      # key -> in-flight _Lookup
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        """Return the cached value for key, or call loader() to fetch it. Only one caller per key
+        runs loader() at a time; the others wait for its result."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                INFLUXDB_ORG_CACHE_HITS.inc()
+                return entry[0]
+            INFLUXDB_ORG_CACHE_MISSES.inc()
+            lookup = self._lookups.get(key)
+            leader = lookup is None
+            if leader:
+                lookup = self._lookups[key] = _Lookup()
+
+        if not leader:
+            lookup.done.wait()
+            if lookup.error is not None:
+                raise lookup.error
+            return lookup.value
+
+        try:
+            lookup.value = loader()
+        except Exception as e:
+            lookup.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._lookups[key]
+                if lookup.error is None:
+                    self._entries[key] = (lookup.value, time.monotonic() + self.ttl)
+            lookup.done.set()
+        return lookup.value
+
+    def peek(self, key):
+        """Return the cached value for key, or None, without looking it up (for callers which cannot
+        block, e.g. on an event loop: they look it up themselves, then put() it)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                INFLUXDB_ORG_CACHE_HITS.inc()
+                return entry[0]
+        INFLUXDB_ORG_CACHE_MISSES.inc()
+        return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
+# Shared organization cache
+ORG_CACHE = OrgCache()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from influx_helper import InfluxdbHelper
+from metrics import RECONCILE_APPS, RECONCILE_REPAIRS, RECONCILE_SWEEP_SECONDS
+from resource_catalog import resource_name
+from state_store import StateStore
+from step_executor import run_parallel
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Resource names of an app: 'neb_{app_id}_{what}', and 'Nebulous Dashboard {app_id}' for the dashboard
+APP_NAME_PATTERNS = [
+    re.compile(r'^neb_(?P<app_id>\w+?)_(?:bucket|scraper|user|var_metrics_list|var_fields_list|stack)$'),
+    re.compile(r'^Nebulous Dashboard (?P<app_id>\w+)$'),
+]
+
+# App status -> repair action (apps with other statuses are only reported)
+REPAIRS = {
+    'unrecorded': 'record',     # All resources exist, but no state is stored: store it (without a password)
+    'drifted': 'record',        # The stored IDs differ from the existing resources: update them (only them)
+    'orphaned': 'delete',       # Some resources exist, and no state is stored (e.g. a failed create): delete them
+    'stale': 'forget',          # State is stored, but no resources exist (e.g. a lost delete): remove the state
+}
+STATUSES = ('ok', 'unrecorded', 'drifted', 'orphaned', 'incomplete', 'stale')
+
+
+class Reconciler:
+    """Compare the apps in the state store with the app resources in InfluxDB, and report (and optionally
+    repair) the differences. Every resource type is listed once per sweep, and the resources are grouped
+    by app from their names. Apps are then checked and repaired in pages, with a pause between pages,
+    so that a sweep of a large instance does not crowd out message processing.
+
+    An app is repaired only if it had the same status in a sweep at least 'grace' seconds before, so that
+    apps being created or deleted at the time of the sweep are left alone."""
+
+    def __init__(self, influxdb_base_url, admin_token, org_name, store, repair=False,
+                 page_size=200, page_pause=0.5, grace=600, max_workers=2):
+        self.influxdb_base_url = influxdb_base_url
+        self.admin_token = admin_token
+        self.org_name = org_name
+        self.store = store
+        self.repair = repair
+        self.page_size = page_size
+        self.page_pause = page_pause
+        self.grace = grace
+        self.max_workers = max_workers
+        self._first_seen = {}   # (app_id, status) -> time the app was first seen with this status
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _helper(self, app_id):
+        return InfluxdbHelper(self.influxdb_base_url, self.admin_token, self.org_name, app_id)
+
+    def list_app_resources(self):
+        """List every resource type once, and group the app resources by App.Id:
+        {app_id: {id attribute: resource}}"""
+        helper = self._helper('')
+        helper.set_org()
+        catalog = helper.resource_catalog()
+        try:
+            # Stacks of the apps created in stack mode, so that they are deleted with their other resources
+            catalog.load(['stacks'])
+        except Exception as e:
+            logger.info(f"Reconcile: stacks not listed ({e})")
+        apps = {}
+        for what, items in catalog.items.items():
+            for x in items:
+                name = resource_name(x) or ''
+                for pattern in APP_NAME_PATTERNS:
+                    m = pattern.match(name)
+                    if m is None:
+                        continue
+                    app_id = m.group('app_id')
+                    for id_attr, _, expected_what, expected_name in self._resource_names(helper, app_id):
+                        if expected_what == what and expected_name == name:
+                            apps.setdefault(app_id, {}).setdefault(id_attr, x)
+                    break
+        return apps
+
+    @staticmethod
+    def _resource_names(helper, app_id):
+        return helper.resource_names(app_id) + [("stack_id", "stack_name", "stacks", helper.name_of("stack", app_id))]
+
+    @staticmethod
+    def status_of(state, resources, expected_count):
+        # The stack of an app created in stack mode is not one of the expected resources
+        count = len(set(resources) - {'stack_id'})
+        if state is None:
+            return 'unrecorded' if count == expected_count else 'orphaned'
+        if not resources:
+            return 'stale'
+        if count < expected_count:
+            return 'incomplete'
+        if any(state.get(id_attr) != x['id'] for id_attr, x in resources.items()):
+            return 'drifted'
+        return 'ok'
+
+    def sweep(self):
+        """Run one reconciliation sweep. Returns a report: {'counts': {status: n}, status: [app_id, ...]}"""
+        start = time.perf_counter()
+        apps = self.list_app_resources()
+        expected_count = len(self._helper('').resource_names(''))
+        report = {status: [] for status in STATUSES}
+        seen = set()
+
+        def pages():
+            # Apps with stored state, in App.Id order, then the apps which only have resources
+            page = []
+            for app_id, _, state in self.store.iter_states(batch_size=self.page_size):
+                page.append((app_id, state, apps.pop(app_id, {})))
+                if len(page) >= self.page_size:
+                    yield page
+                    page = []
+            for app_id in sorted(apps):
+                page.append((app_id, None, apps[app_id]))
+                if len(page) >= self.page_size:
+                    yield page
+                    page = []
+            if page:
+                yield page
+
+        for page in pages():
+            if self._stop.is_set():
+                break
+            to_repair = []
+            for app_id, state, resources in page:
+                status = self.status_of(state, resources, expected_count)
+                report[status].append(app_id)
+                if status == 'ok':
+                    continue
+                seen.add((app_id, status))
+                first_seen = self._first_seen.setdefault((app_id, status), time.monotonic())
+                logger.info(f"Reconcile: app '{app_id}' is {status} "
+                            f"(resources: {', '.join(sorted(resources)) or 'none'})")
+                if self.repair and status in REPAIRS and time.monotonic() - first_seen >= self.grace:
+                    to_repair.append((app_id, status, state, resources))
+            for (app_id, status, _, _), _, e in run_parallel(self._repair, to_repair, self.max_workers):
+                RECONCILE_REPAIRS.labels(action=REPAIRS[status], result='failed' if e else 'ok').inc()
+                if e is not None:
+                    logger.warning(f"Reconcile: could not {REPAIRS[status]} app '{app_id}': {e}")
+                else:
+                    self._first_seen.pop((app_id, status), None)
+            self._stop.wait(self.page_pause)
+
+        # Forget apps which are no longer in the same status
+        self._first_seen = {k: v for k, v in self._first_seen.items() if k in seen}
+
+        report['counts'] = {status: len(report[status]) for status in STATUSES}
+        for status, count in report['counts'].items():
+            RECONCILE_APPS.labels(status=status).set(count)
+        elapsed = time.perf_counter() - start
+        RECONCILE_SWEEP_SECONDS.set(elapsed)
+        logger.info(f"Reconcile sweep done in {elapsed:.3f}s: "
+                    + ", ".join(f"{status}={count}" for status, count in report['counts'].items()))
+        return report
+
+    def _repair(self, item):
+        app_id, status, state, resources = item
+        action = REPAIRS[status]
+        if action == 'forget':
+            self.store.delete(app_id)
+        elif action == 'record' and state is not None:
+            # Only the re-discovered IDs are written: the rest of the state, and the secrets, are kept
+            if not self.store.update(app_id, {id_attr: x['id'] for id_attr, x in resources.items()}):
+                raise Exception("its state was deleted meanwhile")
+        elif action == 'record':
+            helper = self._helper(app_id)
+            if 'stack_id' in resources:
+                helper.provisioning_mode = 'stack'
+            helper.completed_steps = [step.name for step in helper.create_steps()]  # All resources exist
+            for id_attr, x in resources.items():
+                setattr(helper, id_attr, x['id'])
+            helper.set_org()
+            helper.saveToStore(self.store, include_secrets=False)
+        elif action == 'delete':
+            self._delete_resources(app_id, resources)
+        logger.info(f"Reconcile: {action} app '{app_id}' ({status}): done")
+
+    def _delete_resources(self, app_id, resources):
+        helper = self._helper(app_id)
+        for id_attr, x in resources.items():
+            if id_attr != 'stack_id':
+                setattr(helper, id_attr, x['id'])
+        # Resources without an ID are skipped by delete_all. Each resource is deleted, also those of a
+        # stack (which may not hold all of them, e.g. after a failed apply), and then the stack
+        failed = helper.failed_steps(helper.delete_all())
+        if failed:
+            raise Exception(f"Could not delete: {', '.join(failed)}")
+        if 'stack_id' in resources:
+            helper.set_org()
+            helper.stack_id = resources['stack_id']['id']
+            helper.delete_stack()
+
+    def start(self, interval):
+        """Sweep now, and then every interval seconds, in a background thread."""
+        def run():
+            while not self._stop.is_set():
+                try:
+                    self.sweep()
+                except Exception as e:
+                    logger.error(f"Reconcile sweep failed: {e}", exc_info=True)
+                self._stop.wait(interval)
+        self._thread = threading.Thread(target=run, name="reconciler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reconcile the app state store with the app resources in InfluxDB")
+    parser.add_argument('--db', default=None, help="State database file (default: STATE_DB_FILE or app-states/state.db)")
+    parser.add_argument('--repair', action='store_true', help="Repair orphaned, unrecorded, drifted and stale apps (default: report only)")
+    parser.add_argument('--grace', type=float, default=0, help="Only repair apps seen with the same status this many seconds before (default: 0)")
+    parser.add_argument('--page-size', type=int, default=200)
+    parser.add_argument('--log-level', default='INFO')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level.upper(), stream=sys.stderr,
+                        format="%(asctime)s - %(levelname)s - %(message)s")
+
+    store = StateStore(args.db)
+    reconciler = Reconciler(os.environ.get('INFLUXDB_URL'),
+                            os.environ.get('INFLUXDB_ADMIN_TOKEN'),
+                            os.environ.get('INFLUXDB_ORG_NAME'),
+                            store, repair=args.repair, page_size=args.page_size, page_pause=0, grace=args.grace)
+    try:
+        report = reconciler.sweep()
+    finally:
+        store.close()
+    print(json.dumps({status: report[status] for status in STATUSES if status != 'ok'} | {'counts': report['counts']}, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
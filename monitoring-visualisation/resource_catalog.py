@@ -0,0 +1,280 @@
+import codecs
+import json
+import logging
+import re
+from urllib.parse import urlsplit, parse_qsl, urlencode, urlunsplit
+from influx_client import get_client
+from step_executor import gather_parallel, run_parallel
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+# A streamed listing stopped early reads the rest of its page up to this size, so that its connection goes
+# back to the pool (reconnecting costs more than reading it); a larger rest closes the connection instead
+DRAIN_MAX_BYTES = 256 * 1024
+
+
+class ListingError(Exception):
+    """Raised when a listing request is refused. Carries the HTTP status (e.g. 404 without the API)."""
+
+    def __init__(self, json_section, status_code, text):
+        self.status_code = status_code
+        super().__init__(f"Error retrieving {json_section}: {text}")
+
+
+def resource_name(x):
+    """Name of a listed resource. A stack has no name of its own: its name is that of its latest event."""
+    if x.get('name'):
+        return x['name']
+    events = x.get('events') or []
+    return events[-1].get('name') if events else None
+
+
+def iter_listing(influxdb_base_url, headers, url_path, json_section, page_size=100, stream=True):
+    """Yield the items of an InfluxDB listing endpoint, following 'links.next' across pages.
+    With stream, responses are parsed as they are received, one item at a time, so a caller that stops
+    early (e.g. at the first name match) does not decode the rest of the listing, nor request its next pages
+    (the rest of the page is read up to DRAIN_MAX_BYTES, to reuse the connection). Without,
+    each page is decoded at once, which is faster for callers that consume whole listings."""
+    url = _with_limit(f"{influxdb_base_url}{url_path}", page_size)
+    seen = set()
+    while url and url not in seen:
+        seen.add(url)
+        response = get_client().get(url, headers=headers, stream=stream)
+        chunks = None
+        try:
+            if response.status_code != 200:
+                raise ListingError(json_section, response.status_code, response.text)
+            others = {}
+            count = 0
+            if stream:
+                chunks = response.iter_content(CHUNK_SIZE)
+                for item in iter_json_section(chunks, json_section, others):
+                    count += 1
+                    yield item
+            else:
+                others = response.json() or {}
+                items = others.get(json_section) or []
+                count = len(items)
+                yield from items
+        finally:
+            if chunks is not None:
+                _drain(chunks)
+            response.close()    # Releases the connection if the body was read to the end, else closes it
+        next_link = (others.get('links') or {}).get('next')
+        url = f"{influxdb_base_url}{next_link}" if next_link and count else None
+
+
+def _drain(chunks):
+    """Read the rest of a streamed body, up to DRAIN_MAX_BYTES."""
+    read = 0
+    try:
+        for chunk in chunks:
+            read += len(chunk)
+            if read > DRAIN_MAX_BYTES:
+                return
+    except Exception:
+        pass                # The connection is closed with the response
+
+
+async def aiter_listing(client, influxdb_base_url, headers, url_path, json_section, page_size=100):
+    """iter_listing for an event loop, over an async client (see async_influx). Each page is read and decoded
+    at once; a caller that stops early (e.g. at the first name match) does not request the next pages."""
+    url = _with_limit(f"{influxdb_base_url}{url_path}", page_size)
+    seen = set()
+    while url and url not in seen:
+        seen.add(url)
+        response = await client.get(url, headers=headers)
+        if response.status_code != 200:
+            raise ListingError(json_section, response.status_code, response.text)
+        data = response.json() or {}
+        items = data.get(json_section) or []
+        for item in items:
+            yield item
+        next_link = (data.get('links') or {}).get('next')
+        url = f"{influxdb_base_url}{next_link}" if next_link and items else None
+
+
+def iter_json_section(chunks, section, others=None):
+    """Incrementally parse a JSON object from an iterable of byte chunks, yielding the elements of its
+    'section' array one at a time. The other top-level values are decoded into the others dict
+    (when the section comes first, they are only complete once all its elements have been consumed)."""
+    parser = _ChunkParser(chunks)
+    parser.expect('{')
+    if parser.peek() == '}':
+        return
+    while True:
+        key = parser.value()
+        parser.expect(':')
+        if key == section and parser.peek() == '[':
+            yield from parser.array()
+        else:
+            value = parser.value()
+            if others is not None:
+                others[key] = value
+        if parser.expect(',}') == '}':
+            return
+
+
+class _ChunkParser:
+    """Minimal pull parser over a stream of JSON text, decoding one value at a time with the C decoder."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._scan = json.JSONDecoder().scan_once     # (value, end) = scan(text, index), or StopIteration
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        """Read the next chunk into the buffer. Returns False at the end of the stream."""
+        if self._eof:
+            return False
+        # Drop the consumed text, so that the buffer does not grow with the whole document
+        self._buf, self._pos = self._buf[self._pos:], 0
+        for chunk in self._chunks:
+            if chunk:
+                self._buf += self._decoder.decode(chunk)
+                return True
+        self._buf += self._decoder.decode(b'', final=True)
+        self._eof = True
+        return False
+
+    def peek(self):
+        """The next non-whitespace character (not consumed), or '' at the end of the stream."""
+        while True:
+            self._pos = _SKIP_WHITESPACE(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        """Consume the next non-whitespace character, which must be one of chars, and return it."""
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError(f"Invalid JSON listing: expected one of '{chars}', got '{c}'")
+        self._pos += 1
+        return c
+
+    def value(self):
+        """Decode and consume the next JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self._scan(self._buf, self._pos)
+                # A value ending at the end of the buffer may be cut short (e.g. a number): read on to be sure
+                if end < len(self._buf) or self._eof:
+                    self._pos = end
+                    return value
+            except (StopIteration, json.JSONDecodeError):
+                if self._eof:
+                    raise ValueError(f"Invalid JSON listing: no complete value at the end of the stream")
+            self._fill()
+
+    def array(self):
+        """Yield the elements of the next JSON array, decoding them one at a time."""
+        self.expect('[')
+        if self.peek() == ']':
+            self._pos += 1
+            return
+        scan = self._scan
+        while True:
+            # Fast path: the element and the separator after it are in the buffer
+            try:
+                value, end = scan(self._buf, self._pos)
+                m = _SEPARATOR(self._buf, end)
+            except (StopIteration, json.JSONDecodeError):
+                m = None
+            if m is None:
+                value = self.value()
+                c = self.expect(',]')
+                self.peek()
+            else:
+                self._pos = m.end()
+                c = m.group(1)
+            yield value
+            if c == ']':
+                return
+
+
+_SKIP_WHITESPACE = re.compile(r'[ \t\n\r]*').match
+_SEPARATOR = re.compile(r'[ \t\n\r]*([,\]])[ \t\n\r]*').match
+
+
+def _with_limit(url, page_size):
+    """Ask for the largest page size, keeping the other query parameters."""
+    parts = urlsplit(url)
+    query = dict(parse_qsl(parts.query))
+    query.setdefault('limit', str(page_size))
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+class ResourceCatalog:
+    """Snapshot of the InfluxDB resources used by apps, with exact-name indexes.
+    Each resource type is listed once (all pages), and the catalog can then be queried for any number of apps."""
+
+    # Resource type -> (listing path, JSON section). Buckets are listed for the org only, as before.
+    RESOURCE_TYPES = {
+        'buckets': ('/api/v2/buckets?orgID={org_id}', 'buckets'),
+        'scrapers': ('/api/v2/scrapers', 'configurations'),
+        'users': ('/api/v2/users', 'users'),
+        'variables': ('/api/v2/variables', 'variables'),
+        'dashboards': ('/api/v2/dashboards', 'dashboards'),
+        'stacks': ('/api/v2/stacks?orgID={org_id}', 'stacks'),
+    }
+    # Listed by default (stacks only on request: not every server has the stacks API)
+    DEFAULT_TYPES = ('buckets', 'scrapers', 'users', 'variables', 'dashboards')
+
+    def __init__(self, influxdb_base_url, headers, org_id, resource_types=None, max_workers=5, load=True):
+        self.influxdb_base_url = influxdb_base_url
+        self.headers = headers
+        self.org_id = org_id
+        self.items = {}     # Resource type -> list of resources
+        self.by_name = {}   # Resource type -> {name: resource}. The first resource wins for duplicate names.
+        if load:
+            self.load(resource_types or list(self.DEFAULT_TYPES), max_workers)
+
+    def load(self, resource_types, max_workers=5):
+        """(Re)list the given resource types, concurrently."""
+        for what, items, e in run_parallel(self._list, resource_types, max_workers):
+            if e is not None:
+                raise e
+            self.index(what, items)
+
+    async def aload(self, client, resource_types=None):
+        """load() for an event loop, over an async client: the resource types are listed concurrently."""
+        resource_types = resource_types or list(self.DEFAULT_TYPES)
+
+        async def list_type(what):
+            url_path, json_section = self.RESOURCE_TYPES[what]
+            return [x async for x in aiter_listing(client, self.influxdb_base_url, self.headers,
+                                                   url_path.format(org_id=self.org_id), json_section)]
+
+        for what, items, e in await gather_parallel(list_type, resource_types, len(resource_types)):
+            if e is not None:
+                raise e
+            self.index(what, items)
+        return self
+
+    def index(self, what, items):
+        """Set the listed resources of a type (e.g. listed by another client)."""
+        self.items[what] = items
+        index = {}
+        for x in items:
+            name = resource_name(x)
+            if name:
+                index.setdefault(name, x)
+        self.by_name[what] = index
+        logger.debug(f"Catalog: {len(items)} {what}")
+
+    def _list(self, what):
+        url_path, json_section = self.RESOURCE_TYPES[what]
+        return list(iter_listing(self.influxdb_base_url, self.headers, url_path.format(org_id=self.org_id), json_section,
+                                 stream=False))
+
+    def lookup(self, what, name):
+        """Return the resource of the given type with exactly this name, or None."""
+        return self.by_name[what].get(name)
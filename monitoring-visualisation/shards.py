@@ -0,0 +1,150 @@
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+import urllib.request
+import zlib
+from prometheus_client import CollectorRegistry, Counter, Metric, start_http_server
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.parser import text_string_to_metric_families
+from proton import Data, Terminus, symbol
+from proton.reactor import ReceiverOption
+from step_executor import run_parallel
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+def shard_of(key, shard_count):
+    """Consumer process (shard) of a partition key. Messages without a key go to shard 0.
+    The key is salted, so that the worker picked in the shard (crc32 of the key) stays spread out."""
+    if key is None or shard_count <= 1:
+        return 0
+    return zlib.crc32(f"shard:{key}".encode()) % shard_count
+
+
+class SharedSubscription(ReceiverOption):
+    """Receiver option for a durable subscription shared by all consumers using the same link name: the broker
+    hands each message of the topic to one of them (the 'shared' and 'global' source capabilities, as used by
+    JMS 2 shared durable subscriptions on ActiveMQ Artemis)."""
+
+    def apply(self, receiver):
+        receiver.source.durability = Terminus.DELIVERIES
+        receiver.source.expiry_policy = Terminus.EXPIRE_NEVER
+        capabilities = receiver.source.capabilities
+        capabilities.put_array(False, Data.SYMBOL)
+        capabilities.enter()
+        capabilities.put_symbol(symbol('shared'))
+        capabilities.put_symbol(symbol('global'))
+        capabilities.exit()
+
+
+class ShardMetricsCollector:
+    """Collects the metrics of the consumer processes from their local HTTP servers, with a 'shard' label."""
+
+    def __init__(self, ports, timeout=2.0):
+        self.ports = ports          # Metrics port of each shard
+        self.timeout = timeout
+
+    def describe(self):
+        return []   # Not known before the shards are scraped
+
+    def _scrape(self, shard):
+        url = f"http://127.0.0.1:{self.ports[shard]}/metrics"
+        with urllib.request.urlopen(url, timeout=self.timeout) as response:
+            return list(text_string_to_metric_families(response.read().decode('utf-8')))
+
+    def collect(self):
+        up = GaugeMetricFamily('shard_up', 'Whether the metrics of a consumer process could be scraped', labels=['shard'])
+        merged = {}     # Metric name -> metric with the samples of all shards
+        for shard, families, e in run_parallel(self._scrape, range(len(self.ports)), len(self.ports)):
+            up.add_metric([str(shard)], 0 if e else 1)
+            if e is not None:
+                logger.debug(f"Could not scrape the metrics of shard {shard}: {e}")
+                continue
+            for family in families:
+                metric = merged.get(family.name)
+                if metric is None:
+                    metric = merged[family.name] = Metric(family.name, family.documentation, family.type, family.unit)
+                for sample in family.samples:
+                    metric.add_sample(sample.name, dict(sample.labels, shard=str(shard)), sample.value, sample.timestamp)
+        yield up
+        yield from merged.values()
+
+
+# Served by the supervisor only, with the metrics of the shards
+SHARD_RESTARTS = Counter('shard_restarts', 'Number of times a consumer process was restarted', ['shard'], registry=None)
+
+
+class ShardSupervisor:
+    """Runs shard_count consumer processes (the given command, with SHARD_INDEX, SHARD_COUNT and METRICS_PORT
+    set in its environment), restarts the ones which exit, and serves the metrics of all of them on
+    metrics_port. The consumers serve their own metrics on the following ports, on the loopback interface.
+    SIGTERM or SIGINT stop the consumers gracefully (SIGINT), then the supervisor."""
+
+    def __init__(self, shard_count, command, metrics_port=8000, restart_delay=5, max_restart_delay=60, stop_timeout=30):
+        self.shard_count = shard_count
+        self.command = command
+        self.metrics_port = metrics_port
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.stop_timeout = stop_timeout
+        self.processes = [None] * shard_count
+        self._delays = [restart_delay / 2] * shard_count    # Restart delay of each shard, doubled while it keeps failing
+        self._stop = threading.Event()
+
+    def port_of(self, shard):
+        return self.metrics_port + 1 + shard
+
+    def _spawn(self, shard):
+        env = dict(os.environ, SHARD_INDEX=str(shard), SHARD_COUNT=str(self.shard_count),
+                   METRICS_PORT=str(self.port_of(shard)))
+        self.processes[shard] = subprocess.Popen(self.command, env=env)
+        logger.info(f"Started consumer process of shard {shard}/{self.shard_count}: pid {self.processes[shard].pid}")
+
+    def run(self):
+        registry = CollectorRegistry()
+        registry.register(ShardMetricsCollector([self.port_of(shard) for shard in range(self.shard_count)]))
+        registry.register(SHARD_RESTARTS)
+        start_http_server(self.metrics_port, registry=registry)
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, lambda signum, frame: self._stop.set())
+
+        started_at = [time.monotonic()] * self.shard_count
+        restart_at = [None] * self.shard_count
+        for shard in range(self.shard_count):
+            self._spawn(shard)
+        while not self._stop.wait(1):
+            now = time.monotonic()
+            for shard, process in enumerate(self.processes):
+                if restart_at[shard] is not None:
+                    if now >= restart_at[shard]:
+                        restart_at[shard] = None
+                        SHARD_RESTARTS.labels(shard=str(shard)).inc()
+                        self._spawn(shard)
+                        started_at[shard] = now
+                elif process.poll() is not None:
+                    # Back off while a shard keeps failing soon after it is started
+                    quick = now - started_at[shard] < self.max_restart_delay
+                    self._delays[shard] = min(self.max_restart_delay, self._delays[shard] * 2) if quick else self.restart_delay
+                    restart_at[shard] = now + self._delays[shard]
+                    logger.error(f"Consumer process of shard {shard} exited ({process.returncode}): "
+                                 f"restarting it in {self._delays[shard]}s")
+        self.stop()
+        return 0
+
+    def stop(self):
+        logger.info(f"Stopping {self.shard_count} consumer process(es)...")
+        running = [p for p in self.processes if p is not None and p.poll() is None]
+        for process in running:
+            process.send_signal(signal.SIGINT)     # Handled by the subscriber as a graceful shutdown
+        deadline = time.monotonic() + self.stop_timeout
+        for process in running:
+            try:
+                process.wait(max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                logger.warning(f"Consumer process {process.pid} did not stop in time: killing it")
+                process.kill()
+                process.wait()
@@ -0,0 +1,113 @@
+import re
+
+# Builds InfluxDB template manifests (the format of 'influx apply' and /api/v2/templates/apply) from the
+# same data as the REST provisioning: the bucket, the two variables, and the dashboard with its cells,
+# whose views come from the chart templates. Users, scrapers and authorizations cannot be templated.
+
+API_VERSION = 'influxdata.com/v2alpha1'
+
+# Cell view type -> template chart kind
+CHART_KINDS = {
+    'xy': 'Xy',
+    'gauge': 'Gauge',
+    'markdown': 'Markdown',
+    'single-stat': 'Single_Stat',
+    'line-plus-single-stat': 'Single_Stat_Plus_Line',
+    'table': 'Table',
+    'histogram': 'Histogram',
+    'heatmap': 'Heatmap',
+    'scatter': 'Scatter',
+    'band': 'Band',
+    'mosaic': 'Mosaic',
+}
+
+# Cell view property -> template chart field, for the properties which are copied as they are
+CHART_FIELDS = {
+    'note': 'note',
+    'showNoteWhenEmpty': 'noteOnEmpty',
+    'geom': 'geom',
+    'xColumn': 'xCol',
+    'yColumn': 'yCol',
+    'position': 'position',
+    'prefix': 'prefix',
+    'suffix': 'suffix',
+    'tickPrefix': 'tickPrefix',
+    'tickSuffix': 'tickSuffix',
+    'hoverDimension': 'hoverDimension',
+    'legendColorizeRows': 'legendColorizeRows',
+    'legendHide': 'legendHide',
+    'legendOpacity': 'legendOpacity',
+    'legendOrientationThreshold': 'legendOrientationThreshold',
+    'staticLegend': 'staticLegend',
+}
+
+COLOR_FIELDS = ('id', 'name', 'type', 'hex', 'value')
+AXIS_FIELDS = ('label', 'prefix', 'suffix', 'base', 'scale')
+
+
+def meta_name(name):
+    """Template object name (metadata.name) of a resource name: lowercase letters, digits and dashes."""
+    return re.sub(r'[^a-z0-9]+', '-', name.lower()).strip('-')[:63]
+
+
+def _entry(kind, name, spec):
+    return {'apiVersion': API_VERSION, 'kind': kind, 'metadata': {'name': meta_name(name)}, 'spec': spec}
+
+
+def bucket_entry(name, retention):
+    return _entry('Bucket', name, {
+        'name': name,
+        'retentionRules': [{'type': 'expire', 'everySeconds': retention}],
+    })
+
+
+def variable_entry(name, query):
+    return _entry('Variable', name, {
+        'name': name,
+        'type': 'query',
+        'language': 'flux',
+        'query': query,
+    })
+
+
+def dashboard_entry(name, description, charts):
+    return _entry('Dashboard', name, {
+        'name': name,
+        'description': description or '',
+        'charts': charts,
+    })
+
+
+def chart_of(cell, view):
+    """Template chart of a dashboard template cell (position and size) and its view (name and properties)."""
+    properties = view.get('properties') or {}
+    kind = CHART_KINDS.get(properties.get('type'))
+    if kind is None:
+        raise ValueError(f"Cell '{view.get('name')}': view type '{properties.get('type')}' cannot be templated")
+    chart = {
+        'kind': kind,
+        'name': view.get('name'),
+        'xPos': cell.get('x', 0),
+        'yPos': cell.get('y', 0),
+        'width': cell.get('w', 1),
+        'height': cell.get('h', 1),
+    }
+    queries = [q.get('text') for q in properties.get('queries') or [] if q.get('text')]
+    if queries:
+        chart['queries'] = [{'query': q} for q in queries]
+    colors = properties.get('colors') or []
+    if colors:
+        chart['colors'] = [{k: c[k] for k in COLOR_FIELDS if k in c} for c in colors]
+    for field, chart_field in CHART_FIELDS.items():
+        if properties.get(field) is not None:
+            chart[chart_field] = properties[field]
+    decimal_places = properties.get('decimalPlaces')
+    if decimal_places:
+        chart['decimalPlaces'] = decimal_places.get('digits', 0)
+        chart['enforceDecimals'] = bool(decimal_places.get('isEnforced'))
+    axes = properties.get('axes') or {}
+    if axes:
+        chart['axes'] = [dict({k: a[k] for k in AXIS_FIELDS if a.get(k) is not None}, name=axis,
+                              domain=[float(b) for b in a.get('bounds') or [] if b not in ('', None)])
+                         for axis, a in axes.items()]
+    return chart
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+import argparse
+import glob
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+import yaml
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS app_state (
+    app_id     TEXT PRIMARY KEY,
+    updated_at REAL NOT NULL,
+    state      TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS app_state_updated_at ON app_state (updated_at);
+CREATE TABLE IF NOT EXISTS app_secret (
+    app_id     TEXT PRIMARY KEY REFERENCES app_state (app_id) ON DELETE CASCADE,
+    secrets    TEXT NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+class StateStore:
+    """Embedded (SQLite) store of per-app state: resource names and IDs, keyed by the normalized App.Id.
+    Secrets (e.g. user passwords) are kept in a separate table, so that state can be listed, swept or
+    exported without them. Every save is a single transaction."""
+
+    def __init__(self, db_file=None):
+        self.db_file = db_file or os.getenv("STATE_DB_FILE", "app-states/state.db")
+        if self.db_file != ':memory:':
+            os.makedirs(os.path.dirname(self.db_file) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(self.db_file, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("PRAGMA foreign_keys=ON")
+            self._conn.executescript(SCHEMA)
+        if self.db_file != ':memory:':
+            os.chmod(self.db_file, 0o600)   # It holds the user passwords
+        logger.debug(f"State store: {self.db_file}")
+
+    def _transaction(self, statements):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for sql, params in statements:
+                    self._conn.execute(sql, params)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def save(self, app_id, state, secrets=None):
+        """Insert or update the state (and, if given, the secrets) of an app, atomically. Stored secrets are
+        kept when none are given (an upsert, not a REPLACE, which would delete them by cascade)."""
+        statements = [("INSERT INTO app_state (app_id, updated_at, state) VALUES (?, ?, ?) "
+                       "ON CONFLICT (app_id) DO UPDATE SET updated_at = excluded.updated_at, state = excluded.state",
+                       (app_id, time.time(), json.dumps(state, default=str)))]
+        if secrets is not None:
+            statements.append(("INSERT INTO app_secret (app_id, secrets) VALUES (?, ?) "
+                               "ON CONFLICT (app_id) DO UPDATE SET secrets = excluded.secrets",
+                               (app_id, json.dumps(secrets))))
+        self._transaction(statements)
+
+    def update(self, app_id, changes):
+        """Set some fields of the stored state of an app, keeping the others (read and written in one
+        transaction). Returns False if there is no state (e.g. the app was deleted meanwhile)."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT state FROM app_state WHERE app_id = ?", (app_id,)).fetchone()
+                if row is not None:
+                    state = dict(json.loads(row[0]), **changes)
+                    self._conn.execute("UPDATE app_state SET updated_at = ?, state = ? WHERE app_id = ?",
+                                       (time.time(), json.dumps(state, default=str), app_id))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return row is not None
+
+    def load(self, app_id):
+        """Return the state of an app, or None if there is none."""
+        with self._lock:
+            row = self._conn.execute("SELECT state FROM app_state WHERE app_id = ?", (app_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def load_secrets(self, app_id):
+        """Return the secrets of an app, or None if there are none."""
+        with self._lock:
+            row = self._conn.execute("SELECT secrets FROM app_secret WHERE app_id = ?", (app_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def delete(self, app_id):
+        """Remove the state and secrets of an app. Returns True if there was any."""
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM app_state WHERE app_id = ?", (app_id,))
+        return cursor.rowcount > 0
+
+    def __contains__(self, app_id):
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM app_state WHERE app_id = ?", (app_id,)).fetchone() is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM app_state").fetchone()[0]
+
+    def iter_states(self, start=None, end=None, updated_before=None, batch_size=500):
+        """Yield (app_id, updated_at, state) for apps with start <= app_id < end (either bound optional),
+        and optionally not updated since updated_before, in App.Id order. Rows are read in batches,
+        so the store stays usable (and writable) during a long sweep."""
+        after = None
+        while True:
+            conditions, params = [], []
+            if after is not None:
+                conditions.append("app_id > ?")
+                params.append(after)
+            elif start is not None:
+                conditions.append("app_id >= ?")
+                params.append(start)
+            if end is not None:
+                conditions.append("app_id < ?")
+                params.append(end)
+            if updated_before is not None:
+                conditions.append("updated_at < ?")
+                params.append(updated_before)
+            where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+            with self._lock:
+                rows = self._conn.execute(f"SELECT app_id, updated_at, state FROM app_state {where} "
+                                          f"ORDER BY app_id LIMIT ?", params + [batch_size]).fetchall()
+            for app_id, updated_at, state in rows:
+                yield app_id, updated_at, json.loads(state)
+            if len(rows) < batch_size:
+                return
+            after = rows[-1][0]
+
+    def import_yaml_files(self, directory='app-states', secret_fields=('user_password',), excluded_fields=('headers',)):
+        """One-off import of the per-app 'state-*.yaml' files written by earlier versions. Existing
+        entries are not overwritten. The YAML files are left in place. Returns the number imported."""
+        imported = 0
+        for file_name in sorted(glob.glob(os.path.join(directory, 'state-*.yaml'))):
+            try:
+                with open(file_name, 'r') as infile:
+                    data = yaml.safe_load(infile) or {}
+                app_id = data.get('app_id')
+                if not app_id:
+                    logger.warning(f"Skipping '{file_name}': no app_id")
+                    continue
+                if app_id in self:
+                    logger.debug(f"Skipping '{file_name}': '{app_id}' is already in the store")
+                    continue
+                state = {k: v for k, v in data.items() if k not in secret_fields and k not in excluded_fields}
+                secrets = {k: v for k, v in data.items() if k in secret_fields}
+                self.save(app_id, state, secrets)
+                imported += 1
+            except Exception as e:
+                logger.error(f"Could not import '{file_name}': {e}")
+        logger.info(f"Imported {imported} app state file(s) from '{directory}' into '{self.db_file}'")
+        return imported
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="App state store maintenance")
+    parser.add_argument('--db', default=None, help="State database file (default: STATE_DB_FILE or app-states/state.db)")
+    parser.add_argument('--import-yaml', metavar='DIR', help="Import the state-*.yaml files of this directory")
+    parser.add_argument('--list', action='store_true', help="Print the stored app states (without secrets) as JSON lines")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr, format="%(asctime)s - %(levelname)s - %(message)s")
+    store = StateStore(args.db)
+    try:
+        if args.import_yaml:
+            store.import_yaml_files(args.import_yaml)
+        if args.list:
+            for app_id, updated_at, state in store.iter_states():
+                print(json.dumps({'app_id': app_id, 'updated_at': updated_at, 'state': state}, default=str))
+    finally:
+        store.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
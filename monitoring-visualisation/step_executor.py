@@ -0,0 +1,213 @@
+import asyncio
+import contextvars
+import inspect
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import tracing
+from metrics import observe_step
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+class Step:
+    """A named unit of work, which can start once all the steps it requires have completed."""
+
+    def __init__(self, name, func, requires=()):
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+
+    def __repr__(self):
+        return f"Step({self.name!r}, requires={list(self.requires)})"
+
+
+class StepExecutor:
+    """Run a dependency graph of steps, starting each step as soon as its inputs are ready."""
+
+    def __init__(self, max_workers=None, operation="create"):
+        self.max_workers = max_workers or int(os.getenv("PROVISIONING_PARALLELISM", "4"))
+        self.operation = operation  # Label of the step duration metrics
+        self.timings = {}   # Step name -> duration in seconds
+        self.results = {}   # Step name -> value returned by the step
+        self.errors = {}    # Step name -> exception raised by the step
+
+    @staticmethod
+    def _check_graph(steps):
+        """Validate step names and dependencies, and reject cycles."""
+        by_name = {}
+        for step in steps:
+            if step.name in by_name:
+                raise ValueError(f"Duplicate step name: {step.name}")
+            by_name[step.name] = step
+        for step in steps:
+            for dep in step.requires:
+                if dep not in by_name:
+                    raise ValueError(f"Step '{step.name}' requires unknown step '{dep}'")
+
+        # Kahn's algorithm: all steps must be reachable in topological order
+        remaining = {s.name: len(set(s.requires)) for s in steps}
+        dependents = {s.name: [] for s in steps}
+        for step in steps:
+            for dep in set(step.requires):
+                dependents[dep].append(step.name)
+        ready = [name for name, count in remaining.items() if count == 0]
+        visited = 0
+        while ready:
+            name = ready.pop()
+            visited += 1
+            for child in dependents[name]:
+                remaining[child] -= 1
+                if remaining[child] == 0:
+                    ready.append(child)
+        if visited != len(steps):
+            raise ValueError("Step dependencies contain a cycle")
+        return by_name, dependents
+
+    def _run_step(self, step):
+        start = time.perf_counter()
+        try:
+            with observe_step(self.operation, step.name), tracing.span(step.name):
+                return step.func()
+        finally:
+            self.timings[step.name] = time.perf_counter() - start
+
+    def run(self, steps, completed=(), on_step_done=None, keep_going=False):
+        """Run all steps, except the already completed ones. On the first failure no further steps are
+        started, and the error is re-raised once the steps already running have finished.
+        With keep_going, a failed step counts as finished for the steps depending on it, all steps are run,
+        and the errors are left in self.errors instead of being raised.
+        on_step_done(name) is called as each step completes (from the calling thread, one at a time).
+        Returns the per-step timings."""
+        by_name, dependents = self._check_graph(steps)
+        completed = set(completed)
+        waiting = {s.name: set(s.requires) - completed for s in steps if s.name not in completed}
+        error = None
+
+        with tracing.span(self.operation), \
+                ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="step") as pool:
+            running = {}
+
+            def submit_ready():
+                for name in [n for n, deps in waiting.items() if not deps]:
+                    del waiting[name]
+                    # Steps run in the trace (span) of the caller
+                    future = pool.submit(contextvars.copy_context().run, self._run_step, by_name[name])
+                    running[future] = name
+
+            submit_ready()
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    e = self._step_done(running.pop(future), future.result, dependents, waiting,
+                                        on_step_done, keep_going)
+                    error = error or e
+                if error is None or keep_going:
+                    submit_ready()
+
+        return self._finish(error, waiting, keep_going)
+
+    def _step_done(self, name, get_result, dependents, waiting, on_step_done, keep_going):
+        """Record the outcome of a finished step, and release the steps waiting for it (unless it failed,
+        without keep_going). Returns the error of the step, if any."""
+        try:
+            self.results[name] = get_result()
+            if on_step_done is not None:
+                on_step_done(name)
+        except Exception as e:
+            logger.error(f"Step '{name}' failed after {self.timings.get(name, 0):.3f}s: {e}")
+            self.errors[name] = e
+            if not keep_going:
+                return e
+        else:
+            logger.debug(f"Step '{name}' completed in {self.timings[name]:.3f}s")
+        for child in dependents[name]:
+            waiting[child].discard(name)
+        return self.errors.get(name)
+
+    def _finish(self, error, waiting, keep_going):
+        if error is not None and not keep_going:
+            if waiting:
+                logger.warning(f"Steps not started due to an earlier failure: {sorted(waiting)}")
+            raise error
+        return self.timings
+
+
+class AsyncStepExecutor(StepExecutor):
+    """StepExecutor for an event loop: steps run as tasks of the running loop (at most max_workers at a time),
+    and a step function may return an awaitable, which is awaited. Same semantics as StepExecutor.run."""
+
+    async def _run_step(self, step, semaphore):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                with observe_step(self.operation, step.name), tracing.span(step.name):
+                    result = step.func()
+                    if inspect.isawaitable(result):
+                        result = await result
+                    return result
+            finally:
+                self.timings[step.name] = time.perf_counter() - start
+
+    async def run(self, steps, completed=(), on_step_done=None, keep_going=False):
+        by_name, dependents = self._check_graph(steps)
+        completed = set(completed)
+        waiting = {s.name: set(s.requires) - completed for s in steps if s.name not in completed}
+        error = None
+        semaphore = asyncio.Semaphore(self.max_workers)
+        running = {}
+
+        def submit_ready():
+            for name in [n for n, deps in waiting.items() if not deps]:
+                del waiting[name]
+                running[asyncio.ensure_future(self._run_step(by_name[name], semaphore))] = name
+
+        with tracing.span(self.operation):     # Tasks run in the trace (span) they are created in
+            try:
+                submit_ready()
+                while running:
+                    done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        e = self._step_done(running.pop(task), task.result, dependents, waiting,
+                                            on_step_done, keep_going)
+                        error = error or e
+                    if error is None or keep_going:
+                        submit_ready()
+            finally:
+                for task in running:    # Only when cancelled
+                    task.cancel()
+
+        return self._finish(error, waiting, keep_going)
+
+
+def run_parallel(func, items, max_workers):
+    """Call func on every item using at most max_workers threads.
+    Returns a list of (item, result, error) tuples, in the order of the items."""
+    items = list(items)
+    if not items:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items))), thread_name_prefix="parallel") as pool:
+        futures = [pool.submit(contextvars.copy_context().run, func, item) for item in items]
+    outcomes = []
+    for item, future in zip(items, futures):
+        try:
+            outcomes.append((item, future.result(), None))
+        except Exception as e:
+            outcomes.append((item, None, e))
+    return outcomes
+
+
+async def gather_parallel(func, items, limit):
+    """Await func(item) for every item, with at most limit calls in progress at a time, on the running loop.
+    Returns a list of (item, result, error) tuples, in the order of the items (as run_parallel)."""
+    semaphore = asyncio.Semaphore(max(1, limit))
+
+    async def call(item):
+        async with semaphore:
+            return await func(item)
+
+    items = list(items)
+    results = await asyncio.gather(*(call(item) for item in items), return_exceptions=True)
+    return [(item, None, r) if isinstance(r, BaseException) else (item, r, None) for item, r in zip(items, results)]
@@ -1,18 +1,156 @@
+import asyncio
 import logging
 import random
 import threading
 import time
 import queue
+import zlib
+import tracing
 from proton import Message
 from proton._reactor import Backoff
 from proton.handlers import MessagingHandler
-from proton.reactor import Container
+from proton.reactor import Container, EventInjector, ApplicationEvent
+from coalescer import Coalescer
+from dead_letter import DeadLetterBuffer
+from shards import SharedSubscription, shard_of
 
 # Configure logging
 # logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 # logger.setLevel(logging.INFO)
 
+
+class _BusyMeter:
+    """Time spent processing messages, for the utilisation of a worker."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._busy_since = None         # Start of the message(s) being processed, if any
+        self._busy_time = 0.0           # Total processing time of completed messages
+        self._sampled_at = time.monotonic()
+        self._sampled_busy = 0.0
+
+    def start(self):
+        with self._lock:
+            self._busy_since = time.monotonic()
+
+    def stop(self):
+        with self._lock:
+            self._busy_time += time.monotonic() - self._busy_since
+            self._busy_since = None
+
+    def utilisation(self):
+        """Fraction of time spent processing messages since the previous call."""
+        with self._lock:
+            now = time.monotonic()
+            busy = self._busy_time + (now - self._busy_since if self._busy_since is not None else 0.0)
+            elapsed = now - self._sampled_at
+            value = (busy - self._sampled_busy) / elapsed if elapsed > 0 else 0.0
+            self._sampled_at, self._sampled_busy = now, busy
+            return min(max(value, 0.0), 1.0)
+
+
+class _Worker:
+    """A message processing thread with its own queue. Messages in a queue are processed in order."""
+
+    def __init__(self, index, process):
+        self.name = str(index)
+        self.queue = queue.Queue()
+        self._process = process
+        self._meter = _BusyMeter()
+        self.thread = threading.Thread(target=self._run, name=f"worker-{index}", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            msg = self.queue.get()
+            if msg is None:  # Exit signal
+                break
+            self._meter.start()
+            try:
+                self._process(msg)
+            finally:
+                self._meter.stop()
+
+    def submit(self, key, item):
+        self.queue.put(item)
+
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def utilisation(self):
+        return self._meter.utilisation()
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+class _AsyncRunner:
+    """Processes messages as tasks of one event loop, run by a thread of its own, instead of one thread per
+    message in progress. Messages with the same partition key are processed in order (each one starts once
+    the previous one of its key is done); the others are processed concurrently."""
+
+    def __init__(self, process):
+        self.name = "async"
+        self._process = process         # Coroutine function, awaited with each item
+        self._meter = _BusyMeter()      # Busy while at least one message is being processed
+        self._lock = threading.Lock()
+        self._queued = 0                # Messages submitted, and not started yet
+        self._in_progress = 0
+        self._tasks = set()             # Loop thread only
+        self._tails = {}                # Partition key -> task of the key's last message (loop thread only)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="worker-async", daemon=True)
+        self.thread.start()
+
+    def submit(self, key, item):
+        with self._lock:
+            self._queued += 1
+        self.loop.call_soon_threadsafe(self._start, key, item)
+
+    def _start(self, key, item):
+        task = self.loop.create_task(self._run(self._tails.get(key), item))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        if key is not None:
+            self._tails[key] = task
+            task.add_done_callback(lambda t: self._tails.pop(key) if self._tails.get(key) is t else None)
+
+    async def _run(self, previous, item):
+        if previous is not None:
+            await asyncio.wait([previous])
+        with self._lock:
+            self._queued -= 1
+            self._in_progress += 1
+            if self._in_progress == 1:
+                self._meter.start()
+        try:
+            await self._process(item)
+        finally:
+            with self._lock:
+                self._in_progress -= 1
+                if self._in_progress == 0:
+                    self._meter.stop()
+
+    def queue_depth(self):
+        with self._lock:
+            return self._queued
+
+    def utilisation(self):
+        return self._meter.utilisation()
+
+    async def _drain(self):
+        while self._tasks:
+            await asyncio.wait(list(self._tasks))
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._drain(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
 class AMQPSubscriber(MessagingHandler):
     def __init__(self,
                  broker_url,
@@ -21,15 +159,32 @@ class AMQPSubscriber(MessagingHandler):
                  max_retries=10,
                  initial_reconnect_interval=5,
                  max_reconnect_interval=60,
-                 connection_status_callback=None
+                 connection_status_callback=None,
+                 worker_count=1,
+                 partition_key=None,
+                 buffer_size=100,
+                 coalesce_window=0,
+                 coalesce=None,
+                 dead_letter_buffer=None,
+                 dlq_batch_size=50,
+                 dlq_flush_interval=1.0,
+                 message_timing_callback=None,
+                 async_message_processor=None,
+                 shard_index=0,
+                 shard_count=1,
+                 shared_subscription=None,
+                 max_deliveries=5
                  ):
-        super().__init__()
+        # Credit is granted by hand, and deliveries are settled only once they have been processed
+        super().__init__(prefetch=0, auto_accept=False)
         self.broker_url = broker_url
         self.topic = f'topic://{topic}' if '://' not in topic else topic
         self.connection = None
         self.receiver = None
+        self.dlq_sender = None
         self.container = None
         self.message_processor = message_processor  # Store the message processor (function)
+        self.async_message_processor = async_message_processor  # Coroutine function, used instead if given
 
         # Reconnection settings
         self.max_retries = max_retries
@@ -40,20 +195,59 @@ class AMQPSubscriber(MessagingHandler):
 
         # Callbacks
         self.connection_status_callback = connection_status_callback
+        self.message_timing_callback = message_timing_callback  # Called with (queue wait, end-to-end latency) in seconds
 
         # Flags
         self.should_reconnect = True
 
-        # Message queue for async processing
-        self.message_queue = queue.Queue()
+        # Horizontal sharding over shard_count consumer processes. With a shared subscription (its name),
+        # the broker hands each message to one of the processes. Otherwise every process subscribes to the
+        # topic, and keeps only the messages whose partition key is its own (so one app's messages stay in
+        # order); the others are accepted right away
+        self.shard_index = shard_index
+        self.shard_count = max(1, shard_count)
+        self.shared_subscription = shared_subscription
 
-        # Start message processing thread
-        self.processing_thread = threading.Thread(target=self._process_messages, daemon=True)
-        self.processing_thread.start()
+        # Message processing workers. Messages with the same partition key (e.g. App.Id) always go
+        # to the same worker, so they are processed in order; other messages are processed in parallel
+        self.partition_key = partition_key
+        self._next_worker = 0
+        if async_message_processor is not None:
+            # One event loop processes all messages concurrently, so worker_count does not apply
+            self.workers = [_AsyncRunner(self._process_message_async)]
+        else:
+            self.workers = [_Worker(i, self._process_message) for i in range(max(1, worker_count))]
+
+        # Flow control: at most buffer_size messages are received and not yet settled. The receiver's
+        # link credit is topped up as messages are settled, so the broker stops delivering when workers fall behind
+        self.buffer_size = max(1, buffer_size)
+        self.unsettled = 0          # Updated on the reactor thread only
+        self.injector = None        # Passes completions from the workers back to the reactor thread
+
+        # Optional coalescing: messages with the same partition key are held for coalesce_window seconds,
+        # then coalesce(messages) collapses them into (message index, [folded indexes]) groups to process,
+        # and a list of cancelled message indexes, which are settled without being processed
+        self.coalesce = coalesce
+        self.coalescer = Coalescer(coalesce_window, self._flush_coalesced) \
+            if coalesce_window > 0 and coalesce and partition_key else None
+
+        # A message whose processing failed is redelivered (released as modified, with delivery-failed set),
+        # so that e.g. a create interrupted by an InfluxDB outage resumes; it is dead-lettered (and rejected)
+        # after max_deliveries attempts, or right away if it cannot be processed (PERMANENT_ERRORS)
+        self.max_deliveries = max(1, max_deliveries)
+
+        # Dead letters are buffered by the workers, and sent in batches by one long-lived sender on the
+        # reactor thread. Letters that cannot be sent while the broker is down are spilled to a local file
+        self.dead_letters = dead_letter_buffer or DeadLetterBuffer()
+        self.dlq_batch_size = max(1, dlq_batch_size)
+        self.dlq_flush_interval = dlq_flush_interval
+        self._dlq_flush_scheduled = False   # Reactor thread only
 
     def on_start(self, event):
         """Start the connection and subscribe to the topic."""
         self.container = event.container  # Save container reference
+        self.injector = EventInjector()
+        self.container.selectable(self.injector)
         self._connect()
 
     def _connect(self):
@@ -65,7 +259,12 @@ class AMQPSubscriber(MessagingHandler):
             logger.info(f"Connecting to {self.broker_url} and subscribing to {self.topic}...")
             reconnect_strategy = Backoff(initial=self.initial_reconnect_interval, max_delay=self.max_reconnect_interval, factor=1.5)  # Custom reconnect config
             self.connection = self.container.connect(self.broker_url, heartbeat=10, reconnect=reconnect_strategy)
-            self.receiver = self.container.create_receiver(self.connection, self.topic)
+            if self.shared_subscription:
+                self.receiver = self.container.create_receiver(self.connection, self.topic, name=self.shared_subscription,
+                                                               options=SharedSubscription())
+            else:
+                self.receiver = self.container.create_receiver(self.connection, self.topic)
+            self.dlq_sender = self.container.create_sender(self.connection, f"{self.topic}.DLQ")
             self.retry_count = 0  # Reset retry count on success
             self.current_reconnect_interval = self.initial_reconnect_interval  # Reset backoff
             self.connection_status_callback(1)  # Set connection status to 'up'
@@ -77,42 +276,206 @@ class AMQPSubscriber(MessagingHandler):
     # def on_connection_opened(self, event):
     #     logger.info(f"Connected to {self.broker_url}")
 
+    def on_link_opened(self, event):
+        """Grant the initial credit when the receiver link is (re)opened."""
+        if event.link.is_receiver:
+            self._top_up_credit(event.link)
+        elif event.link == self.dlq_sender:
+            self.dead_letters.restore()     # Letters spilled while the broker was unreachable
+
+    def _top_up_credit(self, link):
+        credit = self.buffer_size - self.unsettled - link.credit
+        if credit > 0:
+            link.flow(credit)
+
     def on_message(self, event):
         """Handle incoming messages asynchronously."""
+        counted = False
         try:
-            self.message_queue.put(event.message.body)
+            msg = event.message.body
+            key = self.partition_key(msg) if self.partition_key else None
+            if self.shard_count > 1 and not self.shared_subscription and shard_of(key, self.shard_count) != self.shard_index:
+                self.accept(event.delivery)     # Processed by another shard
+                self._top_up_credit(event.receiver)
+                return
+            self.unsettled += 1
+            counted = True
+            received_at = time.monotonic()
+            # Root span of the message (if its trace is sampled), ended once the message is processed
+            trace = tracing.start_trace("message", event.message.properties, app_id=key, topic=self.topic)
+            attempt = (event.message.delivery_count or 0) + 1
+            if self.coalescer and key is not None:
+                self.coalescer.offer(key, (event.delivery, msg, received_at, trace, attempt))
+            else:
+                self._worker_for(key).submit(key, ([event.delivery], msg, received_at, trace, attempt))
         except Exception as e:
             logger.error(f"Error queuing message: {e}")
+            self.reject(event.delivery)
+            if counted:
+                self.unsettled -= 1
+            self._top_up_credit(event.receiver)
 
-    def _process_messages(self):
-        """Continuously process messages from the queue."""
-        while True:
-            msg = self.message_queue.get()
-            if msg is None:  # Exit signal
-                break
+    def _flush_coalesced(self, key, items):
+        """Queue what is left of a key's messages after coalescing (called on the coalescer thread)."""
+        deliveries = [item[0] for item in items]
+        try:
+            groups, cancelled = self.coalesce([item[1] for item in items])
+        except Exception as e:
+            logger.error(f"Error coalescing messages of '{key}', processing them all: {e}")
+            groups, cancelled = [(i, []) for i in range(len(items))], []
+        for index, folded in groups:
+            indexes = [index] + folded
+            received_at = min(items[i][2] for i in indexes)
+            self._worker_for(key).submit(key, ([deliveries[i] for i in indexes], items[index][1], received_at,
+                                               items[index][3], max(items[i][4] for i in indexes)))
+            self._end_traces([items[i][3] for i in folded], coalesced='folded')
+        if cancelled:
+            logger.info(f"Coalesced away {len(cancelled)} message(s) of '{key}'")
+            self._end_traces([items[i][3] for i in cancelled], coalesced='cancelled')
+            self.injector.trigger(ApplicationEvent("message_processed", subject=([deliveries[i] for i in cancelled], 'accepted')))
+
+    @staticmethod
+    def _end_traces(traces, **attributes):
+        for trace in traces:
+            if trace is not None:
+                trace.attributes.update(attributes)
+                trace.end()
+
+    def _worker_for(self, key):
+        """Pick the worker of a message by its partition key, or round-robin if it has none."""
+        if key is None:
+            self._next_worker = (self._next_worker + 1) % len(self.workers)
+            return self.workers[self._next_worker]
+        return self.workers[zlib.crc32(str(key).encode()) % len(self.workers)]
+
+    def _process_message(self, item):
+        """Process one message from a worker queue, then have it settled on the reactor thread."""
+        deliveries, msg, received_at, trace, attempt = item
+        started_at = time.monotonic()
+        outcome = 'rejected'
+        try:
+            with tracing.activate(trace):
+                self._trace_queue_wait(started_at, received_at)
+                with tracing.span("process_message"):
+                    # Call the passed message processor function
+                    processed_message = self.message_processor(msg)
+            outcome = self._check_processed(msg, processed_message)
+        except Exception as e:
+            outcome = self._message_failed(msg, e, attempt)
+        finally:
+            self._message_done(deliveries, outcome, started_at, received_at, trace)
+
+    async def _process_message_async(self, item):
+        """Process one message on the event loop of the async runner, then have it settled on the reactor thread."""
+        deliveries, msg, received_at, trace, attempt = item
+        started_at = time.monotonic()
+        outcome = 'rejected'
+        try:
+            with tracing.activate(trace):
+                self._trace_queue_wait(started_at, received_at)
+                with tracing.span("process_message"):
+                    processed_message = await self.async_message_processor(msg)
+            outcome = self._check_processed(msg, processed_message)
+        except Exception as e:
+            outcome = self._message_failed(msg, e, attempt)
+        finally:
+            self._message_done(deliveries, outcome, started_at, received_at, trace)
+
+    @staticmethod
+    def _trace_queue_wait(started_at, received_at):
+        now = time.time_ns()
+        tracing.record("queue_wait", now - int((time.monotonic() - received_at) * 1e9),
+                       now - int((time.monotonic() - started_at) * 1e9))
+
+    def _check_processed(self, msg, processed_message):
+        logger.info(f"Processed message: {processed_message}")
+        # Simulate message processing failure
+        if "error" in msg:
+            raise ValueError("Simulated processing failure")
+        return 'accepted'
+
+    # Errors of messages which cannot be processed (e.g. without an App.Id, or not valid JSON, or a delete_2
+    # without stored state): not retried
+    PERMANENT_ERRORS = (KeyError, ValueError)
+
+    def _message_failed(self, msg, e, attempt):
+        """Outcome of a failed message: 'released' to have it redelivered, or 'rejected' once it is dead-lettered."""
+        if not isinstance(e, self.PERMANENT_ERRORS) and attempt < self.max_deliveries:
+            logger.warning(f"Message processing failed (attempt {attempt} of {self.max_deliveries}), "
+                           f"it will be redelivered: {e}\nmessage: {msg}\n")
+            return 'released'
+        logger.error(f"Message processing failed: {e}\nmessage: {msg}\n", exc_info=True)
+        self._send_to_dead_letter_queue(msg, str(e))
+        return 'rejected'
+
+    def _message_done(self, deliveries, outcome, started_at, received_at, trace=None):
+        if trace is not None:
+            if outcome != 'accepted':
+                trace.status = 'error'
+            trace.attributes['outcome'] = outcome
+            trace.end()
+        self.injector.trigger(ApplicationEvent("message_processed", subject=(deliveries, outcome)))
+        if self.message_timing_callback:
+            self.message_timing_callback(started_at - received_at, time.monotonic() - received_at)
+
+    def on_message_processed(self, event):
+        """Settle processed messages (on the reactor thread), and give back their credit."""
+        deliveries, outcome = event.subject
+        self.unsettled -= len(deliveries)
+        for delivery in deliveries:
             try:
-                # Call the passed message processor function
-                processed_message = self.message_processor(msg)
-                logger.info(f"Processed message: {processed_message}")
-                # Simulate message processing failure
-                if "error" in msg:
-                    raise ValueError("Simulated processing failure")
+                if outcome == 'accepted':
+                    self.accept(delivery)
+                elif outcome == 'released':
+                    delivery.local.failed = True    # Counted as a delivery attempt
+                    self.release(delivery, delivered=True)
+                else:
+                    self.reject(delivery)
             except Exception as e:
-                logger.error(f"Message processing failed: {e}\nmessage: {msg}\n", exc_info=True)
-                self._send_to_dead_letter_queue(msg, str(e))
+                logger.warning(f"Could not settle message (the link may have been reopened): {e}")
+        if self.receiver is not None and self.receiver.state & self.receiver.LOCAL_ACTIVE:
+            self._top_up_credit(self.receiver)
 
     def _send_to_dead_letter_queue(self, message_body, reason):
-        """Send failed messages to a Dead Letter Queue (DLQ)."""
+        """Queue a failed message for the Dead Letter Queue (DLQ). It is sent from the reactor thread."""
         try:
-            dlq_name = f"{self.topic}.DLQ"
-            sender = self.container.create_sender(self.connection, dlq_name)
-            sender.send(Message(body={
+            self.dead_letters.add({
                 "message": message_body,
                 "reason": reason
-            }))
-            logger.warning(f"Message moved to Dead Letter Queue: {dlq_name}")
+            })
+            self.injector.trigger(ApplicationEvent("dead_letter"))
         except Exception as e:
-            logger.error(f"Failed to send message to DLQ: {e}")
+            logger.error(f"Failed to queue message for the DLQ: {e}")
+
+    def on_dead_letter(self, event):
+        """Send the dead letters right away once a batch is full, otherwise after the flush interval."""
+        if len(self.dead_letters) >= self.dlq_batch_size:
+            self._flush_dead_letters()
+        elif not self._dlq_flush_scheduled:
+            self._dlq_flush_scheduled = True
+            self.container.schedule(self.dlq_flush_interval, self)
+
+    def on_timer_task(self, event):
+        self._dlq_flush_scheduled = False
+        self._flush_dead_letters()
+
+    def on_sendable(self, event):
+        if event.sender == self.dlq_sender:
+            self._flush_dead_letters()
+
+    def _flush_dead_letters(self):
+        """Send buffered dead letters, in batches, as far as the DLQ sender has credit (reactor thread)."""
+        sender = self.dlq_sender
+        while sender is not None and sender.credit > 0 and (len(self.dead_letters) or self.dead_letters.restore()):
+            letters = self.dead_letters.take(min(sender.credit, self.dlq_batch_size))
+            for i, letter in enumerate(letters):
+                try:
+                    sender.send(Message(body=letter))
+                except Exception as e:
+                    logger.error(f"Failed to send message to DLQ: {e}")
+                    self.dead_letters.put_back(letters[i:])
+                    return
+            logger.warning(f"{len(letters)} message(s) moved to Dead Letter Queue: {sender.target.address}")
 
     def on_transport_error(self, event):
         """Handle connection errors and attempt to reconnect with backoff."""
@@ -171,8 +534,11 @@ class AMQPSubscriber(MessagingHandler):
             if self.container:
                 logger.info("Shutting down the subscriber...")
                 self.container.stop()  # Stop the Proton event loop
-            self.message_queue.put(None)  # Signal the processing thread to exit
-            self.processing_thread.join()
+            if self.coalescer:
+                self.coalescer.stop()  # Hand over the messages still held for coalescing
+            for worker in self.workers:
+                worker.stop()  # Signal the processing threads to exit
+            self.dead_letters.spill()  # Keep unsent dead letters for the next run
         except Exception as e:
             logger.error(f"Error during disconnect: {e}")
 
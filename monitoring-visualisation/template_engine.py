@@ -0,0 +1,102 @@
+import logging
+import os
+import re
+import threading
+import yaml
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Placeholders in templates look like {field_name}
+PLACEHOLDER_PATTERN = re.compile(r'\{([A-Za-z_][A-Za-z0-9_]*)\}')
+# Placeholders are swapped for YAML-safe markers before parsing, so that e.g. an unquoted
+# '- {bucket_name}' is still read as a string, as it was when values were substituted into the text
+MARKER_PATTERN = re.compile(r'<%([A-Za-z_][A-Za-z0-9_]*)%>')
+
+
+class _Slot:
+    """A string value containing placeholders, kept as alternating literal and placeholder parts."""
+    __slots__ = ('parts',)
+
+    def __init__(self, parts):
+        self.parts = parts  # Even positions are literals, odd positions are placeholder names
+
+    def render(self, values):
+        out = []
+        for i, part in enumerate(self.parts):
+            if i % 2 == 0:
+                out.append(part)
+            elif part in values:
+                value = values[part]
+                out.append(value if isinstance(value, str) else str(value))
+            else:
+                out.append(f'{{{part}}}')   # Unknown placeholders are left untouched
+        return ''.join(out)
+
+
+class CompiledTemplate:
+    """A parsed template, with an index of the placeholders it contains."""
+
+    def __init__(self, file_path, mtime, text):
+        self.file_path = file_path
+        self.mtime = mtime
+        self.placeholders = set(PLACEHOLDER_PATTERN.findall(text))
+        data = yaml.safe_load(PLACEHOLDER_PATTERN.sub(r'<%\1%>', text))
+        self.tree = self._compile(data)
+
+    def _compile(self, node):
+        if isinstance(node, dict):
+            return {self._compile(k): self._compile(v) for k, v in node.items()}
+        if isinstance(node, list):
+            return [self._compile(v) for v in node]
+        if isinstance(node, str) and '<%' in node:
+            parts = MARKER_PATTERN.split(node)
+            if len(parts) > 1:
+                return _Slot(parts)
+        return node
+
+    def render(self, values):
+        """Return a fresh copy of the template data, with the placeholders substituted from values."""
+        return self._render(self.tree, values)
+
+    def _render(self, node, values):
+        if isinstance(node, dict):
+            return {self._render(k, values) if isinstance(k, _Slot) else k: self._render(v, values)
+                    for k, v in node.items()}
+        if isinstance(node, list):
+            return [self._render(v, values) for v in node]
+        if isinstance(node, _Slot):
+            return node.render(values)
+        return node
+
+
+class TemplateEngine:
+    """Cache of compiled templates. A template file is parsed again only when its mtime changes."""
+
+    def __init__(self):
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def get(self, file_path):
+        mtime = os.stat(file_path).st_mtime_ns
+        template = self._templates.get(file_path)
+        if template is None or template.mtime != mtime:
+            with self._lock:
+                template = self._templates.get(file_path)
+                if template is None or template.mtime != mtime:
+                    with open(file_path, 'r') as file:
+                        template = CompiledTemplate(file_path, mtime, file.read())
+                    self._templates[file_path] = template
+                    logger.info(f"Compiled template '{file_path}' with placeholders: {sorted(template.placeholders)}")
+        return template
+
+    def preload(self, file_paths):
+        for file_path in file_paths:
+            self.get(file_path)
+
+    def render(self, file_path, values):
+        return self.get(file_path).render(values)
+
+
+# Shared template engine
+TEMPLATES = TemplateEngine()
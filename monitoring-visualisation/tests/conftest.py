@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules of the service are top-level modules of its directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,105 @@
+import io
+import json
+import pytest
+from benchmarks.fake_influxdb import FakeInfluxdb
+from bulk_provision import BulkProvisioner
+from influx_helper import InfluxdbHelper
+from state_store import StateStore
+
+
+@pytest.fixture
+def fake():
+    fake = FakeInfluxdb()
+    url = fake.start()
+    yield fake, url
+    fake.stop()
+
+
+@pytest.fixture
+def store():
+    store = StateStore(':memory:')
+    yield store
+    store.close()
+
+
+def buckets(fake, app_id):
+    return [b for b in fake.data['buckets'].values() if b['name'] == f'neb_{app_id}_bucket']
+
+
+def run(url, store, jobs):
+    output = io.StringIO()
+    failed = BulkProvisioner(url, 'token', 'my-org', store, concurrency=4).run(jobs, output)
+    return failed, [json.loads(line) for line in output.getvalue().splitlines()]
+
+
+def test_jobs_of_one_app_run_in_file_order(fake, store):
+    fake, url = fake
+    jobs = [('app-1', 'create'), ('app-2', 'create'), ('app 1', 'find_all'), ('app-1', 'delete'), ('app-2', 'find_all')]
+    failed, results = run(url, store, jobs)
+    assert failed == 0
+    assert [(r['app-id'], r['operation']) for r in results if r['app-id'] != 'app-2'] == jobs[0:1] + jobs[2:4]
+    assert all(r['resources']['bucket_id'] for r in results if r['operation'] == 'find_all')
+    # app-1 is created, then deleted: nothing of it is left
+    assert 'app_1' not in store and 'app_2' in store
+    assert not buckets(fake, 'app_1') and buckets(fake, 'app_2')
+
+
+def test_delete_then_create_again(fake, store):
+    fake, url = fake
+    assert run(url, store, [('app-1', 'create')])[0] == 0
+    failed, results = run(url, store, [('app-1', 'delete'), ('app-1', 'create')])
+    assert failed == 0
+    assert [r['operation'] for r in results] == ['delete', 'create']
+    assert 'app_1' in store
+    assert len(buckets(fake, 'app_1')) == 1
+
+
+def test_create_after_incomplete_delete(fake, store, monkeypatch):
+    fake, url = fake
+    assert run(url, store, [('app-1', 'create')])[0] == 0
+
+    def fail(self):
+        raise Exception("injected failure")
+    with monkeypatch.context() as m:
+        m.setattr(InfluxdbHelper, 'delete_scraper', fail)
+        failed, results = run(url, store, [('app-1', 'delete')])
+    assert failed == 1
+    # The state is kept for a retry, without the create steps of the deleted resources: the scraper is left,
+    # but it writes to the deleted bucket
+    assert 'app_1' in store and not buckets(fake, 'app_1')
+    assert store.load('app_1')['completed_steps'] == ['set_org']
+
+    failed, results = run(url, store, [('app-1', 'create')])
+    assert failed == 0
+    assert len(buckets(fake, 'app_1')) == 1
+    assert len([s for s in fake.data['scrapers'].values() if s['name'] == 'neb_app_1_scraper']) == 1
+    assert [d for d in fake.data['dashboards'].values() if d['name'] == 'Nebulous Dashboard app_1']
+
+
+def test_delete_finds_the_stack_of_another_mode(fake, store, monkeypatch):
+    fake, url = fake
+    monkeypatch.setattr(InfluxdbHelper, 'PROVISIONING_MODE', 'stack')
+    assert run(url, store, [('app-1', 'create')])[0] == 0
+    store.delete('app_1')
+    monkeypatch.setattr(InfluxdbHelper, 'PROVISIONING_MODE', 'rest')
+    failed, results = run(url, store, [('app-1', 'delete')])
+    assert failed == 0
+    assert results[0]['resources']['delete_stack']['status'] == 'deleted'
+    assert not fake.data['stacks'] and not buckets(fake, 'app_1')
+
+
+class FakeInfluxdbWithoutStacks(FakeInfluxdb):
+    COLLECTIONS = {k: v for k, v in FakeInfluxdb.COLLECTIONS.items() if k != 'stacks'}
+
+
+def test_find_all_without_stacks_api(store):
+    fake = FakeInfluxdbWithoutStacks()
+    url = fake.start()
+    try:
+        assert run(url, store, [('app-1', 'create')])[0] == 0
+        failed, results = run(url, store, [('app-1', 'find_all'), ('app-1', 'delete')])
+        assert failed == 0
+        assert results[0]['resources']['bucket_id'] and 'delete_stack' not in results[1]['resources']
+        assert not buckets(fake, 'app_1')
+    finally:
+        fake.stop()
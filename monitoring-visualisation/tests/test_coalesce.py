@@ -0,0 +1,45 @@
+import json
+import pytest
+from app_initr_influx import coalesce_messages, message_app_id
+from state_store import StateStore
+
+
+def m(app_id, operation):
+    return json.dumps({'app-id': app_id, 'operation': operation})
+
+
+@pytest.fixture
+def store():
+    store = StateStore(':memory:')
+    store.save('live_app', {'app_id': 'live_app'})
+    yield store
+    store.close()
+
+
+def test_repeated_operations_are_folded(store):
+    assert coalesce_messages([m('a', 'create'), m('a', 'create'), m('a', 'create')], store) == ([(0, [1, 2])], [])
+    assert coalesce_messages([m('a', 'delete'), m('a', 'delete')], store) == ([(0, [1])], [])
+
+
+def test_create_then_delete_of_a_new_app_cancels_out(store):
+    assert coalesce_messages([m('a', 'create'), m('a', 'create'), m('a', 'delete_2')], store) == ([], [0, 1, 2])
+
+
+def test_create_then_delete_of_an_existing_app_keeps_the_delete(store):
+    # The create may be a duplicate of the one which created the app: only the delete is processed
+    assert coalesce_messages([m('live-app', 'create'), m('live-app', 'delete')], store) == ([(1, [0])], [])
+
+
+def test_create_then_delete_without_a_store_keeps_the_delete():
+    assert coalesce_messages([m('a', 'create'), m('a', 'delete')]) == ([(1, [0])], [])
+
+
+def test_order_changing_sequences_are_kept(store):
+    messages = [m('a', 'delete'), m('a', 'create'), m('a', 'find_all'), m('a', 'find_all'), 'not json']
+    assert coalesce_messages(messages, store) == ([(0, []), (1, []), (2, []), (3, []), (4, [])], [])
+
+
+def test_message_app_id():
+    assert message_app_id(m(' My-App.1 ', 'create')) == 'My_App_1'
+    assert message_app_id(m('', 'create')) is None
+    assert message_app_id('not json') is None
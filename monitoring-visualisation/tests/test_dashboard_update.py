@@ -0,0 +1,64 @@
+import os
+import pytest
+from benchmarks.fake_influxdb import FakeInfluxdb
+from influx_helper import InfluxdbHelper
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(autouse=True)
+def templates_dir(monkeypatch):
+    # The templates are read relative to the service directory
+    monkeypatch.chdir(SERVICE_DIR)
+
+
+def helper(url='http://influxdb.invalid:8086'):
+    return InfluxdbHelper(url, 'token', 'my-org', 'app-1')
+
+
+def test_no_changes_when_hashes_match():
+    h = helper()
+    h.cell_hashes = h.rendered_cell_hashes()
+    assert h.cell_hashes
+    assert h.plan_dashboard_update() == {}
+
+
+def test_changed_removed_and_unrecorded_cells():
+    h = helper()
+    rendered = h.rendered_cell_hashes()
+    first, second, *others = sorted(rendered)
+    h.cell_hashes = {name: dict(hashes) for name, hashes in rendered.items()}
+    h.cell_hashes[first]['view'] = 'old view'
+    h.cell_hashes[second]['position'] = 'old position'
+    h.cell_hashes['Removed from the template'] = {'position': 'p', 'view': 'v'}
+    for name in others:
+        del h.cell_hashes[name]
+    changes = h.plan_dashboard_update()
+    assert changes[first] == ['view']
+    assert changes[second] == ['position']
+    assert changes['Removed from the template'] == ['remove']
+    assert all(changes[name] == ['position', 'view'] for name in others)
+
+
+@pytest.fixture
+def fake():
+    fake = FakeInfluxdb()
+    url = fake.start()
+    yield fake, url
+    fake.stop()
+
+
+def test_update_dashboard_writes_only_the_changed_cells(fake):
+    fake, url = fake
+    h = helper(url)
+    h.create_all()
+    name = sorted(h.cell_hashes)[0]
+    h.cell_hashes[name] = dict(h.cell_hashes[name], view='old view')
+    fake.request_counts.clear()
+    assert h.update_dashboard() == {name: ['view']}
+    assert sorted(fake.request_counts) == [('GET', '/api/v2/dashboards/{id}'),
+                                           ('PATCH', '/api/v2/dashboards/{id}/cells/{id}/view')]
+    assert sum(fake.request_counts.values()) == 2
+    fake.request_counts.clear()
+    assert h.update_dashboard() == {}
+    assert not fake.request_counts
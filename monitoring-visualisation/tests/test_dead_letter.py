@@ -0,0 +1,55 @@
+import json
+from dead_letter import DeadLetterBuffer
+
+
+def letters(n, start=0):
+    return [{'message': f'm{i}', 'reason': 'failed'} for i in range(start, start + n)]
+
+
+def test_buffers_up_to_max_then_spills(tmp_path):
+    spill_file = tmp_path / 'spill.jsonl'
+    buffer = DeadLetterBuffer(max_buffered=3, spill_file=str(spill_file))
+    for letter in letters(5):
+        buffer.add(letter)
+    assert len(buffer) == 3
+    assert [json.loads(line)['message'] for line in spill_file.read_text().splitlines()] == ['m3', 'm4']
+
+
+def test_take_and_put_back_keep_the_order(tmp_path):
+    buffer = DeadLetterBuffer(max_buffered=10, spill_file=str(tmp_path / 'spill.jsonl'))
+    for letter in letters(4):
+        buffer.add(letter)
+    taken = buffer.take(3)
+    assert [x['message'] for x in taken] == ['m0', 'm1', 'm2']
+    buffer.put_back(taken[1:])
+    assert [x['message'] for x in buffer.take(10)] == ['m1', 'm2', 'm3']
+
+
+def test_restore_as_far_as_there_is_room(tmp_path):
+    spill_file = tmp_path / 'spill.jsonl'
+    buffer = DeadLetterBuffer(max_buffered=2, spill_file=str(spill_file))
+    buffer.spill(letters(3))
+    assert buffer.restore() == 2
+    assert [x['message'] for x in buffer.take(10)] == ['m0', 'm1']
+    assert [json.loads(line)['message'] for line in spill_file.read_text().splitlines()] == ['m2']
+    assert buffer.restore() == 1
+    assert not spill_file.exists()
+    assert buffer.restore() == 0
+
+
+def test_spill_file_size_is_bounded(tmp_path):
+    spill_file = tmp_path / 'spill.jsonl'
+    buffer = DeadLetterBuffer(max_buffered=0, spill_file=str(spill_file), spill_max_bytes=100)
+    for letter in letters(10):
+        buffer.add(letter)
+    assert 0 < spill_file.stat().st_size <= 100
+
+
+def test_spill_all_buffered_letters(tmp_path):
+    spill_file = tmp_path / 'spill.jsonl'
+    buffer = DeadLetterBuffer(max_buffered=10, spill_file=str(spill_file))
+    for letter in letters(3):
+        buffer.add(letter)
+    buffer.spill()
+    assert len(buffer) == 0
+    assert len(spill_file.read_text().splitlines()) == 3
@@ -0,0 +1,81 @@
+import email.utils
+import threading
+import time
+import pytest
+from governor import ConcurrencyGovernor, is_retryable, retry_after_seconds
+
+
+def test_retry_after_seconds():
+    assert retry_after_seconds('5') == 5.0
+    assert retry_after_seconds('-3') == 0.0
+    assert retry_after_seconds(None) is None
+    assert retry_after_seconds('soon') is None
+    now = time.time()
+    assert retry_after_seconds(email.utils.formatdate(now + 30, usegmt=True), now) == pytest.approx(30, abs=1)
+
+
+def test_is_retryable():
+    assert is_retryable('POST', 429)
+    assert not is_retryable('POST', 503)
+    assert all(is_retryable(method, 503) for method in ('GET', 'PATCH', 'DELETE'))
+    assert not is_retryable('GET', 500) and not is_retryable('GET', 200)
+
+
+def test_additive_increase_while_fully_used():
+    governor = ConcurrencyGovernor(initial=2, maximum=4)
+    for _ in range(10):
+        tickets = [governor.acquire() for _ in range(int(governor.limit))]
+        for ticket in tickets:
+            governor.release(ticket, 'GET /api/v2/buckets', 0.01, 200)
+    assert 3 <= governor.limit <= 4
+
+
+def test_no_increase_when_not_fully_used():
+    governor = ConcurrencyGovernor(initial=4, maximum=8)
+    for _ in range(20):
+        governor.release(governor.acquire(), 'GET /api/v2/buckets', 0.01, 200)
+    assert governor.limit == 4
+
+
+def test_multiplicative_decrease_once_per_round():
+    governor = ConcurrencyGovernor(initial=8, maximum=8)
+    tickets = [governor.acquire() for _ in range(4)]
+    governor.release(tickets[0], 'POST /api/v2/buckets', 0.01, 500)
+    assert governor.limit == 6
+    # Calls started before the cut do not cut the limit again
+    for ticket in tickets[1:]:
+        governor.release(ticket, 'POST /api/v2/buckets', 0.01, 500)
+    assert governor.limit == 6
+    governor.release(governor.acquire(), 'POST /api/v2/buckets', 0.01, None)
+    assert governor.limit == 4.5
+
+
+def test_throttled_response_halves_and_pauses_for_retry_after():
+    governor = ConcurrencyGovernor(initial=8, maximum=8, minimum=1)
+    governor.release(governor.acquire(), 'POST /api/v2/buckets', 0.01, 429, retry_after='0.3')
+    assert governor.limit == 4
+    start = time.monotonic()
+    governor.release(governor.acquire(), 'GET /api/v2/buckets', 0.01, 200)
+    assert time.monotonic() - start >= 0.25
+
+
+def test_limit_bounds_concurrent_calls():
+    governor = ConcurrencyGovernor(initial=2, maximum=2)
+    in_flight, peak, lock = [0], [0], threading.Lock()
+
+    def call():
+        ticket = governor.acquire()
+        with lock:
+            in_flight[0] += 1
+            peak[0] = max(peak[0], in_flight[0])
+        time.sleep(0.01)
+        with lock:
+            in_flight[0] -= 1
+        governor.release(ticket, 'GET /api/v2/buckets', 0.01, 200)
+
+    threads = [threading.Thread(target=call) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert peak[0] == 2
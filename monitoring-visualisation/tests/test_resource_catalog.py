@@ -0,0 +1,113 @@
+import json
+import pytest
+import urllib3.connection
+import resource_catalog
+from benchmarks.fake_influxdb import FakeInfluxdb
+from resource_catalog import ResourceCatalog, iter_json_section, iter_listing, resource_name
+
+LISTING = {
+    'links': {'self': '/api/v2/variables', 'next': None},
+    'variables': [
+        {'id': '1', 'name': 'plain', 'n': 12345},
+        {'id': '2', 'name': 'quote \" and \\\\ backslash', 'arguments': {'values': [1, 2.5, True, None]}},
+        {'id': '3', 'name': 'unicode é中 \U0001f600', 'escaped': '\\u00e9 \\n'},
+        {'id': '4', 'name': '{not: [an, object]}'},
+    ],
+    'total': 4,
+}
+
+
+def chunked(data, size):
+    return (data[i:i + size] for i in range(0, len(data), size))
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 5, 7, 16, 4096])
+def test_iter_json_section_across_chunk_boundaries(size):
+    # Every chunk size cuts strings, escapes, multi-byte characters and numbers somewhere
+    data = json.dumps(LISTING, ensure_ascii=False, indent=1).encode('utf-8')
+    others = {}
+    items = list(iter_json_section(chunked(data, size), 'variables', others))
+    assert items == LISTING['variables']
+    assert others == {'links': LISTING['links'], 'total': 4}
+
+
+def test_iter_json_section_without_section_or_empty():
+    assert list(iter_json_section([b'{}'], 'variables')) == []
+    others = {}
+    assert list(iter_json_section([b'{"variables": [], "links": {"next": "/x"}}'], 'variables', others)) == []
+    assert others == {'links': {'next': '/x'}}
+
+
+def test_iter_json_section_stops_reading_early():
+    data = json.dumps({'variables': [{'id': str(i), 'name': 'x' * 100} for i in range(1000)]}).encode('utf-8')
+    read = []
+
+    def chunks():
+        for chunk in chunked(data, 256):
+            read.append(chunk)
+            yield chunk
+
+    items = iter_json_section(chunks(), 'variables')
+    assert next(items)['id'] == '0'
+    assert next(items)['id'] == '1'
+    assert len(read) <= 2
+
+
+def test_iter_json_section_rejects_truncated_listing():
+    with pytest.raises(ValueError):
+        list(iter_json_section([b'{"variables": [{"id": "1"}, {"id": '], 'variables'))
+
+
+def test_resource_name_of_stacks():
+    assert resource_name({'name': 'bucket'}) == 'bucket'
+    assert resource_name({'id': '1', 'events': [{'name': 'old'}, {'name': 'neb_a_stack'}]}) == 'neb_a_stack'
+    assert resource_name({'id': '1'}) is None
+
+
+@pytest.fixture
+def fake():
+    fake = FakeInfluxdb(catalog_size=250)
+    url = fake.start()
+    yield fake, url
+    fake.stop()
+
+
+@pytest.mark.parametrize('stream', [True, False])
+def test_iter_listing_follows_pages(fake, stream):
+    fake, url = fake
+    names = [x['name'] for x in iter_listing(url, {}, '/api/v2/scrapers', 'configurations', stream=stream)]
+    assert len(names) == len(fake.data['scrapers'])
+    assert len(set(names)) == len(names)
+
+
+def test_iter_listing_stops_at_first_match(fake):
+    fake, url = fake
+    first = next(iter(fake.data['dashboards'].values()))
+    fake.request_counts.clear()
+    for x in iter_listing(url, {}, '/api/v2/dashboards', 'dashboards', page_size=10):
+        if x['name'] == first['name']:
+            break
+    assert sum(fake.request_counts.values()) == 1
+
+
+@pytest.mark.parametrize('drain_max_bytes, connections', [(resource_catalog.DRAIN_MAX_BYTES, 1), (0, 5)])
+def test_iter_listing_reuses_the_connection_after_an_early_exit(fake, monkeypatch, drain_max_bytes, connections):
+    fake, url = fake
+    connects = []
+    connect = urllib3.connection.HTTPConnection.connect
+    monkeypatch.setattr(urllib3.connection.HTTPConnection, 'connect',
+                        lambda self: connects.append(self) or connect(self))
+    monkeypatch.setattr(resource_catalog, 'CHUNK_SIZE', 1024)     # The first item is not the whole page
+    monkeypatch.setattr(resource_catalog, 'DRAIN_MAX_BYTES', drain_max_bytes)
+    for _ in range(5):
+        assert next(iter_listing(url, {}, '/api/v2/dashboards', 'dashboards'))
+    assert len(connects) == connections
+
+
+def test_catalog_lookup(fake):
+    fake, url = fake
+    bucket = next(iter(fake.data['buckets'].values()))
+    catalog = ResourceCatalog(url, {}, bucket['orgID'])
+    assert set(catalog.items) == set(ResourceCatalog.DEFAULT_TYPES)
+    assert catalog.lookup('buckets', bucket['name'])['id'] == bucket['id']
+    assert catalog.lookup('buckets', 'no such bucket') is None
@@ -0,0 +1,53 @@
+import pytest
+from state_store import StateStore
+
+
+@pytest.fixture
+def store():
+    store = StateStore(':memory:')
+    yield store
+    store.close()
+
+
+def test_save_and_load(store):
+    store.save('app_1', {'app_id': 'app_1', 'bucket_id': 'b1'}, {'user_password': 'p'})
+    assert store.load('app_1') == {'app_id': 'app_1', 'bucket_id': 'b1'}
+    assert store.load_secrets('app_1') == {'user_password': 'p'}
+    assert 'app_1' in store and len(store) == 1
+    assert store.load('app_2') is None and store.load_secrets('app_2') is None
+
+
+def test_save_without_secrets_keeps_stored_secrets(store):
+    store.save('app_1', {'bucket_id': 'b1'}, {'user_password': 'p'})
+    store.save('app_1', {'bucket_id': 'b2'}, None)
+    assert store.load('app_1') == {'bucket_id': 'b2'}
+    assert store.load_secrets('app_1') == {'user_password': 'p'}
+
+
+def test_save_replaces_secrets_when_given(store):
+    store.save('app_1', {}, {'user_password': 'p'})
+    store.save('app_1', {}, {'user_password': 'q'})
+    assert store.load_secrets('app_1') == {'user_password': 'q'}
+
+
+def test_update_merges_and_keeps_secrets(store):
+    store.save('app_1', {'bucket_id': 'b1', 'user_id': 'u1'}, {'user_password': 'p'})
+    assert store.update('app_1', {'user_id': 'u2'})
+    assert store.load('app_1') == {'bucket_id': 'b1', 'user_id': 'u2'}
+    assert store.load_secrets('app_1') == {'user_password': 'p'}
+    assert not store.update('app_2', {'user_id': 'u3'})
+    assert 'app_2' not in store
+
+
+def test_delete_removes_secrets(store):
+    store.save('app_1', {}, {'user_password': 'p'})
+    assert store.delete('app_1')
+    assert store.load('app_1') is None and store.load_secrets('app_1') is None
+    assert not store.delete('app_1')
+
+
+def test_iter_states_bounds_and_batches(store):
+    for i in range(7):
+        store.save(f'app_{i}', {'i': i})
+    assert [app_id for app_id, _, _ in store.iter_states(batch_size=3)] == [f'app_{i}' for i in range(7)]
+    assert [state['i'] for _, _, state in store.iter_states(start='app_2', end='app_5', batch_size=2)] == [2, 3, 4]
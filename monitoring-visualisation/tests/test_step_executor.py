@@ -0,0 +1,91 @@
+import asyncio
+import threading
+import pytest
+from step_executor import AsyncStepExecutor, Step, StepExecutor, run_parallel
+
+
+def recorder():
+    ran, lock = [], threading.Lock()
+
+    def step(name, fail=False):
+        def func():
+            with lock:
+                ran.append(name)
+            if fail:
+                raise RuntimeError(f"{name} failed")
+            return name
+        return func
+    return ran, step
+
+
+def test_runs_steps_after_their_dependencies():
+    ran, step = recorder()
+    steps = [Step('a', step('a')), Step('b', step('b'), ['a']), Step('c', step('c'), ['a']),
+             Step('d', step('d'), ['b', 'c'])]
+    executor = StepExecutor(4)
+    timings = executor.run(steps)
+    assert set(timings) == {'a', 'b', 'c', 'd'}
+    assert ran[0] == 'a' and ran[-1] == 'd'
+    assert executor.results == {'a': 'a', 'b': 'b', 'c': 'c', 'd': 'd'}
+
+
+def test_failure_skips_dependents_and_raises():
+    ran, step = recorder()
+    steps = [Step('a', step('a', fail=True)), Step('b', step('b'), ['a']), Step('c', step('c'))]
+    with pytest.raises(RuntimeError, match='a failed'):
+        StepExecutor(1).run(steps)
+    assert 'b' not in ran
+
+
+def test_keep_going_runs_all_steps():
+    ran, step = recorder()
+    steps = [Step('a', step('a', fail=True)), Step('b', step('b'), ['a']), Step('c', step('c'))]
+    executor = StepExecutor(2)
+    executor.run(steps, keep_going=True)
+    assert set(ran) == {'a', 'b', 'c'}
+    assert list(executor.errors) == ['a']
+
+
+def test_completed_steps_are_skipped_and_checkpointed():
+    ran, step = recorder()
+    steps = [Step('a', step('a')), Step('b', step('b'), ['a']), Step('c', step('c'), ['b'])]
+    done = []
+    StepExecutor(2).run(steps, completed=['a'], on_step_done=done.append)
+    assert ran == ['b', 'c'] and done == ['b', 'c']
+
+
+@pytest.mark.parametrize('steps, message', [
+    ([Step('a', None), Step('a', None)], 'Duplicate'),
+    ([Step('a', None, ['x'])], 'unknown'),
+    ([Step('a', None, ['b']), Step('b', None, ['a'])], 'cycle'),
+])
+def test_invalid_graphs(steps, message):
+    with pytest.raises(ValueError, match=message):
+        StepExecutor(1).run(steps)
+
+
+def test_async_executor_awaits_steps():
+    ran = []
+
+    def step(name, fail=False):
+        async def func():
+            await asyncio.sleep(0)
+            ran.append(name)
+            if fail:
+                raise RuntimeError(name)
+        return func
+
+    steps = [Step('a', step('a')), Step('b', step('b', fail=True), ['a']), Step('c', step('c'), ['b'])]
+    with pytest.raises(RuntimeError):
+        asyncio.run(AsyncStepExecutor(2).run(steps))
+    assert ran == ['a', 'b']
+
+
+def test_run_parallel_keeps_order_and_errors():
+    def func(x):
+        if x == 2:
+            raise ValueError(x)
+        return x * 10
+    outcomes = run_parallel(func, [1, 2, 3], 3)
+    assert [(item, result) for item, result, _ in outcomes] == [(1, 10), (2, None), (3, 30)]
+    assert isinstance(outcomes[1][2], ValueError)
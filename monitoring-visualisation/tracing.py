@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+
+import argparse
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import re
+import socket
+import sys
+import threading
+import time
+from contextlib import contextmanager
+import requests
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Lightweight trace spans, from the receipt of a message to each InfluxDB request. A trace is started per
+# message (with the trace ID of the message properties, if any) and sampled; the current span is kept in a
+# context variable, so steps run by other threads or tasks are attached to it when they copy the context.
+# Finished spans of sampled traces are written by a background thread, to a JSON lines file or an OTLP/HTTP
+# collector. Outside a sampled trace, span() does nothing.
+
+TRACEPARENT = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')   # W3C Trace Context
+HEX_TRACE_ID = re.compile(r'^[0-9a-f]{32}$')
+
+_current = contextvars.ContextVar('trace_span', default=None)
+
+
+class Span:
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'start_ns', 'end_ns', 'attributes', 'status')
+
+    def __init__(self, trace_id, name, parent_id=None, start_ns=None, attributes=None):
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.name = name
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes or {}
+        self.status = 'ok'
+
+    def child(self, name, start_ns=None, attributes=None):
+        return Span(self.trace_id, name, self.span_id, start_ns, attributes)
+
+    def end(self, end_ns=None):
+        if self.end_ns is None:
+            self.end_ns = end_ns or time.time_ns()
+            EXPORTER.export(self)
+
+    def fail(self, e):
+        self.status = 'error'
+        self.attributes['error'] = str(e)
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start_ns': self.start_ns,
+            'end_ns': self.end_ns,
+            'duration_ms': round((self.end_ns - self.start_ns) / 1e6, 3),
+            'status': self.status,
+            'attributes': self.attributes,
+        }
+
+
+def _property(properties, *names):
+    for name in names:
+        value = (properties or {}).get(name)
+        if value:
+            return str(value).strip().lower()
+    return None
+
+
+def start_trace(name, properties=None, **attributes):
+    """Root span of a message, or None if its trace is not sampled. The trace ID (and parent span) come from
+    a W3C 'traceparent' message property, whose sampled flag is followed, or else from a 'trace-id'
+    property; otherwise a new trace is started. Sampling: TRACE_SAMPLE_RATE of the traces."""
+    if not EXPORTER.enabled:
+        return None
+    trace_id, parent_id, sampled = None, None, None
+    m = TRACEPARENT.match(_property(properties, 'traceparent') or '')
+    if m:
+        trace_id, parent_id, sampled = m.group(1), m.group(2), bool(int(m.group(3), 16) & 1)
+    elif HEX_TRACE_ID.match((_property(properties, 'trace-id', 'trace_id') or '').replace('-', '')):
+        trace_id = _property(properties, 'trace-id', 'trace_id').replace('-', '')
+    if sampled is None:
+        sampled = random.random() < SAMPLE_RATE
+    if not sampled:
+        return None
+    return Span(trace_id or f"{random.getrandbits(128):032x}", name, parent_id, attributes=attributes)
+
+
+@contextmanager
+def activate(span):
+    """Make span (e.g. the root span of a message, or None) the current span, in this thread or task."""
+    token = _current.set(span)
+    try:
+        yield span
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def span(name, **attributes):
+    """A child span of the current span, current within the block; nothing outside a sampled trace."""
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+    s = parent.child(name, attributes=attributes)
+    token = _current.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.fail(e)
+        raise
+    finally:
+        _current.reset(token)
+        s.end()
+
+
+def record(name, start_ns, end_ns=None, **attributes):
+    """A finished child span of the current span, e.g. for a wait measured after the fact."""
+    parent = _current.get()
+    if parent is not None:
+        parent.child(name, start_ns, attributes).end(end_ns)
+
+
+def annotate(**attributes):
+    """Set attributes of the current span, if any."""
+    current = _current.get()
+    if current is not None:
+        current.attributes.update(attributes)
+
+
+def current_trace_id():
+    current = _current.get()
+    return current.trace_id if current is not None else None
+
+
+# ----------------------------------------------------------------------
+# Export
+
+class SpanExporter:
+    """Queues the finished spans of sampled traces, and writes them in batches from a background thread.
+    Spans are dropped (and counted) when the queue is full, rather than slowing message processing down."""
+
+    def __init__(self, writer=None, batch_size=512, flush_interval=1.0, max_queued=10000):
+        self.writer = writer
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._queue = queue.Queue(max_queued)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.writer is not None
+
+    def export(self, span):
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="trace-export", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def _take(self, timeout):
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=timeout))
+            while len(batch) < self.batch_size:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _run(self):
+        while True:
+            self._write(self._take(self.flush_interval))
+
+    def _write(self, batch):
+        if not batch:
+            return
+        try:
+            with self._lock:
+                self.writer(batch)
+        except Exception as e:
+            logger.warning(f"Could not export {len(batch)} span(s): {e}")
+
+    def flush(self):
+        """Write the spans still queued (e.g. at exit)."""
+        while not self._queue.empty():
+            self._write(self._take(0))
+
+
+class FileWriter:
+    """Appends spans to a file, one JSON object per line."""
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        os.makedirs(os.path.dirname(file_name) or '.', exist_ok=True)
+
+    def __call__(self, spans):
+        with open(self.file_name, 'a') as outfile:
+            outfile.write(''.join(json.dumps(s.to_dict(), default=str) + '\n' for s in spans))
+
+
+class OtlpWriter:
+    """Posts spans to an OpenTelemetry collector (or a stand-in), as OTLP/HTTP JSON."""
+
+    def __init__(self, endpoint, service_name, timeout=5):
+        self.url = endpoint.rstrip('/') + '/v1/traces'
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.resource = {'attributes': _otlp_attributes({
+            'service.name': service_name,
+            'service.instance.id': f"{socket.gethostname()}-{os.getpid()}",
+        })}
+
+    def __call__(self, spans):
+        payload = {'resourceSpans': [{
+            'resource': self.resource,
+            'scopeSpans': [{'scope': {'name': __name__}, 'spans': [_otlp_span(s) for s in spans]}],
+        }]}
+        response = self.session.post(self.url, json=payload, timeout=self.timeout)
+        response.raise_for_status()
+
+
+def _otlp_attributes(attributes):
+    def value_of(v):
+        if isinstance(v, bool):
+            return {'boolValue': v}
+        if isinstance(v, int):
+            return {'intValue': str(v)}
+        if isinstance(v, float):
+            return {'doubleValue': v}
+        return {'stringValue': str(v)}
+    return [{'key': k, 'value': value_of(v)} for k, v in attributes.items()]
+
+
+def _otlp_span(s):
+    span = {
+        'traceId': s.trace_id,
+        'spanId': s.span_id,
+        'name': s.name,
+        'kind': 1,      # Internal
+        'startTimeUnixNano': str(s.start_ns),
+        'endTimeUnixNano': str(s.end_ns),
+        'attributes': _otlp_attributes(s.attributes),
+        'status': {'code': 2, 'message': s.attributes.get('error', '')} if s.status == 'error' else {'code': 1},
+    }
+    if s.parent_id:
+        span['parentSpanId'] = s.parent_id
+    return span
+
+
+def writer_from_env():
+    exporter = os.getenv("TRACE_EXPORTER", "")     # '' (no tracing), 'file' or 'otlp'
+    if exporter == 'file':
+        return FileWriter(os.getenv("TRACE_FILE", "app-states/traces.jsonl"))
+    if exporter == 'otlp':
+        return OtlpWriter(os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "http://localhost:4318"),
+                          os.getenv("OTEL_SERVICE_NAME", "monitoring-visualisation"))
+    if exporter:
+        raise ValueError(f"Unknown TRACE_EXPORTER: {exporter}")
+    return None
+
+
+SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.1"))
+EXPORTER = SpanExporter(writer_from_env())
+
+
+# ----------------------------------------------------------------------
+# Critical path of the traces of an app, from a trace file
+
+def critical_path(span, children):
+    """Span IDs on the critical path below a span: going back from its end, the child which finished
+    last, then the child which finished last before that one started, and so on (recursively)."""
+    path = {span['span_id']}
+    cursor = span['end_ns']
+    for child in sorted(children.get(span['span_id'], []), key=lambda c: c['end_ns'], reverse=True):
+        if child['end_ns'] <= cursor:
+            path |= critical_path(child, children)
+            cursor = child['start_ns']
+    return path
+
+
+def print_trace(spans, output=sys.stdout):
+    by_id = {s['span_id']: s for s in spans}
+    children = {}
+    for s in spans:
+        children.setdefault(s['parent_id'], []).append(s)
+    roots = [s for s in spans if s['parent_id'] not in by_id]
+    path = set().union(*(critical_path(root, children) for root in roots))
+
+    def show(s, depth, t0):
+        marker = '*' if s['span_id'] in path else ' '
+        attributes = ' '.join(f"{k}={v}" for k, v in s['attributes'].items())
+        print(f"{marker} {(s['start_ns'] - t0) / 1e6:9.3f}ms {s['duration_ms']:9.3f}ms  {'  ' * depth}{s['name']}"
+              f"{' [error]' if s['status'] == 'error' else ''}  {attributes}", file=output)
+        for child in sorted(children.get(s['span_id'], []), key=lambda c: c['start_ns']):
+            show(child, depth + 1, t0)
+
+    for root in sorted(roots, key=lambda r: r['start_ns']):
+        print(f"trace {root['trace_id']}  (* critical path; start offset, duration)", file=output)
+        show(root, 0, root['start_ns'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Show the traces of an app from a trace file, with their critical path")
+    parser.add_argument('--file', default=os.getenv("TRACE_FILE", "app-states/traces.jsonl"), help="Trace file (default: TRACE_FILE or app-states/traces.jsonl)")
+    parser.add_argument('--app', help="App.Id: its traces")
+    parser.add_argument('--trace', help="Trace ID")
+    parser.add_argument('--last', type=int, default=1, help="Number of the app's latest traces shown (default: 1)")
+    args = parser.parse_args(argv)
+    if not args.app and not args.trace:
+        parser.error("--app or --trace is required")
+
+    traces = {}
+    with open(args.file, 'r') as infile:
+        for line in infile:
+            s = json.loads(line)
+            traces.setdefault(s['trace_id'], []).append(s)
+    if args.trace:
+        selected = [args.trace]
+    else:
+        from influx_helper import InfluxdbHelper
+        app_id = InfluxdbHelper.normalize_app_id(args.app)
+        starts = {trace_id: min(s['start_ns'] for s in spans) for trace_id, spans in traces.items()
+                  if any(s['attributes'].get('app_id') == app_id for s in spans)}
+        selected = sorted(starts, key=starts.get)[-args.last:]
+    if not selected or not all(trace_id in traces for trace_id in selected):
+        print("No trace found", file=sys.stderr)
+        return 1
+    for trace_id in selected:
+        print_trace(traces[trace_id])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())